@@ -0,0 +1,188 @@
+'''An on-disk cache of processed chunks, for reading the same file repeatedly
+
+Decompressing and decoding a full day of TAQ data takes a while, and it's
+the same work every time. With `TAQ2Chunks(..., cache=cache_dir)`, the first
+full pass over a file also writes its chunks to `cache_dir`, and later passes
+(with the same options) are served from a memory map of those, without
+touching the original file.
+
+Entries are keyed by the input file (path, size and modification time, or a
+checksum of its contents with `checksum=True`), and everything that affects
+the chunks (file_type, columns, time_mode, etc., see
+TAQ2Chunks.cache_options()). Once the cache is over `max_bytes`, the least
+recently used entries are removed.
+
+Each entry is a directory named by its key, containing the raw bytes of all
+chunks (records.bin), and meta.npz with the dtype, chunk boundaries and the
+header line of the file. Entries are written to a temporary directory that's
+only renamed once all chunks have been written, so an interrupted pass never
+leaves a partial entry.
+'''
+
+from hashlib import sha1
+from os import path, makedirs, listdir, rename, stat, utime, walk
+from shutil import rmtree
+from tempfile import mkdtemp
+from zlib import crc32
+
+import numpy as np
+
+from .utility import parse_size
+
+
+class CachedChunks:
+    '''One entry of a ChunkCache, for reading'''
+
+    def __init__(self, entry_dir):
+        with np.load(path.join(entry_dir, 'meta.npz')) as meta:
+            self.dtype = meta['template'].dtype
+            self.bounds = meta['bounds']
+            self.first_line = meta['first_line'].item()
+            self.infile_name = meta['infile_name'].item() or None
+
+        numrows = self.bounds[-1] if len(self.bounds) else 0
+        if numrows:
+            self.records = np.memmap(path.join(entry_dir, 'records.bin'),
+                                     dtype=self.dtype, mode='r',
+                                     shape=(numrows,))
+        else:
+            # mmap doesn't like empty maps
+            self.records = np.empty(0, dtype=self.dtype)
+
+    def __iter__(self):
+        '''Yield our chunks, as read-only views of the memory map'''
+        start = 0
+        for end in self.bounds:
+            yield self.records[start:end]
+            start = end
+
+
+class ChunkCache:
+    '''A directory of cached chunks, with least-recently-used eviction'''
+
+    # Bump this if the on-disk format (or the meaning of any option) changes
+    VERSION = 1
+
+    # Read size for checksums
+    CHECKSUM_BLOCK = 2 ** 22
+
+    def __init__(self, cache_dir, max_bytes=None, checksum=False):
+        '''Use (and create if needed) `cache_dir`
+
+        max_bytes : int or str
+            Remove least recently used entries once we're over this size. A
+            str like '20GB' is parsed by utility.parse_size(). Default is no
+            limit.
+        checksum : bool
+            Identify input files by a CRC-32 of their contents, rather than
+            their path, size and modification time. This costs a read of the
+            whole (compressed) file, but entries survive files being copied
+            or touched.
+        '''
+        self.cache_dir = cache_dir
+        if max_bytes is not None:
+            max_bytes = parse_size(max_bytes)
+        self.max_bytes = max_bytes
+        self.checksum = checksum
+        makedirs(cache_dir, exist_ok=True)
+
+    def file_identity(self, fname):
+        '''What we know about the input file, for our keys'''
+        file_stat = stat(fname)
+        if not self.checksum:
+            return (path.abspath(fname), file_stat.st_size,
+                    file_stat.st_mtime_ns)
+
+        crc = 0
+        with open(fname, 'rb') as infile:
+            for block in iter(lambda: infile.read(self.CHECKSUM_BLOCK), b''):
+                crc = crc32(block, crc)
+        return (file_stat.st_size, crc)
+
+    def key(self, fname, options):
+        '''Return the key for `fname` read with `options` (a dict)'''
+        parts = (self.VERSION, self.file_identity(fname),
+                 sorted(options.items()))
+        return sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        '''Return the CachedChunks for `key`, or None if we don't have it'''
+        entry_dir = path.join(self.cache_dir, key)
+        if not path.isdir(entry_dir):
+            return None
+        # Mark as recently used
+        utime(entry_dir)
+        return CachedChunks(entry_dir)
+
+    def store(self, key, chunks, dtype, first_line, infile_name=None):
+        '''Pass on `chunks`, and store them under `key` if we get to the end
+
+        This is a generator, so chunks are written as they're consumed. If
+        iteration stops early (or fails), nothing is stored.
+        '''
+        tmp_dir = mkdtemp(prefix=key + '.', suffix='.tmp', dir=self.cache_dir)
+        bounds = []
+        numrows = 0
+        stored = False
+        try:
+            with open(path.join(tmp_dir, 'records.bin'), 'wb') as outfile:
+                for chunk in chunks:
+                    # We write each chunk before passing it on, so recycled
+                    # chunks are fine
+                    outfile.write(
+                        memoryview(np.ascontiguousarray(chunk)).cast('B'))
+                    numrows += len(chunk)
+                    bounds.append(numrows)
+                    yield chunk
+
+            np.savez(path.join(tmp_dir, 'meta.npz'),
+                     template=np.empty(0, dtype=dtype),
+                     bounds=np.array(bounds, dtype=np.int64),
+                     first_line=np.array(first_line),
+                     infile_name=np.array(infile_name or ''))
+            try:
+                rename(tmp_dir, path.join(self.cache_dir, key))
+                stored = True
+            except OSError:
+                # Someone else stored the same entry first
+                pass
+        finally:
+            if not stored:
+                rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        '''Return [(last used, bytes, key), ...] for all complete entries'''
+        entries = []
+        for name in listdir(self.cache_dir):
+            entry_dir = path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or not path.isdir(entry_dir):
+                continue
+            size = sum(path.getsize(path.join(dirpath, fname))
+                       for dirpath, _, fnames in walk(entry_dir)
+                       for fname in fnames)
+            entries.append((stat(entry_dir).st_mtime_ns, size, name))
+        return entries
+
+    def size(self):
+        '''Total bytes of our complete entries'''
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''Remove least recently used entries until we're within max_bytes'''
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            # Readers with an open memory map are unaffected on POSIX
+            rmtree(path.join(self.cache_dir, name), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        '''Remove everything'''
+        for name in listdir(self.cache_dir):
+            rmtree(path.join(self.cache_dir, name), ignore_errors=True)
@@ -4,14 +4,26 @@ We're not sure this is the best way to go, but it's a reasonable place to start
 for a standard binary format'''
 
 from os import path
+from time import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from traceback import format_exc
+from zipfile import ZipFile, is_zipfile
 
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
 import tables as tb
 
 from .processing import SplitChunks
+from .symbols import SymbolTable
+from .utility import parse_size
 from . import TAQ2Chunks
 
 
+# How conv_to_hdf5 arranges tables, see there
+LAYOUTS = ['per-symbol', 'single']
+
+
 class H5Writer:
     '''Set up an hdf5 file, write tables from numpy struct arrays.
 
@@ -22,7 +34,39 @@ class H5Writer:
     # the first chunk seen by `.append()`.
     tb_desc = None
 
-    def __init__(self, h5_fname, title=None, filters=None):
+    # The table we're buffering rows for (see `append()`), its (path, name),
+    # the buffer and how many rows are in it
+    pending = pending_key = pending_rows = None
+    pending_fill = pending_space = 0
+
+    # Lookups of open tables, see `get_table()`
+    node_hits = node_misses = 0
+
+    # Named compression and chunkshape settings, see `__init__()`. These were
+    # picked with utils/benchmark_hdf5.py, which you can run on your own data
+    # (and machine) to see how they compare. A chunkshape of None lets
+    # PyTables guess, based on the size of the first chunk of each table.
+    presets = {
+        # Small files that will stick around. Checksums are likely redundant
+        # with ZFS, and perhaps LZ4 is too, but they're cheap.
+        'archive': dict(complib='blosc:lz4hc', complevel=9, shuffle=True,
+                        fletcher32=True, chunkshape=None),
+        # Quick to write (e.g., scratch files), for roughly 10% larger files.
+        # Bigger chunks mean fewer HDF5 chunk-index updates, but much bigger
+        # than this is slower, as every table's first chunk is compressed at
+        # full size however few rows it has.
+        'fast-write': dict(complib='blosc:lz4', complevel=1, shuffle=True,
+                           fletcher32=False, chunkshape=2 ** 13),
+        # Quick to read back: LZ4HC decompresses as fast as LZ4, but into
+        # smaller files, and without checksums to verify. PyTables' (small)
+        # chunks mean a short time range doesn't decompress much extra.
+        'fast-read': dict(complib='blosc:lz4hc', complevel=5, shuffle=True,
+                          fletcher32=False, chunkshape=None),
+    }
+
+    def __init__(self, h5_fname, title=None, filters=None, categories=None,
+                 preset='archive', chunkshape=None, buffer_bytes=2 ** 22,
+                 node_cache_size=256):
         '''Get ready to write to HDF5
 
         Note that the table description will be constructed based on the dtype
@@ -33,27 +77,117 @@ class H5Writer:
         title : str
             Specify the `title` of HDF5 file.
         filters : tb.Filters
-            How to compress, etc.?
+            How to compress, etc.? Default is from `preset`.
+        categories : dict of {name: np.ndarray}
+            Dictionaries for categorical columns (e.g., from
+            BytesSpec.categories()). These are the same for every table, so we
+            store them once, as `<name>_categories` attributes of the root
+            group.
+        preset : str
+            One of `H5Writer.presets`: 'archive' (the default) compresses
+            hard, and 'fast-write' and 'fast-read' trade file size for speed.
+            Note that blosc makes it harder to use our files with any runtime.
+        chunkshape : int
+            Rows per HDF5 chunk for new tables, overriding `preset`
+        buffer_bytes : int or str
+            Collect rows for a table until we have this many bytes (or the
+            table changes, see `append()`), rather than writing every piece
+            as it comes. A str like '16MB' is parsed by
+            utility.parse_size(). 0 or None writes right away.
+        node_cache_size : int
+            How many open tables to keep (see `get_table()`)
         '''
         if title is None:
             bname = path.basename(h5_fname)
             title, _ = path.splitext(bname)
 
+        if preset not in self.presets:
+            raise ValueError('Unknown preset: {}'.format(preset))
+        settings = dict(self.presets[preset])
+        preset_chunkshape = settings.pop('chunkshape')
+
         if filters is None:
-            filters = tb.Filters(complevel=9,
-                                 complib='blosc:lz4hc',
-                                 fletcher32=True)
-
-        # We're using aggressive compression and checksums, since this will
-        # likely stick around. That said, checksums are likely redundant with
-        # ZFS, and perhaps LZ4 is too. Moreover, blosc makes it harder to use
-        # this file with any runtime.
+            filters = tb.Filters(**settings)
+        if chunkshape is None:
+            chunkshape = preset_chunkshape
+        self.preset = preset
+        self.chunkshape = chunkshape
+        self.buffer_bytes = parse_size(buffer_bytes or 0)
+        self.node_cache_size = node_cache_size
+        # {(path, name): Table}, least recently used first
+        self.tables = OrderedDict()
+        # {dtype: table description}, see `description()`
+        self.descriptions = {}
+
         self.h5 = tb.open_file(h5_fname, title=title, mode='w',
                                filters=filters)
 
+        if categories:
+            for name, values in categories.items():
+                self.h5.root._v_attrs[name + '_categories'] = values
+
     def finalize_hdf5(self):
+        self.flush()
+        self.tables.clear()
         self.h5.close()
 
+    def get_table(self, path, name):
+        '''Return the table `name` at `path`, or None if there isn't one
+
+        Looking up a node in PyTables is slow (and PyTables only keeps a
+        few nodes open), so we keep the `node_cache_size` most recently used
+        tables. `node_hits` and `node_misses` count how that's going.
+        '''
+        key = (path, name)
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+            self.node_hits += 1
+            return table
+
+        self.node_misses += 1
+        where = path.rstrip('/') + '/' + name
+        if where not in self.h5:
+            return None
+        table = self.h5.get_node(where)
+        self.remember_table(key, table)
+        return table
+
+    def remember_table(self, key, table):
+        '''Add `table` to our open tables, dropping the oldest if we're full'''
+        self.tables[key] = table
+        if len(self.tables) > self.node_cache_size:
+            self.tables.popitem(last=False)
+
+    def forget_tables(self):
+        '''Forget our open tables, e.g., after moving or removing nodes'''
+        self.flush()
+        self.tables.clear()
+
+    def flush(self):
+        '''Write any rows we're buffering for a table'''
+        if self.pending_fill:
+            self.pending.append(self.pending_rows[:self.pending_fill])
+        self.pending = self.pending_key = None
+        self.pending_fill = 0
+
+    def create_indexes(self, columns):
+        '''Build completely sorted indexes on `columns` of all our tables
+
+        Tables that don't have a column are skipped. PyTables then uses these
+        for conditions on these columns in `read_where()`, `where()`, etc.
+        (see `query()`). Note that each table gets its own index, so this is
+        much quicker with layout='single' than with thousands of tables.
+        '''
+        self.flush()
+        for table in self.h5.walk_nodes('/', 'Table'):
+            for name in columns:
+                if name not in table.colnames:
+                    continue
+                column = table.cols._f_col(name)
+                if not column.is_indexed:
+                    column.create_csindex()
+
     def set_table_type(self, target_dtype):
         '''Convert NumPy dtype to PyTable descriptor (adapted from
         blaze.pytables).  E.g.:
@@ -68,7 +202,7 @@ class H5Writer:
 
         tb_desc = {}
         for pos, name in enumerate(target_dtype.names):
-            dt, _ = target_dtype.fields[name]
+            dt, offset = target_dtype.fields[name][:2]
             # We may eventually want to deal with datetime64 columns, but for
             # now, we don't need to
             # if issubclass(dt.type, np.datetime64):
@@ -76,64 +210,718 @@ class H5Writer:
             # else:
             desc, _ = tb.descr_from_dtype(np.dtype([(name, dt)]))
             getattr(desc, name)._v_pos = pos
+            # Recent PyTables records each column's offset, which would
+            # otherwise be 0 for all of our single-column descriptions
+            getattr(desc, name)._v_offset = offset
             tb_desc.update(desc._v_colobjects)
 
         self.tb_desc = tb_desc
 
-    def append(self, path, name, data):
+    def description(self, dtype):
+        '''Return the PyTables description for `dtype`, computing it once'''
+        try:
+            return self.descriptions[dtype]
+        except KeyError:
+            self.set_table_type(dtype)
+            self.descriptions[dtype] = self.tb_desc
+            return self.tb_desc
+
+    def append(self, path, name, data, expectedrows=None):
         '''Put `data` in a table at `path`. Create the table if needed.
 
         path : str
             '/'-separated path from the root
         data : compatible array/buffer object
             E.g., numpy structured array
+        expectedrows : int
+            For a new table, how big it will get. PyTables uses this to pick
+            a chunkshape (if we don't have one), otherwise it goes by `data`.
+
+        New tables use `self.chunkshape` (rows per HDF5 chunk) if it's set,
+        otherwise PyTables picks one based on the size of `data`, which may be
+        rather small for a table that grows a lot. See `presets`.
 
-        XXX currently, we are not being very smart about chunkshape. We should
-        revisit. If we get two chunks for the same location, but with different
+        With `buffer_bytes`, rows are copied to a buffer for the table, which
+        is written in whole HDF5 chunks once it's full. When a symbol spans
+        our input chunks, SplitChunks gives us a piece of it for each one, so
+        this saves lots of tiny appends (especially with small chunks). The
+        rest is written when we get data for a different table (i.e., the
+        symbol changes), on `flush()` and in `finalize_hdf5()`. Tables are
+        created (empty) straight away, so you can set attributes, etc. Only
+        read them after a flush, though.
+
+        XXX If we get two chunks for the same location, but with different
         dtypes, this function will try to do an append that won't work!
         '''
-        # This is an optimization to avoid computing the tb_desc too many times
-        if self.tb_desc is None or self.source_dtype != data.dtype:
-            self.source_dtype = data.dtype
-            self.set_table_type(self.source_dtype)
+        if self.buffer_bytes:
+            if (path, name) != self.pending_key or \
+                    data.dtype != self.pending_rows.dtype:
+                self.flush()
+                self.start_buffer(path, name, data, expectedrows)
+            self.buffer(data)
+            return
 
-        try:
-            table = self.h5.get_node(path, name)
-            # This will generate an error if the previous chunk had a different
-            # dtype
+        table = self.get_table(path, name)
+        if table is None:
+            self.create_table(path, name, data, expectedrows)
+        else:
+            # This will generate an error if the previous chunk had a
+            # different dtype
             table.append(data)
+
+    def create_table(self, path, name, data, expectedrows=None):
+        '''Create a table at `path` for data like `data`, and put it in'''
+        if self.chunkshape is None:
+            chunkshape = None
+        else:
+            chunkshape = (self.chunkshape,)
+        if expectedrows is None:
+            expectedrows = len(data)
+        table = self.h5.create_table(path, name,
+                                     description=self.description(data.dtype),
+                                     createparents=True, obj=data,
+                                     chunkshape=chunkshape,
+                                     expectedrows=max(expectedrows, 1))
+        self.remember_table((path, name), table)
+        return table
+
+    def start_buffer(self, path, name, data, expectedrows=None):
+        '''Get the table at `path` ready for `buffer()`, creating if needed'''
+        table = self.get_table(path, name)
+        if table is None:
+            # Empty for now, but PyTables should pick a chunkshape for all of
+            # the rows we'll get
+            table = self.create_table(path, name, data[:0],
+                                      expectedrows or len(data))
+
+        # A whole number of HDF5 chunks, so each full buffer is written as
+        # complete chunks
+        chunk_rows = table.chunkshape[0]
+        capacity = max(self.buffer_bytes // data.dtype.itemsize, chunk_rows)
+        capacity -= capacity % chunk_rows
+        if self.pending_rows is None or \
+                self.pending_rows.dtype != data.dtype or \
+                len(self.pending_rows) != capacity:
+            self.pending_rows = np.empty(capacity, dtype=data.dtype)
+
+        self.pending = table
+        self.pending_key = (path, name)
+        self.pending_fill = 0
+        # If the table already ends part way through an HDF5 chunk, our
+        # first write completes it
+        self.pending_space = capacity - table.nrows % chunk_rows
+
+    def buffer(self, data):
+        '''Copy `data` to our buffer for `self.pending`, writing when full'''
+        while len(data):
+            take = min(len(data), self.pending_space - self.pending_fill)
+            self.pending_rows[self.pending_fill:self.pending_fill + take] = \
+                data[:take]
+            self.pending_fill += take
+            data = data[take:]
+            if self.pending_fill == self.pending_space:
+                self.pending.append(self.pending_rows[:self.pending_fill])
+                self.pending_fill = 0
+                self.pending_space = len(self.pending_rows)
+
+
+class SortedTableWriter:
+    '''Write all records to one table, sorted by symbol and time
+
+    Along with it, we write a small table of the rows for each symbol, so a
+    symbol is still read as one contiguous slice (see `read_symbol()`). Each
+    row of this index has Symbol_root, Symbol_suffix, start and stop (and
+    Symbol_ID, if our chunks have it). The symbol columns themselves are
+    dropped from the big table.
+
+    TAQ files are already sorted this way, so usually we just append whole
+    chunks. If the input turns out not to be sorted, `finalize()` rewrites the
+    table in order, one symbol at a time (so the biggest symbol needs to fit
+    in memory).
+    '''
+
+    # Columns that only identify the symbol, which we leave to the index
+    symbol_columns = ['Symbol_root', 'Symbol_suffix', 'Symbol_ID']
+
+    def __init__(self, h5writer, name='records', index_name='symbol_index',
+                 expectedrows=None):
+        '''Write to tables `name` and `index_name` in the root of `h5writer`
+
+        expectedrows : int
+            Passed on to H5Writer.append, this should be the number of rows in
+            the file (e.g., `len(taq_in)`)
+        '''
+        self.h5writer = h5writer
+        self.name = name
+        self.index_name = index_name
+        self.expectedrows = expectedrows
+        self.numrows = 0
+        # [[(root, suffix), Symbol_ID, start, stop], ...], in the order we
+        # wrote them. Once we're done, there's one per symbol if we're sorted.
+        self.runs = []
+        self.has_ids = False
+        self.last_time = None
+        self.in_order = True
+
+    def append(self, chunk):
+        '''Write a chunk (with symbol columns), keeping track of symbols'''
+        if len(chunk) == 0:
+            return
+
+        roots = chunk['Symbol_root']
+        suffixes = chunk['Symbol_suffix']
+        changes = (roots[1:] != roots[:-1]) | (suffixes[1:] != suffixes[:-1])
+        starts = np.flatnonzero(changes) + 1
+        self.has_ids = 'Symbol_ID' in chunk.dtype.names
+
+        if 'Time' in chunk.dtype.names:
+            times = chunk['Time']
+            # Time may only go backwards where the symbol changes
+            if (times[1:] < times[:-1])[~changes].any():
+                self.in_order = False
+        else:
+            times = None
+
+        for start, stop in zip(np.r_[0, starts], np.r_[starts, len(chunk)]):
+            symbol = (roots[start], suffixes[start])
+            if self.runs and self.runs[-1][0] == symbol:
+                # Continued from the last chunk
+                if times is not None and times[start] < self.last_time:
+                    self.in_order = False
+                self.runs[-1][3] += stop - start
+            else:
+                if self.runs and symbol < self.runs[-1][0]:
+                    # Either out of order, or we've seen it before
+                    self.in_order = False
+                symbol_id = chunk['Symbol_ID'][start] if self.has_ids else -1
+                self.runs.append([symbol, symbol_id, self.numrows + start,
+                                  self.numrows + stop])
+            if times is not None:
+                self.last_time = times[stop - 1]
+
+        keep = [name for name in chunk.dtype.names
+                if name not in self.symbol_columns]
+        self.h5writer.append('/', self.name, repack_fields(chunk[keep]),
+                             self.expectedrows)
+        self.numrows += len(chunk)
+
+    def finalize(self):
+        '''Sort the table if needed, and write the symbol index'''
+        if not self.in_order:
+            self.sort()
+
+        index_dtype = [('Symbol_root', 'S6'), ('Symbol_suffix', 'S10')]
+        if self.has_ids:
+            index_dtype.append(('Symbol_ID', np.int32))
+        index_dtype += [('start', np.int64), ('stop', np.int64)]
+
+        index = np.empty(len(self.runs), dtype=index_dtype)
+        for i, (symbol, symbol_id, start, stop) in enumerate(self.runs):
+            index[i]['Symbol_root'], index[i]['Symbol_suffix'] = symbol
+            if self.has_ids:
+                index[i]['Symbol_ID'] = symbol_id
+            index[i]['start'] = start
+            index[i]['stop'] = stop
+        self.h5writer.append('/', self.index_name, index)
+
+    def sort(self):
+        '''Rewrite our table in order of symbol, then Time'''
+        self.h5writer.flush()
+        h5 = self.h5writer.h5
+        if '/' + self.name not in h5:
+            # No rows
+            return
+        table = h5.get_node('/', self.name)
+        sorted_name = self.name + '_sorted'
+
+        by_symbol = {}
+        for symbol, symbol_id, start, stop in self.runs:
+            by_symbol.setdefault(symbol, (symbol_id, []))[1].append(
+                (start, stop))
+
+        runs = []
+        numrows = 0
+        for symbol in sorted(by_symbol):
+            symbol_id, ranges = by_symbol[symbol]
+            rows = np.concatenate([table.read(start, stop)
+                                   for start, stop in ranges])
+            if 'Time' in rows.dtype.names:
+                rows = rows[np.argsort(rows['Time'], kind='stable')]
+            self.h5writer.append('/', sorted_name, rows, self.numrows)
+            runs.append([symbol, symbol_id, numrows, numrows + len(rows)])
+            numrows += len(rows)
+
+        self.h5writer.forget_tables()
+        table.remove()
+        h5.rename_node('/', self.name, sorted_name)
+        self.runs = runs
+        self.in_order = True
+
+
+def file_layout(h5):
+    '''The layout of an open file from conv_to_hdf5, see there'''
+    # Files from before we had layouts are all per-symbol
+    return getattr(h5.root._v_attrs, 'layout', 'per-symbol')
+
+
+def symbol_location(h5, symbol_root, symbol_suffix=b''):
+    '''Return (table, start, stop) of the rows for a symbol
+
+    start and stop are None for the per-symbol layout (i.e., the whole table).
+    symbol_root and symbol_suffix are str or bytes, without padding. Raises
+    KeyError if we don't have the symbol.
+    '''
+    if isinstance(symbol_root, str):
+        symbol_root = symbol_root.encode('ascii')
+    if isinstance(symbol_suffix, str):
+        symbol_suffix = symbol_suffix.encode('ascii')
+
+    if file_layout(h5) == 'per-symbol':
+        path, name = node_location(symbol_root, symbol_suffix or b' ')
+        try:
+            return h5.get_node(path, name), None, None
         except tb.NoSuchNodeError:
-            self.h5.create_table(path, name, description=self.tb_desc,
-                                 createparents=True, obj=data)
+            raise KeyError((symbol_root, symbol_suffix))
 
+    index = h5.root.symbol_index.read()
+    found = np.flatnonzero(
+        (np.char.strip(index['Symbol_root']) == symbol_root) &
+        (np.char.strip(index['Symbol_suffix']) == symbol_suffix))
+    if not len(found):
+        raise KeyError((symbol_root, symbol_suffix))
+    entry = index[found[0]]
+    return h5.root.records, int(entry['start']), int(entry['stop'])
 
-def conv_to_hdf5(taq_name, h5_name):
-    '''Read raw bytes from TAQ, write to HDF5'''
-    taq_in = TAQ2Chunks(taq_name, do_process_chunk=True)
+
+def node_symbol(table):
+    '''Return (root, suffix) bytes for a per-symbol table, see node_location'''
+    suffix = {'no_suffix': '', 'dot': '.'}.get(table.name, table.name)
+    return (table._v_parent._v_name.encode('ascii'), suffix.encode('ascii'))
+
+
+def read_symbol(h5, symbol_root, symbol_suffix=b''):
+    '''Read all rows for a symbol from an open file from conv_to_hdf5
+
+    This works with either layout. symbol_root and symbol_suffix are str or
+    bytes, without padding.
+    '''
+    table, start, stop = symbol_location(h5, symbol_root, symbol_suffix)
+    return table.read(start, stop)
+
+
+def time_condition(start=None, stop=None, condition=None, condvars=None):
+    '''Return (condition, condvars) for PyTables, for Time in [start, stop)
+
+    start and stop are in the units of the Time column (see the `time_mode`
+    attribute of the root group), and either may be None for no limit.
+    `condition` is any other PyTables condition (e.g., 'Bid_Price > 0'), and
+    `condvars` has any variables it uses. condition is '' if there's nothing
+    to check.
+    '''
+    condvars = dict(condvars or {})
+    parts = []
+    if start is not None:
+        parts.append('(Time >= time_start)')
+        condvars['time_start'] = start
+    if stop is not None:
+        parts.append('(Time < time_stop)')
+        condvars['time_stop'] = stop
+    if condition:
+        parts.append('({})'.format(condition))
+
+    return ' & '.join(parts), condvars
+
+
+def query_symbol(h5, symbol_root, symbol_suffix=b'', start=None, stop=None,
+                 condition=None, condvars=None):
+    '''Read a symbol's rows with Time in [start, stop) that match `condition`
+
+    h5 is an open file from conv_to_hdf5, in either layout. See
+    `time_condition()` for the rest. If the file has indexes (see
+    `conv_to_hdf5(indexes=True)`), PyTables uses them for Time.
+    '''
+    table, row_start, row_stop = symbol_location(h5, symbol_root,
+                                                 symbol_suffix)
+    condition, condvars = time_condition(start, stop, condition, condvars)
+    if not condition:
+        return table.read(row_start, row_stop)
+    return table.read_where(condition, condvars, start=row_start,
+                            stop=row_stop)
+
+
+def query(h5, start=None, stop=None, condition=None, condvars=None):
+    '''Yield ((root, suffix), rows) for every symbol with matching rows
+
+    This is like `query_symbol()`, across all symbols (in order). root and
+    suffix are bytes, without padding. With layout='single', this is a
+    single query of /records, which is where the Time index really pays off,
+    as a time range is spread over the whole table.
+    '''
+    condition, condvars = time_condition(start, stop, condition, condvars)
+
+    if file_layout(h5) == 'per-symbol':
+        for table in h5.walk_nodes('/', 'Table'):
+            # Symbol tables are in a group for their root
+            if table._v_parent is h5.root:
+                continue
+            if condition:
+                rows = table.read_where(condition, condvars)
+            else:
+                rows = table.read()
+            if len(rows):
+                yield node_symbol(table), rows
+        return
+
+    table = h5.root.records
+    index = h5.root.symbol_index.read()
+    if condition:
+        coords = table.get_where_list(condition, condvars, sort=True)
+    else:
+        coords = np.arange(table.nrows)
+    # Which entry of the index each row belongs to
+    entries = np.searchsorted(index['stop'], coords, side='right')
+    bounds = np.flatnonzero(entries[1:] != entries[:-1]) + 1
+    for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(coords)]):
+        if lo == hi:
+            # No rows at all
+            continue
+        entry = index[entries[lo]]
+        symbol = (entry['Symbol_root'].strip(), entry['Symbol_suffix'].strip())
+        if condition:
+            yield symbol, table.read_coordinates(coords[lo:hi])
+        else:
+            yield symbol, table.read(coords[lo], coords[hi - 1] + 1)
+
+
+class H5Reader:
+    '''Read symbols and time ranges from files from conv_to_hdf5, with a cache
+
+    This is for reading the same (hot) symbols over and over. We keep up to
+    `max_files` files open, and a least-recently-used cache of decompressed
+    blocks of rows, up to `cache_bytes` for all files. Time ranges are found
+    by binary search on the Time column, which is sorted within each symbol
+    (in either layout), so we only decompress the blocks we need. Counts of
+    block lookups are in `hits` and `misses`, see `report()`.
+
+    For example:
+
+    >>> with H5Reader('256MB') as reader:  # doctest: +SKIP
+    ...     rows = reader.read('EQY_US_ALL_BBO_20140206.h5', 'AAPL',
+    ...                        start=t0, stop=t1)
+    '''
+
+    def __init__(self, cache_bytes='256MB', max_files=16, block_rows=None):
+        '''Get ready to read
+
+        cache_bytes : int or str
+            Limit for decompressed blocks, for all files. A str like '1GB' is
+            parsed by utility.parse_size().
+        max_files : int
+            How many files to keep open
+        block_rows : int
+            Rows per block. Default is the HDF5 chunkshape of each table, so a
+            block is decompressed in one go.
+        '''
+        self.cache_bytes = parse_size(cache_bytes)
+        self.max_files = max_files
+        self.block_rows = block_rows
+        # {abspath: tb.File}, least recently used first
+        self.files = OrderedDict()
+        # {(abspath, table path, block number): rows}, likewise
+        self.blocks = OrderedDict()
+        self.cached_bytes = 0
+        # {(abspath, root, suffix): (table path, start, stop, block rows)}
+        self.locations = {}
+        self.hits = self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Close our files, and empty the cache'''
+        for h5 in self.files.values():
+            h5.close()
+        self.files.clear()
+        self.blocks.clear()
+        self.cached_bytes = 0
+
+    def open(self, h5_fname):
+        '''Return the open tb.File for `h5_fname`, opening it if needed'''
+        fname = path.abspath(h5_fname)
+        h5 = self.files.get(fname)
+        if h5 is not None:
+            self.files.move_to_end(fname)
+            return h5
+
+        h5 = self.files[fname] = tb.open_file(fname)
+        if len(self.files) > self.max_files:
+            # Its blocks can stay cached, it'll be the same file next time
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        return h5
+
+    def locate(self, h5_fname, symbol_root, symbol_suffix=b''):
+        '''Return (table path, start, stop, block rows) for a symbol
+
+        See `symbol_location()`, though start and stop are always rows.
+        '''
+        key = (path.abspath(h5_fname), symbol_root, symbol_suffix)
+        try:
+            return self.locations[key]
+        except KeyError:
+            pass
+
+        table, start, stop = symbol_location(self.open(h5_fname),
+                                             symbol_root, symbol_suffix)
+        if start is None:
+            start, stop = 0, table.nrows
+        location = self.locations[key] = (
+            table._v_pathname, start, stop,
+            self.block_rows or table.chunkshape[0])
+        return location
+
+    def block(self, h5_fname, table_path, block_rows, number):
+        '''Return rows [number * block_rows, (number + 1) * block_rows)
+
+        Blocks are read-only, as they're shared by everyone using the cache.
+        '''
+        key = (path.abspath(h5_fname), table_path, number)
+        rows = self.blocks.get(key)
+        if rows is not None:
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return rows
+
+        self.misses += 1
+        table = self.open(h5_fname).get_node(table_path)
+        rows = table.read(number * block_rows, (number + 1) * block_rows)
+        rows.flags.writeable = False
+        self.blocks[key] = rows
+        self.cached_bytes += rows.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.blocks) > 1:
+            _, oldest = self.blocks.popitem(last=False)
+            self.cached_bytes -= oldest.nbytes
+        return rows
+
+    def find_time(self, h5_fname, location, value):
+        '''Return the first row of a symbol with Time >= value
+
+        `location` is from `locate()`. If all times are less than `value`,
+        this is the end of the symbol.
+        '''
+        table_path, start, stop, block_rows = location
+        if start == stop:
+            return start
+
+        # Binary search on blocks, by the last Time in each, so we only
+        # decompress those along the way
+        first, last = start // block_rows, (stop - 1) // block_rows
+        while first < last:
+            middle = (first + last) // 2
+            rows = self.block(h5_fname, table_path, block_rows, middle)
+            if rows['Time'][-1] < value:
+                first = middle + 1
+            else:
+                last = middle
+
+        rows = self.block(h5_fname, table_path, block_rows, first)
+        offset = first * block_rows
+        lo = max(start, offset) - offset
+        hi = min(stop, offset + len(rows)) - offset
+        return offset + lo + int(np.searchsorted(rows['Time'][lo:hi], value))
+
+    def read(self, h5_fname, symbol_root, symbol_suffix=b'', start=None,
+             stop=None):
+        '''Read a symbol's rows with Time in [start, stop)
+
+        symbol_root and symbol_suffix are str or bytes, without padding.
+        start and stop are in the units of the Time column, and either may
+        be None for no limit. Raises KeyError if the file doesn't have the
+        symbol. The result is a new array, so you can modify it.
+        '''
+        location = self.locate(h5_fname, symbol_root, symbol_suffix)
+        table_path, lo, hi, block_rows = location
+        if start is not None:
+            lo = self.find_time(h5_fname, location, start)
+        if stop is not None:
+            hi = max(self.find_time(h5_fname, location, stop), lo)
+
+        pieces = []
+        for number in range(lo // block_rows, (hi - 1) // block_rows + 1):
+            rows = self.block(h5_fname, table_path, block_rows, number)
+            offset = number * block_rows
+            pieces.append(rows[max(lo - offset, 0):hi - offset])
+        if not pieces:
+            table = self.open(h5_fname).get_node(table_path)
+            return np.empty(0, dtype=table.dtype)
+        return np.concatenate(pieces)
+
+    def hit_rate(self):
+        '''Fraction of block lookups that were cached'''
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        return '{} hits, {} misses ({:.1%} hit rate), {} blocks ' \
+            '({:.1f} MB) cached'.format(self.hits, self.misses,
+                                        self.hit_rate(), len(self.blocks),
+                                        self.cached_bytes / 1e6)
+
+
+def node_location(symbol, suffix):
+    '''Return (path, name) of the table for padded bytes `symbol`, `suffix`'''
+    path = '/' + symbol.strip().decode('ascii')
+
+    # Clean up our suffix, including special cases
+    if suffix.isspace():
+        suffix = 'no_suffix'
+    else:
+        suffix = suffix.strip().decode('ascii')
+        # This happens in at least EQY_US_ALL_BBO_20140206.zip
+        # It appears to be undocumented
+        if suffix == '.':
+            suffix = 'dot'
+
+    return path, suffix
+
+
+def conv_to_hdf5(taq_name, h5_name, time_mode='float', price_mode='float',
+                 categorical=False, symbol_ids=None, memory_budget=None,
+                 calibrate=False, validate=False, preset='archive',
+                 filters=None, chunkshape=None, layout='per-symbol',
+                 indexes=False, buffer_bytes=2 ** 22):
+    '''Read raw bytes from TAQ, write to HDF5
+
+    time_mode : str
+        Passed on to TAQ2Chunks, and recorded in the `time_mode` attribute of
+        the root group. For 'ns' or 'ms', Time is stored as a plain Int64Col.
+    price_mode : str
+        Passed on to TAQ2Chunks, and recorded in the `price_mode` attribute of
+        the root group (along with `price_scale` for integer prices). Integer
+        prices are exact, and compress rather better.
+    categorical : bool
+        Passed on to TAQ2Chunks. Category dictionaries are stored by H5Writer.
+    symbol_ids : True or SymbolTable
+        Passed on to TAQ2Chunks. We then split on the int32 Symbol_ID rather
+        than the symbol bytes, which are dropped from our tables. Instead,
+        each table has a Symbol_ID attribute, and the whole SymbolTable is
+        stored once, in the /symbols table.
+    memory_budget : int or str
+        Passed on to TAQ2Chunks, to pick the chunksize.
+    calibrate : bool
+        Instead, use the fastest chunksize within memory_budget (which is then
+        required) from TAQ2Chunks.calibrate().
+    validate : bool or 'raise'
+        Passed on to TAQ2Chunks. With True, we print the validation report
+        when we're done.
+    preset, filters, chunkshape, buffer_bytes
+        Passed on to H5Writer. The preset is recorded in the `preset`
+        attribute of the root group.
+    layout : str
+        'per-symbol' (the default) makes a table for each symbol and suffix
+        (e.g., /AAPL/no_suffix). 'single' puts all rows in one /records table,
+        sorted by symbol and time, with the rows for each symbol in
+        /symbol_index (see SortedTableWriter). This is much quicker to write
+        and compresses better, as there are only two nodes. Either way,
+        `read_symbol()` reads a symbol's rows, and the layout is recorded in
+        the `layout` attribute of the root group.
+    indexes : bool
+        Build completely sorted indexes on Time and the sequence number
+        column of every table (see H5Writer.create_indexes), for quicker
+        queries with `query()` and `query_symbol()`. The indexed columns are
+        recorded in the `indexes` attribute of the root group.
+
+    Returns the number of rows written.'''
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout: {}'.format(layout))
+
+    taq_args = dict(time_mode=time_mode, price_mode=price_mode,
+                    categorical=categorical)
+    if calibrate:
+        if memory_budget is None:
+            raise ValueError('calibrate needs a memory_budget')
+        chunksize, _ = TAQ2Chunks.calibrate(taq_name, memory_budget,
+                                            **taq_args)
+        memory_budget = None
+    else:
+        chunksize = None
+
+    taq_in = TAQ2Chunks(taq_name, chunksize=chunksize, do_process_chunk=True,
+                        symbol_ids=symbol_ids, memory_budget=memory_budget,
+                        validate=validate, **taq_args)
 
     # XXX Should I use a context manager here?
-    h5writer = H5Writer(h5_name)
+    h5writer = H5Writer(h5_name, categories=taq_in.bytes_spec.categories(),
+                        preset=preset, filters=filters,
+                        chunkshape=chunkshape, buffer_bytes=buffer_bytes)
+    h5writer.h5.root._v_attrs.file_type = taq_in.file_type
+    h5writer.h5.root._v_attrs.preset = preset
+    h5writer.h5.root._v_attrs.layout = layout
+    h5writer.h5.root._v_attrs.time_mode = time_mode
+    h5writer.h5.root._v_attrs.price_mode = price_mode
+    if price_mode != 'float':
+        h5writer.h5.root._v_attrs.price_scale = taq_in.bytes_spec.PRICE_SCALE
     # XXX We set sorted_cols to False here for now so things work on our test
     # data.  Should revert this.
-    split = SplitChunks(taq_in, ['Symbol_root', 'Symbol_suffix'],
-                        drop_columns=True, sorted_cols=False)
+    if layout == 'single':
+        # We write whole chunks, no need to split them
+        split = ()
+        sorted_writer = SortedTableWriter(h5writer, expectedrows=len(taq_in))
+    elif symbol_ids is None:
+        split = SplitChunks(taq_in, ['Symbol_root', 'Symbol_suffix'],
+                            drop_columns=True, sorted_cols=False)
+    else:
+        split = SplitChunks(taq_in, ['Symbol_ID'], drop_columns=True,
+                            sorted_cols=False,
+                            drop_also=['Symbol_root', 'Symbol_suffix'])
+    if symbol_ids is not None:
+        symbol_table = taq_in.symbol_table
+        # Table locations, so we only decode each symbol once
+        locations = {}
 
+    numrows = 0
     try:
-        for security, chunk in split:
-            symbol, suffix = security
-            path = '/' + symbol.strip().decode('ascii')
+        if layout == 'single':
+            for chunk in taq_in:
+                sorted_writer.append(chunk)
+                numrows += len(chunk)
+            sorted_writer.finalize()
 
-            # Clean up our suffix, including special cases
-            if suffix.isspace():
-                suffix = 'no_suffix'
+        for security, chunk in split:
+            if symbol_ids is None:
+                path, suffix = node_location(*security)
+                h5writer.append(path, suffix, chunk)
             else:
-                suffix = suffix.strip().decode('ascii')
-                # This happens in at least EQY_US_ALL_BBO_20140206.zip
-                # It appears to be undocumented
-                if suffix == '.':
-                    suffix = 'dot'
+                symbol_id = int(security[0])
+                new_table = symbol_id not in locations
+                if new_table:
+                    locations[symbol_id] = \
+                        node_location(*symbol_table[symbol_id])
+                path, suffix = locations[symbol_id]
+                h5writer.append(path, suffix, chunk)
+                if new_table:
+                    h5writer.get_table(path, suffix)._v_attrs.Symbol_ID = \
+                        symbol_id
+            numrows += len(chunk)
+
+        if symbol_ids is not None:
+            symbols = np.empty(len(symbol_table),
+                               dtype=[('Symbol_ID', np.int32),
+                                      ('Symbol_root', symbol_table.root_dtype),
+                                      ('Symbol_suffix',
+                                       symbol_table.suffix_dtype)])
+            symbols['Symbol_ID'] = np.arange(len(symbol_table))
+            symbols['Symbol_root'], symbols['Symbol_suffix'] = \
+                symbol_table.as_arrays()
+            h5writer.append('/', 'symbols', symbols)
 
-            h5writer.append(path, suffix, chunk)
+        if indexes:
+            index_columns = ['Time', taq_in.bytes_spec.sequence_field]
+            h5writer.create_indexes(index_columns)
+            h5writer.h5.root._v_attrs.indexes = index_columns
 
     # We want to make sure we close our file nicely (though I'm pretty sure
     # pytables handles this anyway...)
@@ -142,6 +930,85 @@ def conv_to_hdf5(taq_name, h5_name):
 
     # I care less about closing the taq_in file...
 
+    if validate is True:
+        print('{}: {}'.format(taq_name, taq_in.validator.report()))
+
+    return numrows
+
+
+class ConversionStats(namedtuple('ConversionStats',
+                                 ['taq_name', 'h5_name', 'numrows', 'nbytes',
+                                  'seconds', 'error'])):
+    '''The outcome of converting a single file'''
+
+    def report(self):
+        if self.error is not None:
+            return '{} FAILED after {:.3} sec:\n{}'.format(
+                self.taq_name, self.seconds, self.error)
+
+        return '{}: {} rows in {:.3} sec ({:,.0f} rows/s, {:.1f} MB/s)'.format(
+            self.taq_name, self.numrows, self.seconds,
+            self.numrows / self.seconds, self.nbytes / 1e6 / self.seconds)
+
+
+def uncompressed_size(taq_name):
+    '''Total uncompressed size of the members of a zip file
+
+    Uncompressed TAQ files are also fine.'''
+    if not is_zipfile(taq_name):
+        return path.getsize(taq_name)
+
+    with ZipFile(taq_name) as zfile:
+        return sum(zinfo.file_size for zinfo in zfile.infolist())
+
+
+def timed_conversion(taq_name, h5_name, **conv_args):
+    '''Run conv_to_hdf5, returning ConversionStats instead of raising
+
+    This is a top-level function so it can be used in a process pool.
+    `conv_args` are passed on to conv_to_hdf5.
+    '''
+    tstart = time()
+    nbytes = numrows = 0
+    try:
+        nbytes = uncompressed_size(taq_name)
+        numrows = conv_to_hdf5(taq_name, h5_name, **conv_args)
+        error = None
+    except Exception:
+        error = format_exc()
+
+    return ConversionStats(taq_name, h5_name, numrows, nbytes,
+                           time() - tstart, error)
+
+
+def convert_many(conversions, jobs=1, **conv_args):
+    '''Convert [(taq_name, h5_name), ...], yielding ConversionStats
+
+    Files are started largest (uncompressed) first, so a big file doesn't end
+    up running alone at the end. With jobs > 1, we use a process pool, and
+    results are yielded as they finish. An error in one file doesn't affect
+    the others. `conv_args` are passed on to conv_to_hdf5.
+    '''
+    def size_or_zero(names):
+        # A bad file should fail in timed_conversion, not here
+        try:
+            return uncompressed_size(names[0])
+        except Exception:
+            return 0
+
+    conversions = sorted(conversions, key=size_or_zero, reverse=True)
+
+    if jobs <= 1:
+        for taq_name, h5_name in conversions:
+            yield timed_conversion(taq_name, h5_name, **conv_args)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(timed_conversion, taq_name, h5_name,
+                                   **conv_args)
+                       for taq_name, h5_name in conversions]
+            for future in as_completed(futures):
+                yield future.result()
+
 
 def taq2h5(overwrite=False):
     '''Basic conversion from zip file to HDF5, use like this:
@@ -153,17 +1020,76 @@ def taq2h5(overwrite=False):
     from os import path
     from argparse import ArgumentParser
 
-    from .utility import timeit
-
     parser = ArgumentParser()
     parser.add_argument('--overwrite', action='store_true',
                         help='Overwrite existing .h5 files')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of files to convert in parallel')
+    parser.add_argument('--time-mode', choices=['float', 'ns', 'ms'],
+                        default='float',
+                        help='Time as float seconds (with hour, minute and '
+                             'msec), int64 ns since the epoch or int64 ms '
+                             'since midnight')
+    parser.add_argument('--price-mode', choices=['float', 'int', 'int32'],
+                        default='float',
+                        help='Prices as float64 dollars, or exact integers '
+                             'in units of $0.0001')
+    parser.add_argument('--categorical', action='store_true',
+                        help='Store single-byte indicator columns as uint8 '
+                             'codes')
+    parser.add_argument('--symbol-ids', action='store_true',
+                        help='Split on int32 symbol IDs, and store symbols '
+                             'once per file in a /symbols table')
+    parser.add_argument('--symbol-table', metavar='FILE',
+                        help='Like --symbol-ids, but with IDs that are '
+                             'consistent across runs, kept in FILE '
+                             '(created if needed)')
+    parser.add_argument('--memory-budget', metavar='SIZE',
+                        help='Memory for chunks of each file, e.g. 512MB')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Use the fastest chunk size that fits in '
+                             '--memory-budget, timed on each file')
+    parser.add_argument('--validate', action='store_const', const='raise',
+                        default=False,
+                        help='Check raw records, and fail on bad ones')
+    parser.add_argument('--preset', choices=sorted(H5Writer.presets),
+                        default='archive',
+                        help='Compression and chunk settings: small files '
+                             '(archive, the default), or bigger files that '
+                             'are quicker to write or read')
+    parser.add_argument('--chunkshape', type=int, metavar='ROWS',
+                        help='Rows per HDF5 chunk, overriding --preset')
+    parser.add_argument('--layout', choices=LAYOUTS, default='per-symbol',
+                        help='A table per symbol (the default), or a single '
+                             'table sorted by symbol, with an index of where '
+                             'each symbol is')
+    parser.add_argument('--write-buffer', metavar='SIZE', default=2 ** 22,
+                        help='Collect rows for each table until we have '
+                             'this much, e.g. 16MB (0 to write every piece '
+                             'right away)')
+    parser.add_argument('--indexes', action='store_true',
+                        help='Index Time and sequence numbers, for quicker '
+                             'queries')
     parser.add_argument('fnames', nargs='+', metavar='filename',
                         help='A TAQ file to convert')
     parsed = parser.parse_args()
 
-    timed_conv = timeit(conv_to_hdf5)
+    if parsed.calibrate and parsed.memory_budget is None:
+        parser.error('--calibrate needs --memory-budget')
+
+    symbol_ids = None
+    if parsed.symbol_table is not None:
+        # Each process would make its own additions to the table
+        if parsed.jobs > 1:
+            parser.error('--symbol-table only works with --jobs 1')
+        if path.exists(parsed.symbol_table):
+            symbol_ids = SymbolTable.load(parsed.symbol_table)
+        else:
+            symbol_ids = SymbolTable()
+    elif parsed.symbol_ids:
+        symbol_ids = True
 
+    conversions = []
     for name in parsed.fnames:
         h5_name, _ = path.splitext(name)
         h5_name += '.h5'
@@ -172,4 +1098,40 @@ def taq2h5(overwrite=False):
         if (not parsed.overwrite) and path.exists(h5_name):
             print('skipping, {} exists'.format(h5_name))
         else:
-            timed_conv(name, h5_name)
+            conversions.append((name, h5_name))
+
+    tstart = time()
+    total_rows = total_bytes = 0
+    failed = []
+    for stats in convert_many(conversions, parsed.jobs,
+                              time_mode=parsed.time_mode,
+                              price_mode=parsed.price_mode,
+                              categorical=parsed.categorical,
+                              symbol_ids=symbol_ids,
+                              memory_budget=parsed.memory_budget,
+                              calibrate=parsed.calibrate,
+                              validate=parsed.validate,
+                              preset=parsed.preset,
+                              chunkshape=parsed.chunkshape,
+                              layout=parsed.layout,
+                              indexes=parsed.indexes,
+                              buffer_bytes=parsed.write_buffer):
+        print(stats.report())
+        if stats.error is None:
+            total_rows += stats.numrows
+            total_bytes += stats.nbytes
+        else:
+            failed.append(stats.taq_name)
+    elapsed = time() - tstart
+
+    if parsed.symbol_table is not None:
+        symbol_ids.save(parsed.symbol_table)
+
+    if conversions:
+        print('Total: {} files, {} rows in {:.3} sec '
+              '({:,.0f} rows/s, {:.1f} MB/s)'.format(
+                  len(conversions) - len(failed), total_rows, elapsed,
+                  total_rows / elapsed, total_bytes / 1e6 / elapsed))
+    if failed:
+        print('Failed: {}'.format(', '.join(failed)))
+        return 1
@@ -6,6 +6,9 @@ from string import ascii_uppercase
 from random import sample
 
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+from .fixed_width import DigitDecoder
 
 
 # While our generator functions aren't quite objects, they're used more like
@@ -86,6 +89,8 @@ class Sanitizer(ProcessChunk):
 
     # This will preserve the fake symbol across chunks
     symbol_map = {}
+    # DigitDecoders for fudge_columns, by raw dtype
+    _decoders = {}
     ascii_bytes = ascii_uppercase.encode('ascii')
 
     def _process_chunks(self, iterator_in):
@@ -116,28 +121,34 @@ class Sanitizer(ProcessChunk):
         Make sure the values stay monotonic, and don't get bigger than
         max_value.'''
 
+        decoder = self._decoders.get(chunk.dtype)
+        if decoder is None:
+            decoder = self._decoders[chunk.dtype] = \
+                DigitDecoder(chunk.dtype, self.fudge_columns)
+
+        # Note that we don't worry about decimal place here - just treating
+        # everything as an integer is fine for this purpose
+        decoded = decoder.decode(chunk)
+        fake_values = {}
         for col in self.fudge_columns:
-            # Note that we don't worry about decimal place here - just treating
-            # everything as an integer is fine for this purpose
-            data = chunk[col].astype(np.int64)
+            data = decoded[col]
             mean_val = np.mean(data)
             std_val = np.std(data)
             fake_data = (np.random.standard_normal(len(data)) *
                          std_val + mean_val).astype(np.int64)
-            # np.min wasn't working here
-            fake_data[fake_data < 0] = 0
-
-            num_bytes = len(chunk[0][col])
-            fake_bytes = np.char.zfill(
-                fake_data.astype('S{}'.format(num_bytes)), num_bytes)
+            # Keep to what fits in the field
+            num_bytes = chunk.dtype[col].itemsize
+            np.clip(fake_data, 0, 10 ** num_bytes - 1, out=fake_data)
+            fake_values[col] = fake_data
 
-            # this is where the side-effects happen
-            chunk[col] = fake_bytes
+        # this is where the side-effects happen, writing zero-padded digits
+        # for whole columns at once
+        decoder.encode(fake_values, chunk)
 
 
 class SplitChunks(ProcessChunk):
     def _process_chunks(self, iterator_in, columns, drop_columns=False,
-                        sorted_cols=True):
+                        sorted_cols=True, drop_also=()):
         '''Split a chunk based on a list of columns
 
         columns : sequence[str]
@@ -151,6 +162,11 @@ class SplitChunks(ProcessChunk):
             Normally, our TAQ data is sorted by symbol. But our synthetic data
             currently isn't. Maybe other data wouldn't be either? Default is
             True.
+        drop_also : sequence[str]
+            With drop_columns, also drop these columns from split chunks. This
+            is for columns that are constant whenever `columns` are (e.g.,
+            Symbol_root and Symbol_suffix when splitting on Symbol_ID), so we
+            don't need to split on them.
 
         Note that if the next chunk exhibits the continuation of a symbol, this
         will NOT combine derived chunks for the same symbol.
@@ -158,6 +174,7 @@ class SplitChunks(ProcessChunk):
         self.columns = columns
         self.drop_columns = drop_columns
         self.sorted_cols = sorted_cols
+        self.drop_also = drop_also
 
         for chunk in iterator_in:
             unique_symbols, start_indices = \
@@ -185,10 +202,14 @@ class SplitChunks(ProcessChunk):
             except AttributeError:
                 return_columns = self.return_columns = \
                     [name for name in chunk.dtype.names
-                     if name not in self.columns]
+                     if name not in self.columns and
+                     name not in self.drop_also]
 
             # This assumes we have non-empty chunks, which should be true
             # It's a bit redundant with np.unique above, but meh...
-            return chunk[self.columns][0], chunk[return_columns]
+            # Multi-field indexing returns a view with padding (numpy >=
+            # 1.16), which PyTables won't accept, so we repack (a copy)
+            return (chunk[self.columns][0],
+                    repack_fields(chunk[return_columns]))
         else:
             return chunk
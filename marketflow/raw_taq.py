@@ -3,15 +3,42 @@
 A central design goal is minimizing external dependencies
 '''
 
-from zipfile import ZipFile
+from zipfile import ZipFile, is_zipfile, ZIP_DEFLATED
+from os import path
 
 from pytz import timezone
 import numpy as np
 from datetime import datetime
+from time import time
+from collections import deque
+
+from .fixed_width import DigitDecoder
+from .zran import SeekIndex, MemberReader, member_data_range, index_name
+from .utility import Prefetcher, parse_size
+from .symbols import SymbolTable
+from .validation import RecordValidator
+from .streams import is_stream, open_stream, iter_stream_members
+from .cache import ChunkCache
 
 
 class BytesSpec(object):
-    '''A description of the records in raw TAQ files'''
+    '''A description of the records in raw TAQ files
+
+    This class describes quote (BBO) files. Other file types are subclasses,
+    see `bytes_specs` and `detect_file_type()`.
+    '''
+
+    # Our key in bytes_specs
+    file_type = 'BBO'
+    # Parts of (upper-case) file names that identify our file type, e.g.
+    # EQY_US_ALL_BBO_20140206 or taqquote20140206
+    name_markers = ['BBO', 'QUOTE']
+
+    # Layouts (initial_dtype and passthrough_strings) and DigitDecoders that
+    # we've already worked out. These are shared by all of our subclasses,
+    # so keys start with file_type.
+    _layouts = {}
+    _decoders = {}
 
     # List of (Name, # of bytes_spectes)
     # We will use this to contstuct "bytes" (which is what 'S' stands for - it
@@ -79,6 +106,24 @@ class BytesSpec(object):
 
     convert_dict = dict(convert_dtype)
 
+    # Prices are 7.4 fixed point in the file. For integer price_modes we keep
+    # that exact integer, i.e., units of 1 / PRICE_SCALE dollars.
+    price_fields = ['Bid_Price', 'Ask_Price']
+    # Should never go down within a symbol, see validation.RecordValidator
+    sequence_field = 'Sequence_Number'
+    PRICE_SCALE = 10000
+    # int32 covers prices up to $214,748.3647, which is nearly everything, but
+    # it is checked for each chunk in TAQ2Chunks.process_chunk()
+    price_dtypes = {'float': np.float64,
+                    'int': np.int64,
+                    'int32': np.int32,
+                   }
+
+    # Raw fields that are needed to compute each of our computed fields (which
+    # are specified by TAQ2Chunks). These get decoded even if they're not
+    # requested in `columns`
+    computed_dependencies = {'Time': ['hour', 'minute', 'msec']}
+
     # This gets reduced to only present fields in .check_present_fields()
     # These are enumerated explicitly to allow for fields like Time, that may
     # be dynamically computed
@@ -102,12 +147,19 @@ class BytesSpec(object):
                            'National_BBO_LULD_Indicator'
                            ]
 
+    # With categorical=True, single-byte passthrough fields become uint8 codes.
+    # The code is simply the byte value, so the dictionary is the same for
+    # every column and every file, and encoding is a free view. E.g., an
+    # Exchange of b'N' has code ord(b'N') == 78, and CATEGORIES[78] == b'N'.
+    CATEGORIES = np.array([bytes([code]) for code in range(256)], dtype='S1')
+
     @property
     def target_dtype(self):
         '''We're being careful about operations on this value!'''
         return self._target_dtype.copy()
 
-    def __init__(self, bytes_per_line, computed_fields=None):
+    def __init__(self, bytes_per_line, computed_fields=None, columns=None,
+                 exclude=None, price_mode='float', categorical=False):
         '''Set up dtypes, etc. based on bytes_per_line
 
         bytes_per_line : int
@@ -117,10 +169,67 @@ class BytesSpec(object):
             `[('Time', 'datetime64[ms]')]`.  PyTables will not accept
             np.datetime64, we need to pass a float64 in, and let pytables
             convert to time64.
+        columns : sequence of str
+            Names of fields (raw or computed) to keep in `target_dtype`. Other
+            fields are neither decoded nor copied. Default (None) keeps
+            everything.
+        exclude : sequence of str
+            Names of raw fields to drop from `target_dtype`. Unlike
+            `columns`, these are still decoded if a computed field needs
+            them (e.g., hour, minute and msec for an integer Time).
+        price_mode : str
+            'float' (the default) gives float64 dollars for Bid_Price and
+            Ask_Price. 'int' gives the exact int64 fixed-point value from the
+            file (in units of 1 / PRICE_SCALE dollars), and 'int32' the same
+            in an int32.
+        categorical : bool
+            If True, single-byte passthrough fields (Exchange,
+            Quote_Condition, the _Ind and LULD_ fields, etc.) are uint8 codes
+            instead of S1 bytes. See CATEGORIES.
         '''
         self.bytes_per_line = bytes_per_line
         self.check_present_fields()
 
+        if price_mode not in self.price_dtypes:
+            raise ValueError('Unknown price_mode: {}'.format(price_mode))
+        self.price_mode = price_mode
+        if price_mode != 'float':
+            price_dtype = self.price_dtypes[price_mode]
+            self.convert_dtype = [(name, price_dtype)
+                                  if name in self.price_fields
+                                  else (name, dtype)
+                                  for name, dtype in self.convert_dtype]
+            self.convert_dict = dict(self.convert_dtype)
+
+        if computed_fields is None:
+            computed_fields = []
+
+        if columns is not None:
+            self.project_columns(columns, computed_fields)
+            computed_fields = [(name, dtype)
+                               for name, dtype in computed_fields
+                               if name in columns]
+
+        if exclude:
+            self.convert_dtype = [(name, dtype)
+                                  for name, dtype in self.convert_dtype
+                                  if name not in exclude]
+            self.convert_dict = dict(self.convert_dtype)
+            self.passthrough_strings = [name
+                                        for name in self.passthrough_strings
+                                        if name not in exclude]
+
+        initial_dict = dict(self.initial_dtype)
+        if categorical:
+            self.categorical_fields = [
+                name for name in self.passthrough_strings
+                if np.dtype(initial_dict[name]).itemsize == 1]
+            self.passthrough_strings = [
+                name for name in self.passthrough_strings
+                if name not in self.categorical_fields]
+        else:
+            self.categorical_fields = []
+
         # The "easy" dtypes are the "not datetime" dtypes
         easy_dtype = []
 
@@ -129,17 +238,189 @@ class BytesSpec(object):
                 easy_dtype.append( (name, self.convert_dict[name]) )
             elif name in self.passthrough_strings:
                 easy_dtype.append( (name, dtype) )
+            elif name in self.categorical_fields:
+                easy_dtype.append( (name, np.uint8) )
             # Items not in these strings are silently ignored! We could add
             # logic to allow for explicitly ignoring fields here.
 
-        if computed_fields:
-            self._target_dtype = computed_fields + easy_dtype
-        else:
-            self._target_dtype = easy_dtype
+        self._target_dtype = computed_fields + easy_dtype
+
+        # We decode everything that's converted, plus whatever we need for
+        # computed fields, in file order
+        to_decode = set(self.convert_dict)
+        for name, _ in computed_fields:
+            to_decode.update(self.computed_dependencies.get(name, []))
+        self.decoded_fields = [name for name, _ in self.initial_dtype
+                               if name in to_decode]
+
+        # The loading plan for our numeric fields only depends on the layout
+        # and the fields we decode, so we only set it up once per process
+        decoder_key = (self.file_type, bytes_per_line,
+                       tuple(self.decoded_fields))
+        self.decoder = self._decoders.get(decoder_key)
+        if self.decoder is None:
+            self.decoder = self._decoders[decoder_key] = \
+                DigitDecoder(self.initial_dtype, self.decoded_fields)
+
+    def project_columns(self, columns, computed_fields):
+        '''Restrict converted and passthrough fields to `columns`
+
+        This sets instance versions of convert_dtype, convert_dict and
+        passthrough_strings, leaving the class defaults alone.
+        '''
+        present = [name for name, _ in self.initial_dtype]
+        known = [name for name, _ in computed_fields] + \
+            [name for name in present if name in self.convert_dict] + \
+            self.passthrough_strings
+        unknown = [name for name in columns if name not in known]
+        if unknown:
+            raise ValueError('Unknown columns: {}'.format(unknown))
+
+        self.convert_dtype = [(name, dtype)
+                              for name, dtype in self.convert_dtype
+                              if name in columns]
+        self.convert_dict = dict(self.convert_dtype)
+        self.passthrough_strings = [name for name in self.passthrough_strings
+                                    if name in columns]
+
+    def categories(self):
+        '''Return {name: categories} for each of our categorical fields
+
+        Codes index into the categories, so e.g.
+        `pandas.Categorical.from_codes(chunk[name], categories[name])` needs
+        no Python-level work.
+        '''
+        return {name: self.CATEGORIES for name in self.categorical_fields}
+
+    def pad(self, field_name, value):
+        '''Pad str or bytes `value` with spaces to the width of a raw field'''
+        width = np.dtype(self.initial_dtype).fields[field_name][0].itemsize
+        if isinstance(value, str):
+            value = value.encode('ascii')
+        if len(value) > width:
+            raise ValueError('{!r} is longer than {} bytes'.format(value,
+                                                                  width))
+        return value.ljust(width)
+
+    def digit_fields(self):
+        '''Names of all numeric fields in our layout, in file order
+
+        Unlike convert_dtype, this isn't affected by `columns`, etc.
+        '''
+        numeric = type(self).convert_dict
+        return [name for name, _ in self.initial_dtype if name in numeric]
+
+    def encode(self, chunk, out=None, msec_of_day=None):
+        '''Write raw records (with our initial_dtype) from a processed chunk
+
+        This is the reverse of TAQ2Chunks.process_chunk(), and works on whole
+        columns at a time (see DigitDecoder.encode()), so it's fast enough to
+        write large synthetic files. Raw fields that are missing from `chunk`
+        are zeros (numeric) or spaces, so `chunk` can have any subset of
+        fields. Prices may be float dollars or integers (see price_mode), and
+        single-byte fields may be bytes or categorical codes.
+
+        chunk : np.ndarray
+            Structured array with fields named as in initial_dtype
+        out : np.ndarray
+            Contiguous array of raw records to write into. Default is a new
+            array.
+        msec_of_day : array of int
+            Milliseconds since midnight, used for hour, minute and msec if
+            they aren't in `chunk` (see TAQ2Chunks.encode_chunk())
+
+        Returns `out`, which can be written straight to a file (e.g., with
+        write_taq()).
+        '''
+        numrows = len(chunk)
+        if out is None:
+            out = np.empty(numrows, dtype=self.initial_dtype)
+        elif len(out) != numrows or not out.flags.c_contiguous:
+            raise ValueError('out must be contiguous, with one row per row '
+                             'of chunk')
+
+        out[...] = self.blank_record()
+
+        digit_fields = self.digit_fields()
+        names = chunk.dtype.names
+        values = {}
+        for name, _ in self.initial_dtype:
+            if name not in names:
+                continue
+            if name in digit_fields:
+                column = chunk[name]
+                if name in self.price_fields and column.dtype.kind == 'f':
+                    column = np.rint(column * self.PRICE_SCALE).astype(
+                        np.int64)
+                values[name] = column
+            elif chunk.dtype[name] == np.uint8:
+                # A categorical code is the byte
+                out[name] = chunk[name].view('S1')
+            elif name != 'newline':
+                out[name] = chunk[name]
+
+        if msec_of_day is not None and 'hour' not in values:
+            hour, msec = np.divmod(msec_of_day, 3600000)
+            minute, msec = np.divmod(msec, 60000)
+            values.update(hour=hour, minute=minute, msec=msec)
+
+        decoder_key = (self.file_type, self.bytes_per_line,
+                       tuple(digit_fields))
+        encoder = self._decoders.get(decoder_key)
+        if encoder is None:
+            encoder = self._decoders[decoder_key] = \
+                DigitDecoder(self.initial_dtype, digit_fields)
+        encoder.encode(values, out)
+
+        return out
+
+    def blank_record(self):
+        '''A raw record of all zeros (numeric) and spaces, ending in CRLF'''
+        digit_fields = self.digit_fields()
+        blank = np.zeros((), dtype=self.initial_dtype)
+        for name, dtype in self.initial_dtype:
+            width = np.dtype(dtype).itemsize
+            if name == 'newline':
+                blank[name] = b'\r\n'
+            elif name in digit_fields:
+                blank[name] = b'0' * width
+            else:
+                blank[name] = b' ' * width
+        return blank
+
+    @classmethod
+    def fits(cls, bytes_per_line):
+        '''Is `bytes_per_line` a valid record length for our file type?'''
+        try:
+            cls.layout(bytes_per_line)
+        except ValueError:
+            return False
+        return True
+
+    @classmethod
+    def layout(cls, bytes_per_line):
+        '''Return (initial_dtype, passthrough_strings) for `bytes_per_line`
+
+        These are worked out once (per process) for each file type and record
+        length, see `check_present_fields()`. Raises ValueError if our fields
+        don't fit `bytes_per_line`.
+        '''
+        key = (cls.file_type, bytes_per_line)
+        if key not in cls._layouts:
+            cls._layouts[key] = cls._build_layout(bytes_per_line)
+        return cls._layouts[key]
 
     def check_present_fields(self):
+        '''Set initial_dtype and passthrough_strings from our layout'''
+        initial_dtype, passthrough_strings = self.layout(self.bytes_per_line)
+        # Copies, so our (cached) layout can't be modified by accident
+        self.initial_dtype = list(initial_dtype)
+        self.passthrough_strings = list(passthrough_strings)
+
+    @classmethod
+    def _build_layout(cls, bytes_per_line):
         """
-        self.initial_dtype_info should be of form, we encode newline info here!
+        cls.initial_dtype_info should be of form, we encode newline info here!
 
         [('Time', 9),
          ('Exchange', 1),
@@ -147,27 +428,198 @@ class BytesSpec(object):
         ]
 
         Assumption is that the last field is a newline field that is present in
-        all versions of BBO
+        all versions of a file type. Older versions of a file type may stop
+        before the end of initial_dtype_info.
         """
         cum_len = 0
-        self.initial_dtype = []
+        initial_dtype = []
         present_passthrough = []
 
         # Newlines consume 2 bytes
-        target_len = self.bytes_per_line - 2
+        target_len = bytes_per_line - 2
 
-        for field_name, field_len in self.initial_dtype_info:
+        for field_name, field_len in cls.initial_dtype_info:
             # Better to do nested unpacking within the function
             cum_len += field_len
-            self.initial_dtype.append( (field_name, 'S{}'.format(field_len)) )
-            if field_name in self.passthrough_strings:
+            initial_dtype.append( (field_name, 'S{}'.format(field_len)) )
+            if field_name in cls.passthrough_strings:
                 present_passthrough.append(field_name)
             if cum_len == target_len:
-                self.initial_dtype.append(('newline', 'S2'))
-                self.passthrough_strings = present_passthrough
-                return
+                initial_dtype.append(('newline', 'S2'))
+                return initial_dtype, present_passthrough
+
+        raise ValueError("Can't map {} fields onto bytes_per_line of "
+                         "{}".format(cls.file_type, bytes_per_line))
+
+
+class TradeBytesSpec(BytesSpec):
+    '''A description of the records in raw TAQ trade files
+
+    This layout follows the Daily TAQ client specification. Unlike BBO, we
+    haven't checked it against real files.
+    '''
+
+    file_type = 'TRADE'
+    name_markers = ['TRADE']
+
+    initial_dtype_info = [
+                          ('hour', 2),
+                          ('minute', 2),
+                          ('msec', 5),
+                          ('Exchange', 1),
+                          ('Symbol_root', 6),
+                          ('Symbol_suffix', 10),
+                          ('Sale_Condition', 4),
+                          ('Trade_Volume', 9),
+                          ('Trade_Price', 11),  # 7.4 (fixed point)
+                          ('Trade_Stop_Stock_Indicator', 1),
+                          ('Trade_Correction_Indicator', 2),
+                          ('Trade_Sequence_Number', 16),
+                          ('Source_of_Trade', 1),
+                          ('Trade_Reporting_Facility', 1),
+                         ]
+
+    convert_dtype = [
+                     ('hour', np.int8),
+                     ('minute', np.int8),
+                     ('msec', np.uint16),
+                     ('Trade_Volume', np.int32),
+                     ('Trade_Price', np.float64),
+                     ('Trade_Sequence_Number', np.int64),
+                    ]
+
+    convert_dict = dict(convert_dtype)
+
+    price_fields = ['Trade_Price']
+    sequence_field = 'Trade_Sequence_Number'
+
+    passthrough_strings = ['Exchange',
+                           'Symbol_root',
+                           'Symbol_suffix',
+                           'Sale_Condition',
+                           'Trade_Stop_Stock_Indicator',
+                           # This is a 2-digit code, but it's categorical
+                           'Trade_Correction_Indicator',
+                           'Source_of_Trade',
+                           'Trade_Reporting_Facility',
+                           ]
+
 
-        raise BaseException("Can't map fields onto bytes_per_line")
+class NBBOBytesSpec(BytesSpec):
+    '''A description of the records in raw TAQ NBBO files
+
+    These start out like BBO records, followed by the best bid and offer. This
+    layout follows the Daily TAQ client specification. Unlike BBO, we haven't
+    checked it against real files.
+    '''
+
+    file_type = 'NBBO'
+    name_markers = ['NBBO']
+
+    initial_dtype_info = [
+                          ('hour', 2),
+                          ('minute', 2),
+                          ('msec', 5),
+                          ('Exchange', 1),
+                          ('Symbol_root', 6),
+                          ('Symbol_suffix', 10),
+                          ('Bid_Price', 11),  # 7.4 (fixed point)
+                          ('Bid_Size', 7),
+                          ('Ask_Price', 11),  # 7.4
+                          ('Ask_Size', 7),
+                          ('Quote_Condition', 1),
+                          ('Market_Maker', 4),
+                          ('Bid_Exchange', 1),
+                          ('Ask_Exchange', 1),
+                          ('Sequence_Number', 16),
+                          ('National_BBO_Ind', 1),
+                          ('NASDAQ_BBO_Ind', 1),
+                          ('Quote_Cancel_Correction', 1),
+                          ('Source_of_Quote', 1),
+                          ('Best_Bid_Quote_Condition', 1),
+                          ('Best_Bid_Exchange', 1),
+                          ('Best_Bid_Price', 11),  # 7.4
+                          ('Best_Bid_Size', 7),
+                          ('Best_Bid_FINRA_Market_Maker_ID', 4),
+                          ('Best_Offer_Quote_Condition', 1),
+                          ('Best_Offer_Exchange', 1),
+                          ('Best_Offer_Price', 11),  # 7.4
+                          ('Best_Offer_Size', 7),
+                          ('Best_Offer_FINRA_Market_Maker_ID', 4),
+                          ('LULD_Indicator', 1),
+                          ('LULD_NBBO_Indicator', 1),
+                          ('SIP_generated_Message_Identifier', 1),
+                         ]
+
+    convert_dtype = BytesSpec.convert_dtype + [
+                     ('Best_Bid_Price', np.float64),
+                     ('Best_Bid_Size', np.int32),
+                     ('Best_Offer_Price', np.float64),
+                     ('Best_Offer_Size', np.int32),
+                    ]
+
+    convert_dict = dict(convert_dtype)
+
+    price_fields = ['Bid_Price', 'Ask_Price',
+                    'Best_Bid_Price', 'Best_Offer_Price']
+
+    passthrough_strings = ['Exchange',
+                           'Symbol_root',
+                           'Symbol_suffix',
+                           'Quote_Condition',
+                           'Market_Maker',
+                           'Bid_Exchange',
+                           'Ask_Exchange',
+                           'National_BBO_Ind',
+                           'NASDAQ_BBO_Ind',
+                           'Quote_Cancel_Correction',
+                           'Source_of_Quote',
+                           'Best_Bid_Quote_Condition',
+                           'Best_Bid_Exchange',
+                           'Best_Bid_FINRA_Market_Maker_ID',
+                           'Best_Offer_Quote_Condition',
+                           'Best_Offer_Exchange',
+                           'Best_Offer_FINRA_Market_Maker_ID',
+                           'LULD_Indicator',
+                           'LULD_NBBO_Indicator',
+                           'SIP_generated_Message_Identifier',
+                           ]
+
+
+# All of the layouts we know about, by file type. BBO comes first, as it's
+# our default when we can't otherwise tell (see detect_file_type())
+bytes_specs = {spec.file_type: spec
+               for spec in [BytesSpec, NBBOBytesSpec, TradeBytesSpec]}
+
+
+def detect_file_type(first_line, member_name=None):
+    '''Return the key in `bytes_specs` for a raw TAQ file
+
+    first_line : bytes
+        The header line of the file. This is the same length as a record, but
+        otherwise doesn't tell us the file type.
+    member_name : str
+        The name of the file (e.g., EQY_US_ALL_TRADE_20140206), which is
+        checked first for name_markers. If that doesn't work, we go by the
+        record length.
+    '''
+    if member_name:
+        upper_name = path.basename(member_name).upper()
+        # NBBO also contains BBO, so the longest match wins
+        matches = [(len(marker), file_type)
+                   for file_type, spec in bytes_specs.items()
+                   for marker in spec.name_markers
+                   if marker in upper_name]
+        if matches:
+            return max(matches)[1]
+
+    bytes_per_line = len(first_line)
+    for file_type, spec in bytes_specs.items():
+        if spec.fits(bytes_per_line):
+            return file_type
+
+    raise ValueError("Can't map fields onto bytes_per_line of "
+                     "{}".format(bytes_per_line))
 
 
 class TAQ2Chunks:
@@ -180,26 +632,213 @@ class TAQ2Chunks:
     day = None
     # This isn't available in our chunks, so we'll expose it here
     first_line = None
+    # Set when iterating with prefetch
+    prefetcher = None
+    # For uncompressed files, a memory-mapped array of all raw records
+    records = None
+    # Set with symbol_ids
+    symbol_table = None
+    # Set with validate
+    validator = None
+    # Set by decode_ahead()
+    background = None
+    # The CachedChunks we're reading from, with cache
+    cached = None
 
     # This is a totally random guess. It should probably be tuned if we care...
+    # (see memory_budget and calibrate())
     DEFAULT_CHUNKSIZE = 1000000
 
-    def __init__(self, taq_fname, chunksize=None, do_process_chunk=True):
+    # With recycle, we fill read buffers in pieces of this size. The zipfile
+    # module allocates a new bytes object for every read, and this keeps those
+    # small enough to be re-used from the heap.
+    RECYCLE_READ_SIZE = 2 ** 20
+
+    # Per-row allowance for temporary arrays in process_chunk (e.g., computing
+    # Time), beyond our decoded buffers and the chunk itself
+    TEMPORARY_BYTES_PER_ROW = 16
+
+    # How we decompress zip files, see `__init__()`
+    zip_backends = ['zipfile', 'raw']
+
+    # dtype of the computed Time column for each time_mode
+    time_dtypes = {'float': np.float64,
+                   'ns': np.int64,
+                   'ms': np.int64,
+                  }
+
+    def __init__(self, taq_fname, chunksize=None, do_process_chunk=True,
+                 columns=None, symbols=None, index=None, start_row=None,
+                 start_symbol=None, prefetch=None, time_mode='float',
+                 price_mode='float', categorical=False, symbol_ids=None,
+                 memory_budget=None, recycle=None, file_type=None,
+                 validate=False, member=None, cache=None,
+                 zip_backend='zipfile', check_crc=True):
         '''Configure conversion process and (for now) set up the iterator
-        taq_fname : str
-            Name of input file
+        taq_fname : str or file object
+            Name of input file. Either a zip archive, or an uncompressed TAQ
+            file, which will be memory-mapped. Or a binary stream (anything
+            with a read() method, or '-' for stdin) of either, which is read
+            as it comes, without seeking (see marketflow.streams). A stream
+            can't use an `index`, and `start_row` is reached by reading.
         chunksize : int
             Number of rows in each chunk. If None, the HDF5 logic will set it
             based on the chunkshape determined by pytables. Otherwise,
             `chunks()` will set this to DEFAULT_CHUNKSIZE.
         do_process_chunk : bool
             Do type conversions?
+        columns : sequence of str
+            Only decode and keep these fields (e.g., ['Time', 'Symbol_root',
+            'Bid_Price']) in processed chunks. Raw chunks (from
+            do_process_chunk=False) always have all fields. Default (None)
+            keeps everything.
+        symbols : sequence of str or (str, str)
+            Only return rows for these symbols. A str matches a Symbol_root
+            with any suffix, a (root, suffix) tuple matches exactly. Matching
+            is done on raw chunks, so only matching rows are decoded. This
+            relies on raw TAQ files being sorted by symbol - we find rows by
+            binary search, and stop reading once we've passed the last
+            requested symbol. Chunks will generally be smaller than
+            `chunksize`, and chunks without matches are skipped. With an
+            `index`, we also skip straight to the first requested symbol.
+        index : str, SeekIndex or True
+            A seek index for a zipped file (see marketflow.zran), or its
+            filename. True uses the default sidecar name from
+            `zran.index_name()`. Lets us start at `start_row` or
+            `start_symbol` without decompressing everything before it.
+            Uncompressed files don't need (and ignore) an index.
+        start_row : int
+            First record to read (0 is the first record after the header)
+        start_symbol : str
+            Start at the first record with this Symbol_root
+        prefetch : int
+            If set, read (and decompress) up to this many chunks ahead in a
+            background thread. Stall counters are then available from
+            `self.prefetcher` (see utility.Prefetcher). Ignored for
+            uncompressed files.
+        time_mode : str
+            How to represent Time in processed chunks. 'float' (the default)
+            is float64 seconds since the epoch, alongside hour, minute and
+            msec columns (this is what PyTables wants for time64). 'ns' is
+            int64 nanoseconds since the epoch, and 'ms' is int64 milliseconds
+            since midnight (Eastern), both without hour, minute and msec.
+            See `to_datetime64()`.
+        price_mode : str
+            How to represent Bid_Price and Ask_Price in processed chunks (see
+            BytesSpec). 'int' and 'int32' keep exact integers, so spreads,
+            etc. can be computed in integer arithmetic. 'int32' raises a
+            ValueError for a chunk with a price that doesn't fit. See
+            `to_dollars()`.
+        categorical : bool
+            If True, single-byte indicator fields are uint8 codes in processed
+            chunks, so filtering is an integer comparison (e.g.,
+            `chunk['Exchange'] == ord('N')`). See BytesSpec.CATEGORIES.
+        symbol_ids : True or SymbolTable
+            Add an int32 Symbol_ID column to processed chunks. True starts a
+            new SymbolTable for this file, or pass a SymbolTable to add to
+            (e.g., one loaded from a previous day, for IDs that are
+            consistent across files). Either way, it's available as
+            `self.symbol_table`.
+        memory_budget : int or str
+            Pick chunksize so that the chunks we have alive at once (raw,
+            prefetched, decoded and processed, see `row_footprint()`) fit in
+            this many bytes. A str like '512MB' is parsed by
+            utility.parse_size(). This doesn't account for copies made by
+            whoever consumes our chunks, so leave some headroom. Can't be
+            combined with `chunksize`. See also `calibrate()`.
+        recycle : int
+            Re-use a ring of this many preallocated chunks (and read buffers,
+            which are filled with `readinto()`), rather than allocating new
+            arrays for each chunk. This keeps memory use flat over long runs,
+            but **a chunk is overwritten once `recycle` more chunks have been
+            produced**, so copy anything you want to keep longer than that.
+        file_type : str
+            A key of `bytes_specs` (e.g., 'BBO', 'NBBO' or 'TRADE'). Default
+            is to use `detect_file_type()` on the header and file name. The
+            result is in `self.file_type`.
+        validate : bool or 'raise'
+            Check raw records as we read them: newlines, that numeric fields
+            are digits (and in range, for times), that sequence numbers don't
+            go down within a symbol, and (once we reach the end) the row count
+            in the header. Results are in `self.validator` (see
+            validation.RecordValidator). With 'raise', we raise a ValueError
+            as soon as a chunk has a problem.
+        member : str or int
+            The name or (0-based) position of the TAQ file to read in a zip
+            archive with several (e.g., several days). This is required for
+            such archives, except for streams, where the default is the first
+            member. See also `each_member()`.
+        cache : str or ChunkCache
+            A directory (or marketflow.cache.ChunkCache) for caching our
+            chunks on disk. A full pass over the file stores them, and later
+            passes with the same options read them from a memory map instead
+            (`self.cached` is then set). Chunks from the cache are read-only.
+            This is ignored for streams, symbol_ids and validate, which need
+            the original data.
+        zip_backend : str
+            'zipfile' (the default) reads zip members with the zipfile module.
+            'raw' finds the member's compressed data itself, and has zlib
+            inflate large blocks straight into our read buffers (see
+            zran.MemberReader), which is faster and doesn't copy. Members
+            that aren't deflated always use 'zipfile'.
+        check_crc : bool
+            With zip_backend='raw', whether to check the CRC-32 of the member
+            (which costs roughly 10%). The zipfile module always checks.
         chunk_type : read in by chunksize "lines" or by unbroken run of
             stock "symbols"
         '''
         self.taq_fname = taq_fname
+        self.stream = is_stream(taq_fname)
+        if self.stream and index is not None:
+            raise ValueError("Can't use an index with a stream")
+        self.member = member
+        if isinstance(cache, str):
+            cache = ChunkCache(cache)
+        self.cache = cache
+        if zip_backend not in self.zip_backends:
+            raise ValueError('Unknown zip_backend: {}'.format(zip_backend))
+        self.zip_backend = zip_backend
+        self.check_crc = check_crc
         self.chunksize = chunksize
         self.do_process_chunk = do_process_chunk
+        self.columns = columns
+        self.symbols = symbols
+        self.index = index
+        self.start_row = start_row
+        self.start_symbol = start_symbol
+        self.prefetch = prefetch
+        if memory_budget is not None:
+            if chunksize is not None:
+                raise ValueError("Can't use both chunksize and memory_budget")
+            memory_budget = parse_size(memory_budget)
+        self.memory_budget = memory_budget
+        if recycle is not None and recycle < 1:
+            raise ValueError('recycle must be at least 1')
+        self.recycle = recycle
+        if file_type is not None and file_type not in bytes_specs:
+            raise ValueError('Unknown file_type: {}'.format(file_type))
+        self.file_type = file_type
+        if validate not in [False, True, 'raise']:
+            raise ValueError('Unknown validate: {}'.format(validate))
+        self.validate = validate
+        if time_mode not in self.time_dtypes:
+            raise ValueError('Unknown time_mode: {}'.format(time_mode))
+        self.time_mode = time_mode
+        if price_mode not in BytesSpec.price_dtypes:
+            raise ValueError('Unknown price_mode: {}'.format(price_mode))
+        self.price_mode = price_mode
+        self.categorical = categorical
+        if symbol_ids is True:
+            self.symbol_table = SymbolTable()
+        elif symbol_ids is not None:
+            self.symbol_table = symbol_ids
+        # int64 buffers for process_chunk
+        self._decoded = {}
+        # Other scratch space for process_chunk, see scratch()
+        self._scratch = {}
+        # Our ring of processed chunks for recycle
+        self._outputs = []
+        self._next_output = 0
 
         self._iterator = self._convert_taq()
         # Get first line read / set up remaining attributes
@@ -216,67 +855,590 @@ class TAQ2Chunks:
     def __next__(self):
         return next(self._iterator)
 
+    def close(self):
+        '''Stop iterating early, closing files (and background threads)'''
+        self._iterator.close()
+        if self.background is not None:
+            self.background.stop()
+            self._decoding.close()
+
+    def decode_ahead(self, depth=2):
+        '''Start reading and processing chunks in a background thread
+
+        Up to `depth` chunks are queued until we're iterated over. numpy and
+        zlib release the GIL for most of their work, so several files (e.g.,
+        from `each_member()`) can be decoded at once. The thread is available
+        as `self.background` (a utility.Prefetcher). This can't be combined
+        with `recycle`, as queued chunks would be overwritten.
+        '''
+        if self.recycle:
+            raise ValueError("Can't decode ahead with recycle")
+        if self.background is not None:
+            return
+        self._decoding = self._iterator
+
+        def read():
+            # Chunks don't have a truth value, so we wrap them in a tuple
+            chunk = next(self._decoding, None)
+            return () if chunk is None else (chunk,)
+
+        self.background = Prefetcher(read, depth)
+        self.background.start()
+        self._iterator = (chunk for chunk, in self.background)
+
+    @classmethod
+    def each_member(cls, taq_fname, jobs=None, **taq_args):
+        '''Yield a TAQ2Chunks for each TAQ file in a zip archive, in order
+
+        taq_fname : str or file object
+            As for `__init__()`. Anything other than a zip archive gives a
+            single TAQ2Chunks.
+        jobs : int
+            Keep this many members decoding at once, in background threads
+            (see `decode_ahead()`). Members of a stream can only be read one
+            after another, so this only works for file names.
+        taq_args
+            Passed on to TAQ2Chunks (e.g., columns, time_mode)
+
+        Each TAQ2Chunks is closed when the next one is requested, so use the
+        chunks from one before moving on.
+        '''
+        if jobs is not None and jobs > 1:
+            if is_stream(taq_fname):
+                raise ValueError("Can't decode members of a stream in "
+                                 "parallel")
+            yield from cls._each_member_ahead(taq_fname, jobs, **taq_args)
+            return
+
+        if is_stream(taq_fname):
+            for member in iter_stream_members(taq_fname):
+                taq_in = cls(member, **taq_args)
+                try:
+                    yield taq_in
+                finally:
+                    taq_in.close()
+            return
+
+        for name in cls.member_names(taq_fname):
+            taq_in = cls(taq_fname, member=name, **taq_args)
+            try:
+                yield taq_in
+            finally:
+                taq_in.close()
+
+    @classmethod
+    def _each_member_ahead(cls, taq_fname, jobs, **taq_args):
+        '''each_member(), with `jobs` members decoding at once'''
+        names = iter(cls.member_names(taq_fname))
+        started = deque()
+
+        def start_next():
+            name = next(names, None)
+            if name is not None:
+                taq_in = cls(taq_fname, member=name, **taq_args)
+                taq_in.decode_ahead()
+                started.append(taq_in)
+
+        try:
+            for _ in range(jobs):
+                start_next()
+            while started:
+                taq_in = started.popleft()
+                yield taq_in
+                taq_in.close()
+                start_next()
+        finally:
+            for taq_in in started:
+                taq_in.close()
+
+    @staticmethod
+    def member_names(taq_fname):
+        '''Names of the TAQ files in zip archive `taq_fname`, in order
+
+        An uncompressed file gives [None], which (as `member`) just reads it.
+        '''
+        if not is_zipfile(taq_fname):
+            return [None]
+        with ZipFile(taq_fname) as zfile:
+            return [zinfo.filename for zinfo in zfile.infolist()
+                    if not zinfo.is_dir()]
+
+    def select_member(self, zfile):
+        '''Return the ZipInfo of the member we're reading from `zfile`'''
+        infos = [zinfo for zinfo in zfile.infolist() if not zinfo.is_dir()]
+        if self.member is None:
+            if len(infos) != 1:
+                raise ValueError(
+                    '{} has {} members, pick one with member (or use '
+                    'TAQ2Chunks.each_member())'.format(self.taq_fname,
+                                                       len(infos)))
+            return infos[0]
+
+        if isinstance(self.member, int):
+            return infos[self.member]
+        for zinfo in infos:
+            if zinfo.filename == self.member:
+                return zinfo
+        raise ValueError('No member {!r} in {}'.format(self.member,
+                                                       self.taq_fname))
+
     def _convert_taq(self):
         '''Return a generator that yields chunks, based on config in object
 
         This is meant to be called from within `__init__()`, and stored in
         `self._iterator`
         '''
+        source = self._convert_source()
+        if not self.cacheable():
+            yield from source
+            return
+
+        key = self.cache.key(self.taq_fname, self.cache_options())
+        self.cached = self.cache.load(key)
+        if self.cached is not None:
+            self.first_line = self.cached.first_line
+            self.infile_name = self.cached.infile_name
+            self.parse_first_line()
+            yield
+            yield from self.cached
+            return
+
+        # Parse the header, then store chunks as they go by
+        next(source)
+        yield
+        if self.do_process_chunk:
+            dtype = self.bytes_spec.target_dtype
+        else:
+            dtype = self.bytes_spec.initial_dtype
+        yield from self.cache.store(key, source, dtype, self.first_line,
+                                    self.infile_name)
+
+    def cacheable(self):
+        '''Can our chunks go in (or come from) self.cache?'''
+        return (self.cache is not None and not self.stream and
+                self.symbol_table is None and not self.validate)
+
+    def cache_options(self):
+        '''Everything (besides the input file) that affects our chunks'''
+        return dict(member=self.member, file_type=self.file_type,
+                    chunksize=self.chunksize,
+                    memory_budget=self.memory_budget,
+                    do_process_chunk=self.do_process_chunk,
+                    columns=self.columns, symbols=self.symbols,
+                    start_row=self.start_row, start_symbol=self.start_symbol,
+                    time_mode=self.time_mode, price_mode=self.price_mode,
+                    categorical=self.categorical)
+
+    def _convert_source(self):
+        '''_convert_taq(), reading from the original file'''
         # The below doesn't work for pandas (and neither does `unzip` from the
         # command line). Probably want to use something like `7z x -so
         # my_file.zip 2> /dev/null` if we use pandas.
 
+        if self.stream:
+            yield from self._convert_stream()
+            return
+
+        if not is_zipfile(self.taq_fname):
+            yield from self._convert_uncompressed()
+            return
+
         with ZipFile(self.taq_fname) as zfile:
-            # We unpack a single-item sequence with the comma
-            # XXX Should maybe add better exception handling here
-            self.infile_name, = zfile.namelist()
+            zinfo = self.select_member(zfile)
+            self.infile_name = zinfo.filename
 
-            with zfile.open(self.infile_name) as infile:
+            with zfile.open(zinfo) as infile:
                 # this is part of the public interface
                 self.first_line = infile.readline()
-                bytes_per_line = len(self.first_line)
+                self.parse_first_line()
+                bytes_per_line = self.bytes_spec.bytes_per_line
 
-                if self.do_process_chunk:
-                    self.bytes_spec = \
-                        BytesSpec(bytes_per_line,
-                                  computed_fields=[('Time', np.float64)])
-                else:
-                    self.bytes_spec = BytesSpec(bytes_per_line)
-
-                # You need to use bytes to split bytes
-                # some files (probably older files do not have a record count)
-                try:
-                    dateish, numlines = self.first_line.split(b":")
-                    self.numlines = int(numlines)
-                except ValueError:
-                    dateish = self.first_line
-
-                # Get dates to combine with times later
-                # This is a little over-trusting of the spec...
-                self.month = int(dateish[2:4])
-                self.day = int(dateish[4:6])
-                self.year = int(dateish[6:10])
-
-                # Nice idea from @rdhyee, we only need to compute the
-                # 0-second for the day once per file.self
-                naive_dt = datetime(self.year, self.month, self.day)
-
-                # It turns out you can't pass tzinfo directly, See
-                # http://pythonhosted.org/pytz/
-                # This lets us compute a UTC timestamp
-                self.midnight_ts = timezone('US/Eastern').\
-                                     localize(naive_dt).\
-                                     timestamp()
+                self.load_index(zinfo)
 
                 # This lets us parse the first line to initialize our
                 # various attributes
                 yield
 
-                if self.do_process_chunk:
-                    for chunk in self.chunks(self.numlines, infile):
-                        yield self.process_chunk(chunk)
+                start_row = self.find_start_row()
+                start_offset = bytes_per_line * (start_row + 1)
+
+                if start_row and self.index is not None:
+                    data_start, _ = member_data_range(zfile, zinfo)
+                    with open(self.taq_fname, 'rb') as raw_fp:
+                        reader = self.index.open_at(raw_fp, data_start,
+                                                    start_offset)
+                        try:
+                            yield from self._from_raw(
+                                self.chunks(self.numlines, reader, start_row))
+                        finally:
+                            reader.close()
+                elif self.zip_backend == 'raw' and \
+                        zinfo.compress_type == ZIP_DEFLATED:
+                    with open(self.taq_fname, 'rb') as raw_fp:
+                        reader = MemberReader(raw_fp, zfile, zinfo,
+                                              self.check_crc)
+                        try:
+                            # Including the header line, and everything
+                            # before start_row
+                            reader.skip(start_offset)
+                            yield from self._from_raw(
+                                self.chunks(self.numlines, reader, start_row))
+                        finally:
+                            reader.close()
                 else:
-                    yield from self.chunks(self.numlines, infile)
+                    if start_row:
+                        # Without an index, this decompresses everything
+                        # before start_row
+                        infile.seek(start_offset)
+                    yield from self._from_raw(self.chunks(self.numlines,
+                                                          infile, start_row))
+
+    def _convert_stream(self):
+        '''Like _convert_taq(), but reading a stream as it comes
+
+        Without seeking, we can't use an index, so a start_row is reached by
+        reading (and decompressing) everything before it.
+        '''
+        infile = open_stream(self.taq_fname, self.member)
+        self.infile_name = infile.name
+        self.first_line = infile.readline()
+        self.parse_first_line()
+
+        yield
+
+        start_row = self.find_start_row()
+        if start_row:
+            infile.skip(self.bytes_spec.bytes_per_line * start_row)
+        yield from self._from_raw(self.chunks(self.numlines, infile,
+                                              start_row))
+
+    def _convert_uncompressed(self):
+        '''Like _convert_taq(), but for an uncompressed file
+
+        We memory-map the file, and chunks are read-only views, so there's no
+        copying (or even reading) until chunks are used. Picking a start row
+        is O(1), and a start symbol is a binary search.
+        '''
+        with open(self.taq_fname, 'rb') as infile:
+            self.first_line = infile.readline()
+        self.infile_name = path.basename(self.taq_fname)
+        self.parse_first_line()
+        bytes_per_line = self.bytes_spec.bytes_per_line
+
+        # Any partial line at the end is ignored, like in chunks()
+        numrows, partial_bytes = divmod(
+            path.getsize(self.taq_fname) - bytes_per_line, bytes_per_line)
+        if numrows > 0:
+            self.records = np.memmap(self.taq_fname, mode='r',
+                                     dtype=self.bytes_spec.initial_dtype,
+                                     offset=bytes_per_line, shape=(numrows,))
+        else:
+            # mmap doesn't like empty maps
+            self.records = np.empty(0, dtype=self.bytes_spec.initial_dtype)
+
+        yield
+
+        # We don't need an index to find symbols
+        if self.start_row is not None:
+            start_row = self.start_row
+        elif self.start_symbol is not None:
+            start_row = np.searchsorted(
+                self.records['Symbol_root'],
+                self.bytes_spec.pad('Symbol_root', self.start_symbol))
+        elif self.symbols:
+            self.set_symbol_filter(self.symbols)
+            start_row = np.searchsorted(self.records['Symbol_root'],
+                                        self._filter_roots[0])
+        else:
+            start_row = 0
+
+        yield from self._from_raw(self.memmap_chunks(start_row,
+                                                     max(partial_bytes, 0)))
+
+    def memmap_chunks(self, start_row=0, partial_bytes=0):
+        '''Yield views of self.records, starting at `start_row`
+
+        partial_bytes is only used for validation.
+        '''
+        if self.chunksize is None:
+            self.chunksize = self.DEFAULT_CHUNKSIZE
+
+        for start in range(start_row, len(self.records), self.chunksize):
+            chunk = self.records[start:start + self.chunksize]
+            if self.validator is not None:
+                self.validator.check(chunk, start)
+            yield chunk
+
+        if self.validator is not None:
+            self.validator.finish(partial_bytes, start_row)
+
+    def parse_first_line(self):
+        '''Set up bytes_spec and date info from self.first_line'''
+        bytes_per_line = len(self.first_line)
+        if self.file_type is None:
+            self.file_type = detect_file_type(self.first_line,
+                                              self.infile_name)
+        spec_class = bytes_specs[self.file_type]
+
+        if self.do_process_chunk:
+            if self.time_mode == 'float':
+                exclude = None
+            else:
+                # Time has all of the information in these
+                exclude = ['hour', 'minute', 'msec']
+            computed_fields = [('Time', self.time_dtypes[self.time_mode])]
+            if self.symbol_table is not None:
+                computed_fields.append(('Symbol_ID', np.int32))
+            self.bytes_spec = \
+                spec_class(bytes_per_line,
+                          computed_fields=computed_fields,
+                          columns=self.columns, exclude=exclude,
+                          price_mode=self.price_mode,
+                          categorical=self.categorical)
+        else:
+            self.bytes_spec = spec_class(bytes_per_line)
+
+        # You need to use bytes to split bytes
+        # some files (probably older files do not have a record count)
+        try:
+            dateish, numlines = self.first_line.split(b":")
+            self.numlines = int(numlines)
+        except ValueError:
+            dateish = self.first_line
+
+        # Get dates to combine with times later
+        # This is a little over-trusting of the spec...
+        self.month = int(dateish[2:4])
+        self.day = int(dateish[4:6])
+        self.year = int(dateish[6:10])
+
+        # Nice idea from @rdhyee, we only need to compute the
+        # 0-second for the day once per file.self
+        naive_dt = datetime(self.year, self.month, self.day)
+
+        # It turns out you can't pass tzinfo directly, See
+        # http://pythonhosted.org/pytz/
+        # This lets us compute a UTC timestamp
+        self.midnight_ts = timezone('US/Eastern').\
+                             localize(naive_dt).\
+                             timestamp()
+        # midnight_ts is always a whole number of seconds
+        self.midnight_ns = int(round(self.midnight_ts)) * 10 ** 9
+
+        if self.validate:
+            self.validator = RecordValidator(
+                self.bytes_spec, self.numlines,
+                raise_errors=(self.validate == 'raise'))
+
+        if self.memory_budget is not None:
+            self.chunksize = self.memory_budget // self.row_footprint()
+            if self.chunksize < 1:
+                raise ValueError('memory_budget of {} bytes is less than a '
+                                 'row'.format(self.memory_budget))
+
+    def row_footprint(self):
+        '''Bytes per row of the chunks we (may) have alive at once
+
+        That's raw records (several, if we're prefetching or recycling), and,
+        if we're processing chunks, our int64 decoding buffers, the processed
+        chunk(s) and some temporaries. This needs self.bytes_spec, so it can be
+        used after `__init__()`.
+        '''
+        # With recycle, we hold on to that many chunks (and read buffers)
+        copies = self.recycle or 1
+        raw_copies = copies
+        if self.prefetch and (self.stream or is_zipfile(self.taq_fname)):
+            # A full queue, plus one being read
+            raw_copies += self.prefetch + 1
+        footprint = raw_copies * self.bytes_spec.bytes_per_line
+
+        if self.do_process_chunk:
+            footprint += 8 * len(self.bytes_spec.decoded_fields)
+            footprint += copies * \
+                np.dtype(self.bytes_spec.target_dtype).itemsize
+            footprint += self.TEMPORARY_BYTES_PER_ROW
+
+        return footprint
+
+    @classmethod
+    def calibrate(cls, taq_fname, memory_budget, candidates=None,
+                  sample_rows=None, **taq_args):
+        '''Time a few chunksizes on `taq_fname`, returning the fastest
+
+        taq_fname : str
+            The file to read (only its first `sample_rows` rows)
+        memory_budget : int or str
+            The largest chunksize we try is the one this gives (see
+            `__init__()`)
+        candidates : sequence of int
+            Chunksizes to try, any that don't fit in our budget are dropped.
+            Default is the largest size that fits, and 1/4, 1/16 and 1/64 of
+            that.
+        sample_rows : int
+            How many rows to read for each candidate. Default is twice the
+            largest candidate.
+        taq_args
+            Passed on to TAQ2Chunks (e.g., columns, time_mode)
+
+        Returns (chunksize, {chunksize: rows per second, ...}), so you can
+        then use `TAQ2Chunks(taq_fname, chunksize=chunksize, **taq_args)`.
+        '''
+        if is_stream(taq_fname):
+            raise ValueError("Can't calibrate on a stream, which can only be "
+                             "read once")
+        probe = cls(taq_fname, memory_budget=memory_budget, **taq_args)
+        max_rows = probe.chunksize
+        probe.close()
+
+        if candidates is None:
+            candidates = [max_rows // 4 ** i for i in range(4)]
+        candidates = sorted(set(size for size in candidates
+                                if 0 < size <= max_rows))
+        if not candidates:
+            raise ValueError('No candidate chunksize fits in memory_budget')
+        if sample_rows is None:
+            sample_rows = 2 * candidates[-1]
+
+        rates = {}
+        for chunksize in candidates:
+            taq_in = cls(taq_fname, chunksize=chunksize, **taq_args)
+            numrows = 0
+            tstart = time()
+            for chunk in taq_in:
+                numrows += len(chunk)
+                if numrows >= sample_rows:
+                    break
+            elapsed = time() - tstart
+            taq_in.close()
+            # A tiny sample might take no measurable time
+            rates[chunksize] = numrows / max(elapsed, 1e-9)
+
+        return max(rates, key=rates.get), rates
+
+    def _from_raw(self, raw_chunks):
+        '''Filter and process raw chunks as configured'''
+        if self.start_symbol is not None:
+            raw_chunks = self.skip_to_symbol(raw_chunks)
+        if self.symbols is not None:
+            raw_chunks = self.filter_chunks(raw_chunks)
+
+        if self.do_process_chunk:
+            for chunk in raw_chunks:
+                yield self.process_chunk(chunk)
+        else:
+            yield from raw_chunks
+
+    def load_index(self, zinfo):
+        '''Make sure self.index is a SeekIndex for zinfo, if we have one'''
+        if self.index is True:
+            self.index = index_name(self.taq_fname)
+        if isinstance(self.index, str):
+            self.index = SeekIndex.load(self.index)
+        if self.index is not None:
+            self.index.check_matches(zinfo)
+
+    def find_start_row(self):
+        '''Return the first row we need to read, based on our config
+
+        For symbols, this is only a lower bound, unless we have an index it's
+        just 0.
+        '''
+        if self.start_row is not None:
+            return self.start_row
+
+        if self.index is None:
+            return 0
+
+        if self.start_symbol is not None:
+            return self.index.row_for_symbol(
+                self.bytes_spec.pad('Symbol_root', self.start_symbol))
+        elif self.symbols:
+            self.set_symbol_filter(self.symbols)
+            return self.index.row_for_symbol(self._filter_roots[0])
+
+        return 0
+
+    def skip_to_symbol(self, raw_chunks):
+        '''Drop rows before the first row of self.start_symbol'''
+        start_root = self.bytes_spec.pad('Symbol_root', self.start_symbol)
+
+        for all_bytes in raw_chunks:
+            start = np.searchsorted(all_bytes['Symbol_root'], start_root)
+            if start < len(all_bytes):
+                yield all_bytes[start:]
+                break
+
+        yield from raw_chunks
+
+    def set_symbol_filter(self, symbols):
+        '''Pad `symbols` out to raw field widths for matching raw chunks
+
+        See `__init__()` for the format of `symbols`. Sets
+        `self.symbol_filter` to a dict of {root: None or [suffixes]}, with
+        None meaning "any suffix".
+        '''
+        pad = self.bytes_spec.pad
+
+        self.symbol_filter = {}
+        for symbol in symbols:
+            if isinstance(symbol, (str, bytes)):
+                self.symbol_filter[pad('Symbol_root', symbol)] = None
+            else:
+                root, suffix = symbol
+                root = pad('Symbol_root', root)
+                suffixes = self.symbol_filter.setdefault(root, [])
+                # An earlier plain root already matches any suffix
+                if suffixes is not None:
+                    suffixes.append(pad('Symbol_suffix', suffix))
+
+        root_dtype = np.dtype(self.bytes_spec.initial_dtype)['Symbol_root']
+        self._filter_roots = np.array(sorted(self.symbol_filter),
+                                      dtype=root_dtype)
+
+    def filter_symbols(self, all_bytes):
+        '''Return the rows of a raw chunk that match our symbol filter
+
+        `all_bytes` must be sorted by Symbol_root. The result is a compact
+        copy of the matching raw records (which may be empty).
+        '''
+        roots = all_bytes['Symbol_root']
+        starts = np.searchsorted(roots, self._filter_roots, 'left')
+        stops = np.searchsorted(roots, self._filter_roots, 'right')
+
+        selected = []
+        for root, start, stop in zip(self._filter_roots, starts, stops):
+            if start == stop:
+                continue
+            rows = np.arange(start, stop)
+            suffixes = self.symbol_filter[root]
+            if suffixes is not None:
+                keep = np.isin(all_bytes['Symbol_suffix'][start:stop],
+                               suffixes)
+                rows = rows[keep]
+            selected.append(rows)
+
+        if selected:
+            return all_bytes[np.concatenate(selected)]
+        else:
+            return all_bytes[:0]
+
+    def filter_chunks(self, raw_chunks):
+        '''Yield only matching rows from `raw_chunks`, stopping early
+
+        Since raw files are sorted by symbol, we can stop as soon as a chunk
+        ends past the last symbol we want.
+        '''
+        self.set_symbol_filter(self.symbols)
+        if not len(self._filter_roots):
+            return
+        last_root = self._filter_roots[-1]
+
+        for all_bytes in raw_chunks:
+            selected = self.filter_symbols(all_bytes)
+            if len(selected):
+                yield selected
+            if all_bytes['Symbol_root'][-1] > last_root:
+                break
 
     def process_chunk(self, all_bytes):
         '''Convert the structured ndarray `all_bytes` to the target_dtype
@@ -284,70 +1446,272 @@ class TAQ2Chunks:
         If you did not specify do_process_chunk, you might run this yourself on
         chunks that you get from iteration.'''
         target_dtype = np.dtype(self.bytes_spec.target_dtype)
-        combined = np.empty(all_bytes.shape, dtype=target_dtype)
+        if self.recycle:
+            combined = self.recycled_output(len(all_bytes), target_dtype)
+        else:
+            combined = np.empty(all_bytes.shape, dtype=target_dtype)
 
         for name in self.bytes_spec.passthrough_strings:
             combined[name] = all_bytes[name]
+        # Our categorical codes are just the bytes, re-interpreted
+        for name in self.bytes_spec.categorical_fields:
+            combined[name] = all_bytes[name].view(np.uint8)
+
+        # We decode all numeric fields with exact integer arithmetic straight
+        # from the raw records (see marketflow.fixed_width), re-using our int64
+        # buffers from the previous chunk where possible. Note that we don't do
+        # any bounds checking - non-digits will result in garbage.
+        self._decoded = self.bytes_spec.decoder.decode(all_bytes,
+                                                       self._decoded)
+        price_fields = self.bytes_spec.price_fields
         for name, dtype in self.bytes_spec.convert_dtype:
-            curr = all_bytes[name]
-            # .fromstring() converts bytes to integers, but needs
-            # C-contiguous data, hence a .copy()
-            # Also, 48 == ord(b'0'), subtracting from ANSI/ASCII/UTF8 yeilds
-            # integer equivalents.
-            # If generalizing this code, may want to do bounds checking
-            a = np.fromstring(curr.copy(), np.uint8) - 48
-            a = a.reshape((-1, curr.itemsize))
-
-            # We now have an expanded decimal representation in a, we'll assign
-            # appropriate multipliers for each place (e.g., (100, 10, 1))
-            place_values = (10. ** np.arange(curr.itemsize - 1, 0 - 1, -1,
-                                             dtype=dtype))
-
-            # These don't have the decimal point in the TAQ file
-            if name in ['Bid_Price', 'Ask_Price']:
-                place_values /= 10000
-
-            # And now we reduce to a more appropriate representation of a
-            # single float or integer per number using matrix algebra
-            combined[name] = a.dot(place_values)
+            if name in price_fields and self.price_mode == 'float':
+                # These don't have the decimal point in the TAQ file. Dividing
+                # the exact integer gives us the closest float64 to the actual
+                # price
+                np.divide(self._decoded[name], self.bytes_spec.PRICE_SCALE,
+                          out=combined[name])
+            else:
+                if name in price_fields and self.price_mode == 'int32':
+                    self.check_fits(name, dtype)
+                combined[name] = self._decoded[name]
 
         # Currently, there doesn't seem to be any value in converting to
         # numpy.datetime64, as PyTables wants float64's corresponding to the
         # POSIX Standard (relative to 1970-01-01, UTC) that it then converts to
         # a time64 struct on it's own
 
-        # This math is probably a bit inefficient, but we have tested that it
-        # works, and based on Dav's testing, this is taking negligible time
-        # compared to the above conversions.
-        time64ish = (self.midnight_ts +
-                     combined['hour'] * 3600. +
-                     combined['minute'] * 60. +
-                     # I'm particularly amazed that this seems to work (in py3)
-                     combined['msec'] / 1000.)
+        # Based on Dav's testing, this is taking negligible time compared to
+        # the above conversions. We work in place in scratch buffers to avoid
+        # allocating temporaries for every chunk.
+        if 'Time' in target_dtype.names:
+            # We use the decoded ints, as hour, etc. may not be in `combined`
+            # if we're only keeping some columns
+            hour = self._decoded['hour']
+            minute = self._decoded['minute']
+            msec = self._decoded['msec']
+            time_dtype = self.time_dtypes[self.time_mode]
+            time64ish = self.scratch('time', len(all_bytes), time_dtype)
+            term = self.scratch('term', len(all_bytes), time_dtype)
+
+            if self.time_mode == 'float':
+                # This is the same (left to right) order of operations as
+                # midnight_ts + hour * 3600. + minute * 60. + msec / 1000.
+                np.multiply(hour, 3600., out=time64ish)
+                np.add(time64ish, self.midnight_ts, out=time64ish)
+                np.multiply(minute, 60., out=term)
+                np.add(time64ish, term, out=time64ish)
+                # I'm particularly amazed that this seems to work (in py3)
+                np.divide(msec, 1000., out=term)
+                np.add(time64ish, term, out=time64ish)
+            else:
+                # Exact integer arithmetic, milliseconds since midnight
+                np.multiply(hour, 3600000, out=time64ish)
+                np.multiply(minute, 60000, out=term)
+                np.add(time64ish, term, out=time64ish)
+                np.add(time64ish, msec, out=time64ish)
+                if self.time_mode == 'ns':
+                    np.multiply(time64ish, 1000000, out=time64ish)
+                    np.add(time64ish, self.midnight_ns, out=time64ish)
+
+            # For float, this is a vanilla float64 column, as time64 is a mess
+            # (e.g. unsupported in HDF5)
+            combined['Time'] = time64ish
 
-        # This is a vanilla float64 column, as time64 is a mess (e.g.
-        # unsupported in HDF5)
-        combined['Time'] = time64ish
+        if 'Symbol_ID' in target_dtype.names:
+            combined['Symbol_ID'] = self.symbol_table.intern(
+                all_bytes['Symbol_root'], all_bytes['Symbol_suffix'])
 
         return combined
 
-    def chunks(self, numlines, infile):
-        '''Do the conversion of bytes to numpy "chunks"'''
-        # TODO Should do check on numlines to make sure we get the right number
+    def encode_chunk(self, chunk, out=None):
+        '''Convert a processed chunk back to raw records
+
+        This is the reverse of process_chunk(), see BytesSpec.encode(). With
+        a time_mode other than 'float', hour, minute and msec are computed
+        from Time.
+        '''
+        names = chunk.dtype.names
+        msec_of_day = None
+        if 'hour' not in names and 'Time' in names:
+            times = chunk['Time']
+            if self.time_mode == 'ms':
+                msec_of_day = times
+            elif self.time_mode == 'ns':
+                msec_of_day = (times - self.midnight_ns) // 1000000
+            else:
+                msec_of_day = np.rint(
+                    (times - self.midnight_ts) * 1000.).astype(np.int64)
+
+        return self.bytes_spec.encode(chunk, out, msec_of_day)
+
+    def scratch(self, name, numrows, dtype):
+        '''Return a scratch array of `numrows`, re-used between chunks'''
+        buf = self._scratch.get(name)
+        if buf is None or len(buf) < numrows or buf.dtype != dtype:
+            buf = self._scratch[name] = np.empty(numrows, dtype)
+        return buf[:numrows]
+
+    def recycled_output(self, numrows, target_dtype):
+        '''Return the next array in our ring of `self.recycle` outputs'''
+        if len(self._outputs) < self.recycle:
+            self._outputs.append(None)
+        i = self._next_output
+        self._next_output = (i + 1) % self.recycle
+
+        out = self._outputs[i]
+        if out is None or len(out) < numrows or out.dtype != target_dtype:
+            # We don't generally know chunksize when processing chunks
+            # directly, but most chunks will be a full chunksize
+            out = self._outputs[i] = np.empty(
+                max(numrows, self.chunksize or 0), dtype=target_dtype)
+
+        return out[:numrows]
+
+    def check_fits(self, name, dtype):
+        '''Raise a ValueError if decoded values for `name` overflow `dtype`'''
+        decoded = self._decoded[name]
+        if len(decoded) and decoded.max() > np.iinfo(dtype).max:
+            raise ValueError('{} of {} does not fit in {}, use '
+                             "price_mode='int'".format(
+                                 name, decoded.max(), np.dtype(dtype)))
+
+    def to_dollars(self, prices):
+        '''Return prices from processed chunks as float64 dollars
+
+        For price_mode 'float', prices are returned as-is.
+        '''
+        if self.price_mode == 'float':
+            return prices
+        return prices / self.bytes_spec.PRICE_SCALE
+
+    def to_datetime64(self, times):
+        '''Return Time values from processed chunks as datetime64[ns]
+
+        For time_mode 'ns', this is a view with no copying.
+        '''
+        if self.time_mode == 'ns':
+            return times.view('M8[ns]')
+        elif self.time_mode == 'ms':
+            return (times * 1000000 + self.midnight_ns).view('M8[ns]')
+        else:
+            # Our float times are only good to the millisecond anyway
+            msecs = np.round(times * 1000.).astype(np.int64)
+            return (msecs * 1000000).view('M8[ns]')
+
+    def chunks(self, numlines, infile, first_row=0):
+        '''Do the conversion of bytes to numpy "chunks"
+
+        first_row is the row we're starting from, for validation. With
+        validate, we also check numlines once we get to the end.
+        '''
 
         if self.chunksize is None:
             self.chunksize = self.DEFAULT_CHUNKSIZE
 
-        while(True):
-            raw_bytes = infile.read(self.bytes_spec.bytes_per_line *
-                                    self.chunksize)
-            if not raw_bytes:
-                break
+        read_size = self.bytes_spec.bytes_per_line * self.chunksize
+
+        if self.recycle:
+            num_buffers = self.recycle
+            if self.prefetch:
+                # A full queue, plus one being read
+                num_buffers += self.prefetch + 1
+            read = self.recycled_reader(infile, read_size, num_buffers)
+        else:
+            def read():
+                return infile.read(read_size)
 
+        if self.prefetch:
+            # Decompression happens in a background thread, while we (or our
+            # consumer) process the previous chunk
+            self.prefetcher = Prefetcher(read, self.prefetch)
+            raw_reads = iter(self.prefetcher)
+        else:
+            # An empty memoryview also compares equal to b''
+            raw_reads = iter(read, b'')
+
+        row = first_row
+        partial_bytes = 0
+        for raw_bytes in raw_reads:
             # This is a fix that @rdhyee made, but due to non-DRY appraoch, he
             # did not propagate his fix!
-            numrows = len(raw_bytes) // self.bytes_spec.bytes_per_line
+            numrows, partial_bytes = divmod(len(raw_bytes),
+                                            self.bytes_spec.bytes_per_line)
             all_bytes = np.ndarray(numrows, buffer=raw_bytes,
                                    dtype=self.bytes_spec.initial_dtype)
 
+            if self.validator is not None:
+                self.validator.check(all_bytes, row)
+            row += numrows
+
             yield all_bytes
+
+        # Reads are a whole number of records, so only the last one can have a
+        # partial record
+        if self.validator is not None:
+            self.validator.finish(partial_bytes, first_row)
+
+    def recycled_reader(self, infile, read_size, num_buffers):
+        '''Return a read() function that fills a ring of buffers in turn
+
+        Each call returns a memoryview of the next buffer, which will be empty
+        at the end of `infile`.
+        '''
+        buffers = [memoryview(bytearray(read_size))
+                   for _ in range(num_buffers)]
+        ring = {'next': 0}
+
+        def read():
+            buf = buffers[ring['next']]
+            ring['next'] = (ring['next'] + 1) % num_buffers
+
+            fill = 0
+            while fill < read_size:
+                piece = buf[fill:fill + self.RECYCLE_READ_SIZE]
+                num_read = infile.readinto(piece)
+                if not num_read:
+                    break
+                fill += num_read
+
+            return buf[:fill]
+
+        return read
+
+
+def write_taq(fname, first_line, chunks, member_name=None):
+    '''Write a raw TAQ file, zipped if `fname` ends in .zip
+
+    first_line : bytes
+        The header, including the trailing b'\\r\\n' (e.g., from
+        TAQ2Chunks.first_line). It should have the same length as a record.
+    chunks : iterable of np.ndarray
+        Raw records, e.g. from BytesSpec.encode(). Each chunk is written
+        straight from its buffer, without copying.
+    member_name : str
+        Name of the file in the zip archive. Default is `fname` without the
+        directory or .zip.
+
+    Returns the number of records written.
+    '''
+    if fname.endswith('.zip'):
+        if member_name is None:
+            member_name = path.basename(fname)[:-len('.zip')]
+        zf = ZipFile(fname, 'w', ZIP_DEFLATED)
+        # force_zip64 as we don't know how big this will be
+        outfile = zf.open(member_name, 'w', force_zip64=True)
+    else:
+        zf = None
+        outfile = open(fname, 'wb')
+
+    numrows = 0
+    try:
+        outfile.write(first_line)
+        for chunk in chunks:
+            outfile.write(memoryview(np.ascontiguousarray(chunk)).cast('B'))
+            numrows += len(chunk)
+    finally:
+        outfile.close()
+        if zf is not None:
+            zf.close()
+
+    return numrows
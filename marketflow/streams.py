@@ -0,0 +1,321 @@
+'''Read TAQ data from streams: pipes, stdin or any binary file object
+
+Nothing here seeks, so we can read straight from a transfer, e.g.:
+
+    $ aws s3 cp s3://bucket/EQY_US_ALL_BBO_20140206.zip - | python -c ...
+
+without staging to disk first. Zip archives are read member by member from
+their local file headers, rather than from the central directory at the end
+(which is what the zipfile module needs).
+'''
+
+import struct
+import sys
+import zlib
+from zipfile import BadZipFile
+
+ZIP_MAGIC = b'PK\x03\x04'
+# Once we get to the central directory (or the end of it), there are no more
+# members
+_CENTRAL_MAGIC = b'PK\x01\x02'
+_END_MAGIC = b'PK\x05\x06'
+_DESCRIPTOR_MAGIC = b'PK\x07\x08'
+
+# signature, version, flags, method, time, date, crc, compressed size,
+# uncompressed size, name length, extra length
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+# Flag bit for "crc and sizes are in a data descriptor after the data"
+_HAS_DESCRIPTOR = 0x08
+_ZIP64_EXTRA = 0x0001
+_ZIP64_LIMIT = 0xFFFFFFFF
+
+_STORED = 0
+_DEFLATED = 8
+
+
+def is_stream(taq_fname):
+    '''Is `taq_fname` a stream ('-' for stdin, or a file object)?'''
+    return taq_fname == '-' or hasattr(taq_fname, 'read')
+
+
+class _BufferedStream:
+    '''read(), readinto() and readline() on top of `_raw_read()`
+
+    Subclasses implement `_raw_read(size)`, which returns up to (roughly)
+    `size` bytes, and b'' at the end.
+    '''
+
+    # How much we ask _raw_read() for when we need more for readline()
+    READ_SIZE = 2 ** 16
+
+    name = None
+
+    def __init__(self):
+        self._pending = b''
+
+    def _raw_read(self, size):
+        raise NotImplementedError
+
+    def unread(self, data):
+        '''Put `data` back, so it's the next thing we read'''
+        self._pending = bytes(data) + self._pending
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            pieces = [self._pending]
+            self._pending = b''
+            for piece in iter(lambda: self._raw_read(self.READ_SIZE), b''):
+                pieces.append(piece)
+            return b''.join(pieces)
+
+        if len(self._pending) >= size:
+            data = self._pending[:size]
+            self._pending = self._pending[size:]
+            return data
+
+        # Raw reads may come up short (e.g., from a pipe), so we keep going
+        # until we have `size` bytes, or get to the end
+        pieces = [self._pending]
+        have = len(self._pending)
+        self._pending = b''
+        while have < size:
+            piece = self._raw_read(size - have)
+            if not piece:
+                break
+            pieces.append(piece)
+            have += len(piece)
+
+        data = b''.join(pieces)
+        if have > size:
+            self.unread(data[size:])
+            data = data[:size]
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        while b'\n' not in self._pending:
+            piece = self._raw_read(self.READ_SIZE)
+            if not piece:
+                break
+            self._pending += piece
+
+        end = self._pending.find(b'\n') + 1 or len(self._pending)
+        line = self._pending[:end]
+        self._pending = self._pending[end:]
+        return line
+
+    def peek(self, size):
+        '''Return the next `size` bytes (or fewer) without consuming them'''
+        data = self.read(size)
+        self.unread(data)
+        return data
+
+    def read_exact(self, size):
+        '''Read `size` bytes, raising BadZipFile if we get to the end first'''
+        data = self.read(size)
+        if len(data) < size:
+            raise BadZipFile('Unexpected end of stream')
+        return data
+
+    def skip(self, size):
+        '''Read and discard `size` bytes'''
+        while size > 0:
+            skipped = len(self.read(min(size, self.READ_SIZE)))
+            if not skipped:
+                break
+            size -= skipped
+
+    def close(self):
+        pass
+
+
+class StreamReader(_BufferedStream):
+    '''A minimal file object for the bytes of `fileobj`
+
+    `fileobj` only needs a read() method.
+    '''
+
+    def __init__(self, fileobj):
+        super().__init__()
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', None)
+        if not isinstance(self.name, str):
+            self.name = None
+
+    def _raw_read(self, size):
+        return self.fileobj.read(size)
+
+
+
+class ZipMemberReader(_BufferedStream):
+    '''A file object for the uncompressed data of one member of a zip stream
+
+    Created by `iter_zip_members()`, which has just read the local file
+    header. The CRC is checked once we get to the end of the data.
+    '''
+
+    def __init__(self, source, name, flags, method, crc, compress_size,
+                 zip64):
+        super().__init__()
+        if method not in (_STORED, _DEFLATED):
+            raise BadZipFile('{} uses unsupported compression method '
+                             '{}'.format(name, method))
+        if method == _STORED and flags & _HAS_DESCRIPTOR:
+            # We'd have no way of telling where the data ends
+            raise BadZipFile("Can't stream {}, which is stored with a data "
+                             "descriptor".format(name))
+
+        self.source = source
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.crc = crc
+        self.zip64 = zip64
+        self.finished = False
+        self._running_crc = 0
+        if method == _DEFLATED:
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            self._stored_left = compress_size
+
+    def _raw_read(self, size):
+        if self.finished:
+            return b''
+
+        if self.method == _STORED:
+            data = self.source.read(min(size, self._stored_left))
+            if not data and self._stored_left:
+                raise BadZipFile('Unexpected end of stream in '
+                                 '{}'.format(self.name))
+            self._stored_left -= len(data)
+            at_end = not self._stored_left
+        else:
+            data = b''
+            # A small piece of compressed data might not give us any output
+            while not data and not self._inflater.eof:
+                compressed = self.source.read(self.READ_SIZE)
+                if not compressed:
+                    raise BadZipFile('Unexpected end of stream in '
+                                     '{}'.format(self.name))
+                data = self._inflater.decompress(compressed)
+            at_end = self._inflater.eof
+            if at_end:
+                # We read past the end of the compressed data
+                self.source.unread(self._inflater.unused_data)
+
+        self._running_crc = zlib.crc32(data, self._running_crc)
+        if at_end:
+            self._finish()
+        return data
+
+    def _finish(self):
+        self.finished = True
+        crc = self.crc
+        if self.flags & _HAS_DESCRIPTOR:
+            # The signature is optional
+            crc_bytes = self.source.read_exact(4)
+            if crc_bytes == _DESCRIPTOR_MAGIC:
+                crc_bytes = self.source.read_exact(4)
+            crc, = struct.unpack('<L', crc_bytes)
+            # We don't need the sizes
+            self.source.read_exact(16 if self.zip64 else 8)
+
+        if crc != self._running_crc:
+            raise BadZipFile('Bad CRC-32 for {}'.format(self.name))
+
+    def skip_rest(self):
+        '''Read (and check) the rest of our data, so the source is at the
+        next member'''
+        while not self.finished:
+            self._raw_read(self.READ_SIZE)
+
+
+def _zip64_sizes(extra):
+    '''Return (file size, compressed size) from the zip64 extra field
+
+    Returns None if the extra field of a local header has no zip64 record.
+    '''
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<2H', extra, offset)
+        if header_id == _ZIP64_EXTRA and size >= 16:
+            return struct.unpack_from('<2Q', extra, offset + 4)
+        offset += 4 + size
+    return None
+
+
+def iter_zip_members(source):
+    '''Yield a ZipMemberReader for each file in the zip stream `source`
+
+    source : StreamReader
+        Positioned at the first local file header
+
+    Members must be read in order. Whatever is left of a member is read (and
+    discarded) when we move on to the next one. Directories are skipped.
+    '''
+    while True:
+        magic = source.read(4)
+        if magic in (b'', _CENTRAL_MAGIC, _END_MAGIC):
+            return
+        if magic != ZIP_MAGIC:
+            raise BadZipFile('Expected a local file header, got '
+                             '{!r}'.format(magic))
+
+        (_, _, flags, method, _, _, crc, compress_size, file_size,
+         name_len, extra_len) = _LOCAL_HEADER.unpack(
+             magic + source.read_exact(_LOCAL_HEADER.size - 4))
+        name = source.read_exact(name_len).decode('utf-8', 'replace')
+        extra = source.read_exact(extra_len)
+        zip64_sizes = _zip64_sizes(extra)
+        zip64 = zip64_sizes is not None
+        if zip64 and compress_size == _ZIP64_LIMIT:
+            _, compress_size = zip64_sizes
+
+        member = ZipMemberReader(source, name, flags, method, crc,
+                                 compress_size, zip64)
+        if not name.endswith('/'):
+            yield member
+        member.skip_rest()
+
+
+def iter_stream_members(fileobj):
+    '''Yield a file object for each TAQ file in `fileobj`, in order
+
+    fileobj : file object or '-'
+        A binary stream (only read() is used), or '-' for stdin. If it starts
+        with a zip header, it's read as a zip archive (see
+        `iter_zip_members()`), otherwise it's a single file.
+    '''
+    if fileobj == '-':
+        fileobj = sys.stdin.buffer
+    if isinstance(fileobj, _BufferedStream):
+        # E.g., a member from a previous call, no need to wrap it again
+        source = fileobj
+    else:
+        source = StreamReader(fileobj)
+
+    if source.peek(4) == ZIP_MAGIC:
+        yield from iter_zip_members(source)
+    else:
+        yield source
+
+
+def open_stream(fileobj, member=None):
+    '''Return a file object for the (uncompressed) TAQ data in `fileobj`
+
+    fileobj : file object or '-'
+        As for `iter_stream_members()`
+    member : str or int
+        For a zip archive, the name or (0-based) position of the file we
+        want. Files before it are read and discarded. Default is the first
+        file.
+    '''
+    for position, reader in enumerate(iter_stream_members(fileobj)):
+        if member is None or member == position or member == reader.name:
+            return reader
+
+    raise ValueError('No member {!r} in stream'.format(member))
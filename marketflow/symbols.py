@@ -0,0 +1,118 @@
+'''Intern TAQ symbols (Symbol_root + Symbol_suffix) as int32 IDs
+
+Every raw record carries 16 bytes of symbol. Grouping, joining or looking up
+on those bytes is slow (np.unique on a structured byte array, decoding for
+every split, etc.), so we map each distinct symbol to a small integer while
+chunks are parsed, and keep the strings once, in a SymbolTable.
+'''
+
+import numpy as np
+
+
+class SymbolTable:
+    '''A two-way mapping between (Symbol_root, Symbol_suffix) and int32 IDs
+
+    IDs are assigned in order of first appearance, starting from 0, and never
+    change. So a table that is saved and re-loaded (see `save()` and `load()`)
+    gives the same IDs across files (e.g., across days).
+
+    Symbols are stored padded with spaces, as in raw TAQ records.
+    '''
+
+    # These match the raw field widths in BytesSpec
+    root_dtype = np.dtype('S6')
+    suffix_dtype = np.dtype('S10')
+
+    def __init__(self, roots=(), suffixes=()):
+        '''Start with the given symbols (which get IDs 0, 1, ...)'''
+        self._roots = []
+        self._suffixes = []
+        self._ids = {}
+        # Array versions of _roots and _suffixes, built as needed
+        self._arrays = None
+
+        for root, suffix in zip(roots, suffixes):
+            self.add(root, suffix)
+
+    def __len__(self):
+        return len(self._roots)
+
+    def __getitem__(self, symbol_id):
+        '''Return (root, suffix) for `symbol_id`'''
+        return self._roots[symbol_id], self._suffixes[symbol_id]
+
+    def add(self, root, suffix):
+        '''Return the ID for padded bytes `root` and `suffix`, adding if new'''
+        key = (root, suffix)
+        try:
+            return self._ids[key]
+        except KeyError:
+            symbol_id = self._ids[key] = len(self._roots)
+            self._roots.append(root)
+            self._suffixes.append(suffix)
+            self._arrays = None
+            return symbol_id
+
+    def id_for(self, root, suffix=b''):
+        '''Return the ID of a symbol, or raise KeyError if we don't have it
+
+        root, suffix : str or bytes
+            Padded with spaces as needed, so e.g. `id_for('PWXSAN', 'PRA')`
+            works.
+        '''
+        if isinstance(root, str):
+            root = root.encode('ascii')
+        if isinstance(suffix, str):
+            suffix = suffix.encode('ascii')
+        return self._ids[(root.ljust(self.root_dtype.itemsize),
+                          suffix.ljust(self.suffix_dtype.itemsize))]
+
+    @property
+    def roots(self):
+        '''Array of Symbol_root, indexed by ID'''
+        return self.as_arrays()[0]
+
+    @property
+    def suffixes(self):
+        '''Array of Symbol_suffix, indexed by ID'''
+        return self.as_arrays()[1]
+
+    def as_arrays(self):
+        if self._arrays is None:
+            self._arrays = (np.array(self._roots, dtype=self.root_dtype),
+                            np.array(self._suffixes, dtype=self.suffix_dtype))
+        return self._arrays
+
+    def intern(self, roots, suffixes):
+        '''Return an int32 array of IDs for arrays of `roots` and `suffixes`
+
+        New symbols are added. We only do Python-level work for each run of
+        identical symbols, which (as raw TAQ files are sorted by symbol) is
+        roughly the number of symbols in the chunk, not the number of rows.
+        '''
+        numrows = len(roots)
+        if numrows == 0:
+            return np.empty(0, np.int32)
+
+        changed = roots[1:] != roots[:-1]
+        changed |= suffixes[1:] != suffixes[:-1]
+        starts = np.concatenate([[0], np.flatnonzero(changed) + 1])
+
+        run_ids = np.array([self.add(root, suffix) for root, suffix in
+                            zip(roots[starts].tolist(),
+                                suffixes[starts].tolist())],
+                           dtype=np.int32)
+
+        return np.repeat(run_ids, np.diff(np.append(starts, numrows)))
+
+    def save(self, fname):
+        '''Write to a compressed .npz file'''
+        roots, suffixes = self.as_arrays()
+        # np.savez will add .npz, but we want the name we were given
+        with open(fname, 'wb') as outfile:
+            np.savez_compressed(outfile, roots=roots, suffixes=suffixes)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as saved:
+            return cls(saved['roots'].tolist(), saved['suffixes'].tolist())
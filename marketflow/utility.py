@@ -2,6 +2,8 @@
 
 import csv
 from time import time
+from threading import Thread, Event
+from queue import Queue, Empty, Full
 
 # Keeping track of a bundle of output files for, e.g., ITCH data
 
@@ -50,6 +52,147 @@ class ManyWriters:
         self.close_files()
 
 
+# Overlapping I/O (or decompression) with processing
+
+
+class Prefetcher:
+    '''Iterate over the results of `read()`, calling it in a background thread
+
+    Iteration stops when `read()` returns something falsy (e.g., b'' at the
+    end of a file). Up to `depth` results are kept in a bounded queue, and
+    order is preserved. Exceptions in the background thread are re-raised in
+    the consumer.
+
+    This helps when `read()` releases the GIL for most of its work, as zlib
+    does for decompression.
+
+    Counters (updated as we go):
+
+    consumer_stalls
+        How often the consumer had to wait for `read()`
+    producer_stalls
+        How often the reader had to wait because the queue was full
+    items
+        How many results have been consumed
+    '''
+
+    # Sentinel for the end of our results
+    _done = object()
+
+    def __init__(self, read, depth=2):
+        self.read = read
+        self.depth = depth
+        self.consumer_stalls = 0
+        self.producer_stalls = 0
+        self.items = 0
+        self._reader = None
+
+    def _produce(self, queue, stop):
+        try:
+            while not stop.is_set():
+                item = self.read()
+                if not item:
+                    break
+                self._put(queue, stop, item)
+        except BaseException as err:
+            self._put(queue, stop, err)
+        finally:
+            self._put(queue, stop, self._done)
+
+    def _put(self, queue, stop, item):
+        try:
+            queue.put_nowait(item)
+        except Full:
+            self.producer_stalls += 1
+            # We time out periodically so we notice if the consumer quit
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    break
+                except Full:
+                    pass
+
+    def start(self):
+        '''Start calling read() in the background, if we haven't already
+
+        This normally happens when iteration starts, but starting early lets
+        several Prefetchers fill their queues at once.
+        '''
+        if self._reader is None:
+            self._queue = Queue(maxsize=self.depth)
+            self._stop = Event()
+            self._reader = Thread(target=self._produce,
+                                  args=(self._queue, self._stop), daemon=True)
+            self._reader.start()
+
+    def stop(self):
+        '''Stop the background thread, and wait for it to finish'''
+        reader = self._reader
+        if reader is None:
+            return
+        self._stop.set()
+        while reader.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Empty:
+                pass
+        reader.join()
+        self._reader = None
+
+    def __iter__(self):
+        self.start()
+        queue = self._queue
+
+        try:
+            while True:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    self.consumer_stalls += 1
+                    item = queue.get()
+
+                if item is self._done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                self.items += 1
+                yield item
+        finally:
+            # Make sure the reader is done before our caller (e.g.) closes the
+            # file it's reading from
+            self.stop()
+
+
+# Sizes
+
+_size_units = {'': 1, 'B': 1,
+               'K': 2 ** 10, 'KB': 2 ** 10,
+               'M': 2 ** 20, 'MB': 2 ** 20,
+               'G': 2 ** 30, 'GB': 2 ** 30,
+              }
+
+
+def parse_size(size):
+    '''Return a number of bytes for, e.g., 512000, '512MB' or '1.5 G'
+
+    Units are powers of 1024, as you'd expect for memory.
+    '''
+    if not isinstance(size, str):
+        return int(size)
+
+    number = size.strip().upper()
+    unit = ''
+    while number and number[-1] in 'KMGB':
+        unit = number[-1] + unit
+        number = number[:-1]
+
+    try:
+        return int(float(number) * _size_units[unit])
+    except (ValueError, KeyError):
+        raise ValueError("Can't parse size: {!r}".format(size))
+
+
 # Benchmarking
 
 
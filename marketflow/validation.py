@@ -0,0 +1,210 @@
+'''Vectorized integrity checks for raw TAQ records
+
+A partial download or a corrupt file otherwise just gives us garbage numbers
+(see TAQ2Chunks.process_chunk). All checks here work on whole raw chunks with
+numpy, there are no per-row Python loops.
+'''
+
+import numpy as np
+
+from .fixed_width import DigitDecoder
+
+
+def as_comparable(values):
+    '''Return a view of an 'S' array that compares like the bytes do
+
+    Comparing bytes arrays in numpy is slow. For widths of 1, 2, 4 or 8, a
+    big-endian unsigned int view orders the same way, and is much faster.
+    Other widths are returned as they are.
+    '''
+    if isinstance(values, bytes):
+        values = np.array(values)
+    width = values.dtype.itemsize
+    if width in [1, 2, 4, 8]:
+        return values.view('>u{}'.format(width))
+    return values
+
+
+class RecordValidator:
+    '''Check raw chunks from one file, keeping counts of bad rows
+
+    Checks (the keys of `bad_counts` and `bad_rows`):
+
+    newline
+        The record doesn't end in b'\\r\\n'
+    digits:<field>
+        A numeric field contains something other than b'0' through b'9'
+    range:<field>
+        A field is outside of `field_ranges` (e.g., an hour of 24)
+    sequence
+        The sequence number went down within a run of one symbol (raw files
+        are sorted by symbol, then sequence number)
+
+    plus two checks for the file as a whole, done by `finish()`:
+
+    partial_bytes
+        The number of bytes of an incomplete record at the end of the file
+    row_count
+        Whether the number of rows we read matches the header
+    '''
+
+    # Inclusive (low, high) for fields with a restricted range. These are
+    # compared as bytes, which works for fixed-width, zero-padded digits.
+    field_ranges = {'hour': (b'00', b'23'),
+                    'minute': (b'00', b'59'),
+                    # This includes seconds
+                    'msec': (b'00000', b'59999'),
+                   }
+
+    # We keep (at most) this many row numbers for each check
+    MAX_BAD_ROWS = 1000
+
+    def __init__(self, bytes_spec, numlines=None, raise_errors=False):
+        '''Set up checks for records described by `bytes_spec`
+
+        numlines : int
+            Number of records according to the header, if we have it
+        raise_errors : bool
+            Raise a ValueError (with our report) as soon as a chunk has bad
+            rows, instead of carrying on.
+        '''
+        self.bytes_per_line = bytes_spec.bytes_per_line
+        self.numlines = numlines
+        self.raise_errors = raise_errors
+
+        initial_dtype = np.dtype(bytes_spec.initial_dtype)
+        # All of the numeric fields in the layout, whether or not we're
+        # converting them
+        self.digit_fields = bytes_spec.digit_fields()
+        self.digit_checker = DigitDecoder(bytes_spec.initial_dtype,
+                                          self.digit_fields)
+        self.range_fields = [name for name in self.field_ranges
+                             if name in initial_dtype.names]
+        self.sequence_field = bytes_spec.sequence_field
+        if self.sequence_field not in initial_dtype.names:
+            self.sequence_field = None
+
+        self.rows_seen = 0
+        self.partial_bytes = 0
+        self.row_count_ok = None
+        self.bad_counts = {}
+        self.bad_rows = {}
+        # (root, suffix, sequence number) of the last row of the last chunk
+        self._last = None
+
+    @property
+    def ok(self):
+        '''True if no problems have been found so far'''
+        return not any(self.bad_counts.values()) and not self.partial_bytes \
+            and self.row_count_ok is not False
+
+    def _record(self, check, bad, first_row):
+        '''Count rows that failed `check`, given a boolean mask `bad`'''
+        bad_rows = np.flatnonzero(bad)
+        self.bad_counts[check] = self.bad_counts.get(check, 0) + \
+            len(bad_rows)
+        kept = self.bad_rows.setdefault(check, [])
+        room = self.MAX_BAD_ROWS - sum(len(rows) for rows in kept)
+        if len(bad_rows) and room > 0:
+            kept.append(bad_rows[:room] + first_row)
+
+    def check(self, all_bytes, first_row):
+        '''Check a raw chunk, the first record of which is row `first_row`
+
+        Returns True if all rows passed.
+        '''
+        numrows = len(all_bytes)
+        if numrows == 0:
+            return True
+        bad_before = sum(self.bad_counts.values())
+
+        self._record('newline', as_comparable(all_bytes['newline']) !=
+                     as_comparable(b'\r\n'), first_row)
+
+        non_digits = self.digit_checker.find_non_digits(all_bytes)
+        for name in self.digit_fields:
+            self._record('digits:' + name, non_digits[name], first_row)
+
+        for name in self.range_fields:
+            low, high = [as_comparable(limit)
+                         for limit in self.field_ranges[name]]
+            values = as_comparable(all_bytes[name])
+            self._record('range:' + name, (values < low) | (values > high),
+                         first_row)
+
+        if self.sequence_field is not None:
+            self._check_sequence(all_bytes, first_row)
+
+        self.rows_seen += numrows
+
+        passed = sum(self.bad_counts.values()) == bad_before
+        if not passed and self.raise_errors:
+            raise ValueError(self.report())
+        return passed
+
+    def _check_sequence(self, all_bytes, first_row):
+        '''Sequence numbers shouldn't go down for the same symbol'''
+        roots = all_bytes['Symbol_root']
+        suffixes = all_bytes['Symbol_suffix']
+        # Equal-width digits compare the same as bytes and as numbers
+        sequence = all_bytes[self.sequence_field]
+
+        went_down = np.zeros(len(all_bytes), dtype=bool)
+        went_down[1:] = (sequence[1:] < sequence[:-1]) & \
+            (roots[1:] == roots[:-1]) & (suffixes[1:] == suffixes[:-1])
+        if self._last is not None:
+            last_root, last_suffix, last_sequence = self._last
+            went_down[0] = (sequence[0] < last_sequence and
+                            roots[0] == last_root and
+                            suffixes[0] == last_suffix)
+        self._last = (roots[-1], suffixes[-1], sequence[-1])
+
+        self._record('sequence', went_down, first_row)
+
+    def finish(self, partial_bytes=0, start_row=0):
+        '''Do the whole-file checks, once we've read to the end
+
+        partial_bytes : int
+            Bytes left over after the last complete record
+        start_row : int
+            The row we started reading from, if not the first
+        '''
+        self.partial_bytes = partial_bytes
+        if self.numlines is not None:
+            self.row_count_ok = (start_row + self.rows_seen == self.numlines)
+
+        if self.raise_errors and not self.ok:
+            raise ValueError(self.report())
+
+    def bad_offsets(self, check):
+        '''Byte offsets in the (uncompressed) file of bad rows for `check`'''
+        return (self.bad_row_numbers(check) + 1) * self.bytes_per_line
+
+    def bad_row_numbers(self, check):
+        '''Row numbers (0 is the first record) of bad rows for `check`
+
+        Only the first MAX_BAD_ROWS bad rows for each check are kept.
+        '''
+        kept = self.bad_rows.get(check)
+        if not kept:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(kept)
+
+    def report(self):
+        '''Return a summary of problems found, as a str'''
+        if self.ok:
+            return 'OK: {} rows checked'.format(self.rows_seen)
+
+        lines = ['Problems in {} rows checked:'.format(self.rows_seen)]
+        for check, count in sorted(self.bad_counts.items()):
+            if count:
+                rows = self.bad_row_numbers(check)
+                lines.append('  {}: {} rows, first at row {} (byte {})'.format(
+                    check, count, rows[0], self.bad_offsets(check)[0]))
+        if self.partial_bytes:
+            lines.append('  {} bytes of a partial record at the end'.format(
+                self.partial_bytes))
+        if self.row_count_ok is False:
+            lines.append('  header says {} rows'.format(self.numlines))
+
+        return '\n'.join(lines)
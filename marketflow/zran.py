@@ -0,0 +1,576 @@
+'''Random access into zipped TAQ files, based on zran.c from zlib
+
+The deflate stream in a TAQ zip can only be decompressed from the start. But if
+we remember where some deflate blocks begin (down to the bit), along with the
+32KB of uncompressed data before that point, we can restart decompression
+there. See Mark Adler's zran.c (in the examples/ directory of zlib) for the
+original approach.
+
+Python's zlib module doesn't expose the pieces we need (Z_BLOCK and
+inflatePrime), so we drive the system zlib through ctypes. That keeps us free
+of compiled dependencies. We build the index once, while decompressing the
+whole file, and save it next to the zip (see `index_name()`).
+
+Along with each restart point, we record the first complete row after it, and
+that row's symbol, so we can start reading at a row or a symbol.
+'''
+
+import ctypes
+import ctypes.util
+from struct import unpack
+from zipfile import ZipFile, ZIP_DEFLATED, BadZipFile
+from os import path
+from zlib import crc32
+
+import numpy as np
+
+
+# From zlib.h
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+# Size of the deflate window, which we need to restart decompression
+WINSIZE = 32768
+
+# How much compressed data we read from disk at a time
+READ_SIZE = 2 ** 20
+
+
+class _ZStream(ctypes.Structure):
+    '''z_stream from zlib.h'''
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong),
+               ]
+
+
+_libz = None
+
+
+def load_libz():
+    '''Load the system zlib (once), and set up the functions we use'''
+    global _libz
+
+    if _libz is None:
+        libname = ctypes.util.find_library('z')
+        if libname is None:
+            raise ImportError("Couldn't find a zlib shared library")
+        libz = ctypes.CDLL(libname)
+
+        stream_p = ctypes.POINTER(_ZStream)
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [stream_p, ctypes.c_int,
+                                       ctypes.c_char_p, ctypes.c_int]
+        libz.inflate.argtypes = [stream_p, ctypes.c_int]
+        libz.inflateEnd.argtypes = [stream_p]
+        libz.inflatePrime.argtypes = [stream_p, ctypes.c_int, ctypes.c_int]
+        libz.inflateSetDictionary.argtypes = [stream_p, ctypes.c_char_p,
+                                              ctypes.c_uint]
+        _libz = libz
+
+    return _libz
+
+
+class RawInflater:
+    '''Minimal wrapper around zlib's inflate() for raw deflate streams
+
+    Output is written straight into a caller-provided writable buffer, so we
+    don't make extra copies of (potentially large) output.
+    '''
+
+    def __init__(self):
+        self.libz = load_libz()
+        self.strm = _ZStream()
+        ret = self.libz.inflateInit2_(ctypes.byref(self.strm), -15,
+                                      self.libz.zlibVersion(),
+                                      ctypes.sizeof(_ZStream))
+        if ret != Z_OK:
+            raise RuntimeError('inflateInit2 failed: {}'.format(ret))
+        self._input = None
+
+    def close(self):
+        if self.strm is not None:
+            self.libz.inflateEnd(ctypes.byref(self.strm))
+            self.strm = None
+
+    def __del__(self):
+        self.close()
+
+    def prime(self, bits, value):
+        '''Insert `bits` bits of `value` before the next input byte'''
+        self.libz.inflatePrime(ctypes.byref(self.strm), bits, value)
+
+    def set_dictionary(self, window):
+        '''Supply the uncompressed data preceding our restart point'''
+        ret = self.libz.inflateSetDictionary(ctypes.byref(self.strm),
+                                             window, len(window))
+        if ret != Z_OK:
+            raise RuntimeError('inflateSetDictionary failed: {}'.format(ret))
+
+    @property
+    def avail_in(self):
+        return self.strm.avail_in
+
+    @property
+    def data_type(self):
+        return self.strm.data_type
+
+    def feed(self, data):
+        '''Set `data` (bytes) as the next input'''
+        # We hold a reference so the memory stays valid
+        self._input = ctypes.create_string_buffer(data, len(data))
+        self.strm.next_in = ctypes.addressof(self._input)
+        self.strm.avail_in = len(data)
+
+    def inflate(self, out, start, stop, flush=Z_NO_FLUSH):
+        '''Inflate into out[start:stop], returning (# bytes written, status)
+
+        out : writable buffer (e.g., bytearray)
+        '''
+        addr = ctypes.addressof(ctypes.c_char.from_buffer(out))
+        self.strm.next_out = addr + start
+        self.strm.avail_out = stop - start
+        ret = self.libz.inflate(ctypes.byref(self.strm), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            msg = self.strm.msg
+            raise ValueError('Corrupt deflate data: {} ({})'.format(
+                ret, msg.decode() if msg else 'no message'))
+
+        return (stop - start) - self.strm.avail_out, ret
+
+
+def member_data_range(zfile, zinfo):
+    '''Return (offset, size) of the compressed data for `zinfo` in `zfile`
+
+    The local header can have a different "extra" field than the central
+    directory, so we read it directly.
+    '''
+    fp = zfile.fp
+    fp.seek(zinfo.header_offset)
+    local_header = fp.read(30)
+    if local_header[:4] != b'PK\x03\x04':
+        raise ValueError('Bad local header for {}'.format(zinfo.filename))
+    name_len, extra_len = unpack('<HH', local_header[26:30])
+
+    return zinfo.header_offset + 30 + name_len + extra_len, zinfo.compress_size
+
+
+def symbol_slices(first_line, member_name=None):
+    '''Return slices for Symbol_root and Symbol_suffix in a raw record
+
+    The layout is detected from the header line and the name of the file.
+    '''
+    # raw_taq uses this module, so we import here
+    from .raw_taq import bytes_specs, detect_file_type
+
+    spec = bytes_specs[detect_file_type(first_line, member_name)]
+    initial_dtype, _ = spec.layout(len(first_line))
+    fields = np.dtype(initial_dtype).fields
+    slices = []
+    for name in ['Symbol_root', 'Symbol_suffix']:
+        field_dtype, offset = fields[name][:2]
+        slices.append(slice(offset, offset + field_dtype.itemsize))
+
+    return slices
+
+
+def index_name(taq_fname):
+    '''Default name of the sidecar index for `taq_fname`'''
+    return taq_fname + '.idx.npz'
+
+
+class SeekIndex:
+    '''Restart points for the deflate stream of a zipped TAQ file
+
+    Each restart point i has:
+
+    in_offset[i], bits[i]
+        Position in the compressed data (bits is the number of bits of the
+        byte before in_offset that still need to be decompressed)
+    out_offset[i]
+        Position in the uncompressed file (including the header line)
+    first_row[i]
+        The first complete record at or after out_offset (0 is the first
+        record after the header)
+    first_root[i], first_suffix[i]
+        The symbol of that record
+    windows[i]
+        The (up to) 32KB of uncompressed data before out_offset
+    '''
+
+    # Uncompressed bytes between restart points. Larger is a smaller index, but
+    # more wasted decompression on each seek.
+    DEFAULT_SPAN = 2 ** 25
+
+    array_names = ['in_offset', 'bits', 'out_offset', 'first_row',
+                   'first_root', 'first_suffix', 'windows']
+
+    def __init__(self, member_name, compress_size, crc, bytes_per_line,
+                 **arrays):
+        '''Usually you'll want `build()` or `load()` instead'''
+        self.member_name = member_name
+        self.compress_size = compress_size
+        self.crc = crc
+        self.bytes_per_line = bytes_per_line
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.out_offset)
+
+    @classmethod
+    def build(cls, taq_fname, span=None):
+        '''Decompress all of `taq_fname`, recording restart points
+
+        span : int
+            Minimum uncompressed bytes between restart points. Default is
+            DEFAULT_SPAN.
+        '''
+        if span is None:
+            span = cls.DEFAULT_SPAN
+
+        with ZipFile(taq_fname) as zfile:
+            zinfo, = zfile.infolist()
+            if zinfo.compress_type != ZIP_DEFLATED:
+                raise ValueError('{} is not deflated'.format(taq_fname))
+            data_start, compress_size = member_data_range(zfile, zinfo)
+            fp = zfile.fp
+            fp.seek(data_start)
+
+            points = cls._scan(fp, compress_size, span, zinfo.filename)
+
+        return cls(zinfo.filename, zinfo.compress_size, zinfo.CRC, **points)
+
+    @staticmethod
+    def _scan(fp, compress_size, span, member_name=None):
+        '''Find restart points, and the rows/symbols that follow them'''
+        inflater = RawInflater()
+
+        # Output goes in buf[:fill], and we keep at least the last WINSIZE
+        # bytes when we need more space
+        buf = bytearray(WINSIZE + 8 * READ_SIZE)
+        fill = 0
+        total_in = total_out = 0
+        remaining = compress_size
+
+        bytes_per_line = None
+        # Set once we know bytes_per_line
+        root_slice = suffix_slice = None
+        points = {name: [] for name in SeekIndex.array_names}
+        # Points for which we haven't seen the first complete row yet
+        pending = []
+        last = None
+
+        def resolve_pending():
+            # buf[:fill] holds uncompressed bytes [total_out - fill, total_out)
+            while pending:
+                i = pending[0]
+                row = points['first_row'][i]
+                row_start = bytes_per_line * (row + 1)
+                if row_start + bytes_per_line > total_out:
+                    break
+                record = buf[row_start - (total_out - fill):][:bytes_per_line]
+                points['first_root'][i] = bytes(record[root_slice])
+                points['first_suffix'][i] = bytes(record[suffix_slice])
+                pending.pop(0)
+
+        # z_stream.total_in is only 32 bits on some platforms, so we count
+        # ourselves. This is the input consumed before the current feed()
+        consumed_before = fed = 0
+
+        while True:
+            if inflater.avail_in == 0 and remaining:
+                consumed_before += fed
+                data = fp.read(min(READ_SIZE, remaining))
+                remaining -= len(data)
+                inflater.feed(data)
+                fed = len(data)
+
+            if fill == len(buf):
+                buf[:WINSIZE] = buf[-WINSIZE:]
+                fill = WINSIZE
+
+            written, ret = inflater.inflate(buf, fill, len(buf), Z_BLOCK)
+            fill += written
+            total_out += written
+            total_in = consumed_before + fed - inflater.avail_in
+
+            if bytes_per_line is None:
+                newline = buf.find(b'\n', 0, fill)
+                if newline >= 0:
+                    bytes_per_line = newline + 1
+                    root_slice, suffix_slice = symbol_slices(
+                        bytes(buf[:bytes_per_line]), member_name)
+
+            if bytes_per_line is not None:
+                resolve_pending()
+
+            if ret == Z_STREAM_END:
+                break
+            if ret == Z_BUF_ERROR and inflater.avail_in == 0 and \
+                    not remaining:
+                raise ValueError('Deflate stream is truncated')
+
+            # At the end of a block (and not the last block)
+            data_type = inflater.data_type
+            if (data_type & 128) and not (data_type & 64) and \
+                    (last is None or total_out - last > span):
+                window_len = min(WINSIZE, total_out)
+                points['in_offset'].append(total_in)
+                points['bits'].append(data_type & 7)
+                points['out_offset'].append(total_out)
+                points['windows'].append(
+                    bytes(buf[fill - window_len:fill]).ljust(WINSIZE, b'\0'))
+                # The header is one line, the same length as the records,
+                # and we want the first record that starts at or after here
+                if bytes_per_line is None:
+                    first_row = 0
+                else:
+                    first_row = max(0, -(-total_out // bytes_per_line) - 1)
+                points['first_row'].append(first_row)
+                points['first_root'].append(None)
+                points['first_suffix'].append(None)
+                pending.append(len(points['out_offset']) - 1)
+                last = total_out
+
+        inflater.close()
+
+        # Points after the last complete row are useless
+        for i in reversed(pending):
+            for name in SeekIndex.array_names:
+                del points[name][i]
+
+        return {'in_offset': np.array(points['in_offset'], np.int64),
+                'bits': np.array(points['bits'], np.uint8),
+                'out_offset': np.array(points['out_offset'], np.int64),
+                'first_row': np.array(points['first_row'], np.int64),
+                'first_root': np.array(points['first_root'], 'S6'),
+                'first_suffix': np.array(points['first_suffix'], 'S10'),
+                'windows': np.frombuffer(b''.join(points['windows']),
+                                         np.uint8).reshape(-1, WINSIZE),
+                'bytes_per_line': bytes_per_line,
+                }
+
+    def save(self, index_fname):
+        '''Write to a compressed .npz file'''
+        # np.savez will add .npz, but we want the name we were given
+        with open(index_fname, 'wb') as outfile:
+            np.savez_compressed(
+                outfile, member_name=self.member_name,
+                compress_size=self.compress_size, crc=self.crc,
+                bytes_per_line=self.bytes_per_line,
+                **{name: getattr(self, name) for name in self.array_names})
+
+    @classmethod
+    def load(cls, index_fname):
+        with np.load(index_fname) as saved:
+            return cls(str(saved['member_name']),
+                       int(saved['compress_size']), int(saved['crc']),
+                       int(saved['bytes_per_line']),
+                       **{name: saved[name] for name in cls.array_names})
+
+    def check_matches(self, zinfo):
+        '''Raise ValueError if we weren't built from `zinfo`'''
+        if (zinfo.filename, zinfo.compress_size, zinfo.CRC) != \
+                (self.member_name, self.compress_size, self.crc):
+            raise ValueError('Index does not match {}, please rebuild'.format(
+                zinfo.filename))
+
+    def row_for_symbol(self, symbol_root):
+        '''Return a row at or before the first row of `symbol_root`
+
+        symbol_root : bytes
+            Padded to the width of the Symbol_root field
+        '''
+        # The last point that starts before our symbol. Records are sorted by
+        # symbol, so our symbol can't start before that point.
+        i = np.searchsorted(self.first_root, symbol_root, 'left') - 1
+        if i < 0:
+            return 0
+        return int(self.first_row[i])
+
+    def open_at(self, fp, data_start, out_offset):
+        '''Return a file-like reader starting at uncompressed `out_offset`
+
+        fp : binary file object
+            The zip file, which we'll seek around in
+        data_start : int
+            Offset of the compressed data in `fp`
+        '''
+        i = np.searchsorted(self.out_offset, out_offset, 'right') - 1
+        if i < 0:
+            # We can always start at the very beginning
+            reader = IndexedReader(fp, data_start, self.compress_size)
+            reader.skip(out_offset)
+        else:
+            bits = int(self.bits[i])
+            window_len = min(WINSIZE, int(self.out_offset[i]))
+            reader = IndexedReader(fp, data_start, self.compress_size,
+                                   int(self.in_offset[i]), bits,
+                                   self.windows[i, :window_len].tobytes())
+            reader.skip(out_offset - int(self.out_offset[i]))
+
+        return reader
+
+
+class IndexedReader:
+    '''A minimal read-only file object for a deflate stream, from any point
+
+    Note that there's no CRC check, since we don't read the whole member.
+    '''
+
+    def __init__(self, fp, data_start, compress_size, in_offset=0, bits=0,
+                 window=None):
+        self.fp = fp
+        self.inflater = RawInflater()
+        self.done = False
+
+        start = data_start + in_offset
+        if bits:
+            # We need the remaining bits of the preceding byte
+            start -= 1
+        fp.seek(start)
+        self.remaining = data_start + compress_size - start
+
+        if bits:
+            first = self._read_compressed(1)[0]
+            self.inflater.prime(bits, first >> (8 - bits))
+        if window:
+            self.inflater.set_dictionary(window)
+
+    def _read_compressed(self, size):
+        data = self.fp.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def readinto(self, out):
+        '''Fill the writable buffer `out` as far as possible
+
+        Returns the number of bytes written, which is only less than len(out)
+        at the end of the stream.
+        '''
+        fill = 0
+        while fill < len(out) and not self.done:
+            if self.inflater.avail_in == 0:
+                data = self._read_compressed(READ_SIZE)
+                if not data:
+                    raise ValueError('Deflate stream is truncated')
+                self.inflater.feed(data)
+            written, ret = self.inflater.inflate(out, fill, len(out))
+            fill += written
+            if ret == Z_STREAM_END:
+                self.done = True
+
+        return fill
+
+    def read(self, size):
+        '''Read up to `size` bytes, returned as a memoryview
+
+        We don't copy the output into a bytes object, and unlike a bytearray,
+        the buffer isn't zero-filled first.
+        '''
+        out = np.empty(size, dtype=np.uint8)
+        fill = self.readinto(out)
+
+        return memoryview(out)[:fill]
+
+    def skip(self, size):
+        '''Discard `size` bytes of output'''
+        scratch = bytearray(min(size, 8 * READ_SIZE))
+        while size > 0:
+            fill = self.readinto(memoryview(scratch)[:size])
+            if fill == 0:
+                break
+            size -= fill
+
+    def close(self):
+        self.inflater.close()
+
+
+class MemberReader(IndexedReader):
+    '''Read a whole zip member with zlib directly, bypassing ZipExtFile
+
+    ZipExtFile inflates a little at a time, into new bytes objects that are
+    then joined. We feed zlib large (READ_SIZE) blocks of compressed data, and
+    it writes straight into the caller's buffer (see `readinto()`), so the
+    result can be used as a numpy buffer with no copies.
+
+    check_crc : bool
+        Compute the CRC-32 of the output as we go, and raise BadZipFile if it
+        doesn't match `zinfo` at the end of the member
+    '''
+
+    def __init__(self, fp, zfile, zinfo, check_crc=True):
+        if zinfo.compress_type != ZIP_DEFLATED:
+            raise ValueError('{} is not deflated'.format(zinfo.filename))
+        data_start, compress_size = member_data_range(zfile, zinfo)
+        super().__init__(fp, data_start, compress_size)
+        self.name = zinfo.filename
+        self.expected_crc = zinfo.CRC if check_crc else None
+        self.crc = 0
+
+    def readinto(self, out):
+        fill = super().readinto(out)
+        if self.expected_crc is not None:
+            self.crc = crc32(memoryview(out)[:fill], self.crc)
+            if self.done and self.crc != self.expected_crc:
+                raise BadZipFile('Bad CRC-32 for {}'.format(self.name))
+        return fill
+
+
+def build_index(taq_fname, index_fname=None, span=None):
+    '''Build and save a SeekIndex for `taq_fname`, and return it
+
+    index_fname : str
+        Where to save the index. Default is from `index_name()`.
+    '''
+    if index_fname is None:
+        index_fname = index_name(taq_fname)
+
+    index = SeekIndex.build(taq_fname, span)
+    index.save(index_fname)
+
+    return index
+
+
+def main():
+    '''Build seek indexes for zipped TAQ files, use like this:
+
+    $ taqindex ../../local_data/EQY_US_ALL_BBO_201502*.zip
+
+    (It's installed as a package script)
+    '''
+    from argparse import ArgumentParser
+
+    from .utility import timeit
+
+    parser = ArgumentParser()
+    parser.add_argument('--span', type=int, default=SeekIndex.DEFAULT_SPAN,
+                        help='Uncompressed bytes between restart points')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Overwrite existing index files')
+    parser.add_argument('fnames', nargs='+', metavar='filename',
+                        help='A zipped TAQ file to index')
+    parsed = parser.parse_args()
+
+    timed_build = timeit(build_index)
+
+    for name in parsed.fnames:
+        if (not parsed.overwrite) and path.exists(index_name(name)):
+            print('skipping, {} exists'.format(index_name(name)))
+        else:
+            timed_build(name, span=parsed.span)
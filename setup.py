@@ -20,6 +20,7 @@ setup(
         'console_scripts': [
             'taq2h5=marketflow.hdf5:taq2h5',
             'pyitch=marketflow.ITCHbin:main',
+            'taqindex=marketflow.zran:main',
         ],
     },
 )
@@ -0,0 +1,77 @@
+'''Test the marketflow.cache module'''
+
+from os import path, utime, listdir
+from shutil import copy
+
+import numpy as np
+
+import marketflow
+from marketflow.cache import ChunkCache
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+def test_cached_pass(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    taq_name = str(tmpdir.join('taq.zip'))
+    copy(std_test_file, taq_name)
+    expected = list(marketflow.TAQ2Chunks(taq_name, chunksize=3000))
+
+    first = marketflow.TAQ2Chunks(taq_name, chunksize=3000, cache=cache_dir)
+    assert first.cached is None
+    list(first)
+
+    again = marketflow.TAQ2Chunks(taq_name, chunksize=3000, cache=cache_dir)
+    assert again.cached is not None
+    assert again.numlines == first.numlines
+    assert again.midnight_ts == first.midnight_ts
+    chunks = list(again)
+    assert [len(chunk) for chunk in chunks] == \
+        [len(chunk) for chunk in expected]
+    assert (np.hstack(chunks) == np.hstack(expected)).all()
+    assert not chunks[0].flags.writeable
+
+    # Different options are a different entry
+    other = marketflow.TAQ2Chunks(taq_name, chunksize=3000, cache=cache_dir,
+                                  price_mode='int')
+    assert other.cached is None
+    # We only store full passes
+    next(other)
+    other.close()
+    assert len(ChunkCache(cache_dir).entries()) == 1
+
+    # A changed file is a different entry
+    utime(taq_name, (0, 0))
+    assert marketflow.TAQ2Chunks(taq_name, chunksize=3000,
+                                 cache=cache_dir).cached is None
+
+
+def test_checksum(tmpdir):
+    cache = ChunkCache(str(tmpdir.join('cache')), checksum=True)
+    list(marketflow.TAQ2Chunks(std_test_file, cache=cache))
+
+    taq_name = str(tmpdir.join('copy.zip'))
+    copy(std_test_file, taq_name)
+    assert marketflow.TAQ2Chunks(taq_name, cache=cache).cached is not None
+
+
+def test_eviction(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    list(marketflow.TAQ2Chunks(std_test_file, cache=cache_dir))
+    entry_size = ChunkCache(cache_dir).size()
+
+    # Room for two entries
+    cache = ChunkCache(cache_dir, max_bytes=int(entry_size * 2.5))
+    for price_mode in ['int', 'int32']:
+        list(marketflow.TAQ2Chunks(std_test_file, cache=cache,
+                                   price_mode=price_mode))
+    assert len(cache.entries()) == 2
+    # The float entry was used least recently
+    assert marketflow.TAQ2Chunks(std_test_file, cache=cache).cached is None
+    assert marketflow.TAQ2Chunks(std_test_file, cache=cache,
+                                 price_mode='int32').cached is not None
+
+    cache.clear()
+    assert listdir(cache_dir) == []
@@ -0,0 +1,113 @@
+'''Test the marketflow.fixed_width module'''
+
+from os import path
+
+import numpy as np
+import pytest
+from pytest import mark
+
+import marketflow
+from marketflow.fixed_width import DigitDecoder
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+def float_decode(curr):
+    '''The float dot-product decoding we used to use in process_chunk'''
+    a = np.frombuffer(curr.copy(), np.uint8) - 48
+    a = a.reshape((-1, curr.itemsize))
+    place_values = 10. ** np.arange(curr.itemsize - 1, -1, -1)
+
+    return a.dot(place_values)
+
+
+@mark.parametrize('block_rows', [None, 7, 1000])
+def test_decoder_matches_float_decode(block_rows):
+    taq_in = marketflow.TAQ2Chunks(std_test_file, do_process_chunk=False)
+    raw = next(taq_in)
+    names = [name for name, _ in taq_in.bytes_spec.convert_dtype]
+    decoder = DigitDecoder(raw.dtype, names, block_rows)
+
+    decoded = decoder.decode(raw)
+
+    for name in names:
+        assert decoded[name].dtype == np.int64
+        assert (decoded[name] == float_decode(raw[name])).all()
+
+
+def test_decoder_edge_widths():
+    # Fields at the very start and end of a record, and one wider than 16
+    dtype = np.dtype([('a', 'S2'), ('b', 'S3'), ('c', 'S18'), ('d', 'S1')])
+    records = np.array([(b'07', b'123', b'123456789012345678', b'9'),
+                        (b'00', b'000', b'000000000000000001', b'0'),
+                        (b'99', b'999', b'999999999999999999', b'5')],
+                       dtype=dtype)
+    decoder = DigitDecoder(dtype, ['a', 'b', 'c', 'd'])
+
+    decoded = decoder.decode(records)
+
+    for name in dtype.names:
+        assert decoded[name].tolist() == [int(x) for x in records[name]]
+
+    # Output arrays are re-used when they fit
+    again = decoder.decode(records, decoded)
+    assert again['c'] is decoded['c']
+
+
+def test_decoder_non_contiguous():
+    taq_in = marketflow.TAQ2Chunks(std_test_file, do_process_chunk=False)
+    raw = next(taq_in)[::3]
+    decoder = DigitDecoder(raw.dtype, ['Sequence_Number'])
+
+    decoded = decoder.decode(raw)
+
+    assert (decoded['Sequence_Number'] ==
+            float_decode(raw['Sequence_Number'])).all()
+
+
+def test_find_non_digits():
+    dtype = np.dtype([('a', 'S3'), ('b', 'S11'), ('c', 'S2')])
+    records = np.array([(b'123', b'00001234500', b'00'),
+                        (b'12 ', b'0000123450/', b'0:'),
+                        (b'\x00\x00\x00', b'\xb0' * 11, b'99')], dtype=dtype)
+    decoder = DigitDecoder(dtype, ['a', 'b', 'c'])
+
+    non_digits = decoder.find_non_digits(records)
+
+    assert non_digits['a'].tolist() == [False, True, True]
+    assert non_digits['b'].tolist() == [False, True, True]
+    assert non_digits['c'].tolist() == [False, True, False]
+
+
+@mark.parametrize('block_rows', [None, 7])
+def test_encode(block_rows):
+    # Fields at the very start and end of a record, and some wider than 8
+    dtype = np.dtype([('a', 'S2'), ('b', 'S3'), ('c', 'S18'), ('s', 'S2'),
+                      ('d', 'S11'), ('e', 'S1')])
+    decoder = DigitDecoder(dtype, ['a', 'b', 'c', 'd', 'e'], block_rows)
+    values = {'a': np.array([7, 0, 99] * 5),
+              'b': np.array([123, 0, 999] * 5),
+              'c': np.array([123456789012345678, 1, 10 ** 18 - 1] * 5),
+              'd': np.array([1234500, 0, 10 ** 11 - 1] * 5),
+              'e': np.array([9, 0, 5] * 5)}
+    records = np.zeros(15, dtype)
+    records['s'] = b'xy'
+
+    decoder.encode(values, records)
+
+    for name, field_values in values.items():
+        width = dtype[name].itemsize
+        assert records[name].tolist() == \
+            [str(x).zfill(width).encode() for x in field_values]
+    # Other bytes aren't touched
+    assert (records['s'] == b'xy').all()
+
+    with pytest.raises(ValueError):
+        decoder.encode({'b': np.array([1000])}, records[:1])
+
+
+def test_decoder_too_wide():
+    with pytest.raises(ValueError):
+        DigitDecoder(np.dtype([('a', 'S19')]), ['a'])
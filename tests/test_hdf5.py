@@ -0,0 +1,304 @@
+'''Test the marketflow.hdf5 module'''
+
+from os import path
+from shutil import copy
+
+import numpy as np
+import pytest
+import tables as tb
+
+import marketflow
+from marketflow.hdf5 import (H5Reader, H5Writer, LAYOUTS, conv_to_hdf5,
+                             convert_many, read_symbol, query, query_symbol,
+                             time_condition)
+from marketflow.raw_taq import write_taq
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+def test_conv_to_hdf5(tmpdir):
+    h5_name = str(tmpdir.join('test.h5'))
+    numrows = conv_to_hdf5(std_test_file, h5_name)
+
+    taq_in = marketflow.TAQ2Chunks(std_test_file)
+    assert numrows == len(taq_in)
+
+    with tb.open_file(h5_name) as h5:
+        tables = list(h5.walk_nodes('/', 'Table'))
+        assert sum(table.nrows for table in tables) == numrows
+        assert h5.root.PWXSAN.PRA.nrows > 0
+
+
+def test_int_time(tmpdir):
+    h5_name = str(tmpdir.join('test.h5'))
+    conv_to_hdf5(std_test_file, h5_name, time_mode='ns')
+
+    with tb.open_file(h5_name) as h5:
+        assert h5.root._v_attrs.time_mode == 'ns'
+        table = h5.root.PWXSAN.PRA
+        assert table.coldtypes['Time'] == np.int64
+        assert 'hour' not in table.colnames
+
+
+def test_int_prices(tmpdir):
+    h5_name = str(tmpdir.join('test.h5'))
+    conv_to_hdf5(std_test_file, h5_name, price_mode='int')
+
+    with tb.open_file(h5_name) as h5:
+        assert h5.root._v_attrs.price_mode == 'int'
+        assert h5.root._v_attrs.price_scale == 10000
+        assert h5.root.PWXSAN.PRA.coldtypes['Bid_Price'] == np.int64
+
+
+def test_categorical(tmpdir):
+    bytes_name = str(tmpdir.join('bytes.h5'))
+    conv_to_hdf5(std_test_file, bytes_name)
+    cat_name = str(tmpdir.join('cat.h5'))
+    conv_to_hdf5(std_test_file, cat_name, categorical=True)
+
+    with tb.open_file(bytes_name) as bytes_h5, tb.open_file(cat_name) as h5:
+        categories = h5.root._v_attrs.Exchange_categories
+        exchange = h5.root.PWXSAN.PRA.col('Exchange')
+        assert exchange.dtype == np.uint8
+        assert (categories[exchange] ==
+                bytes_h5.root.PWXSAN.PRA.col('Exchange')).all()
+
+
+def test_symbol_ids(tmpdir):
+    h5_name = str(tmpdir.join('test.h5'))
+    numrows = conv_to_hdf5(std_test_file, h5_name, symbol_ids=True)
+
+    with tb.open_file(h5_name) as h5:
+        symbols = h5.root.symbols.read()
+        table = h5.root.PWXSAN.PRA
+        assert 'Symbol_root' not in table.colnames
+        assert 'Symbol_ID' not in table.colnames
+        symbol_id = table.attrs.Symbol_ID
+        assert symbols['Symbol_root'][symbol_id] == b'PWXSAN'
+        assert symbols['Symbol_suffix'][symbol_id].strip() == b'PRA'
+        assert sum(node.nrows for node in h5.walk_nodes('/', 'Table')
+                   if node is not h5.root.symbols) == numrows
+
+
+def test_convert_many(tmpdir):
+    conversions = []
+    for i in range(3):
+        taq_name = str(tmpdir.join('test{}.zip'.format(i)))
+        copy(std_test_file, taq_name)
+        conversions.append((taq_name, taq_name[:-4] + '.h5'))
+    bad_name = str(tmpdir.join('bad.zip'))
+    with open(bad_name, 'w') as bad:
+        bad.write('Not a zip file')
+    conversions.append((bad_name, bad_name[:-4] + '.h5'))
+
+    results = list(convert_many(conversions, jobs=2))
+
+    assert len(results) == 4
+    for stats in results:
+        if stats.taq_name == bad_name:
+            assert stats.error is not None
+            assert 'FAILED' in stats.report()
+        else:
+            assert stats.error is None
+            assert stats.numrows > 0
+            assert path.exists(stats.h5_name)
+
+
+def test_presets(tmpdir):
+    h5_name = str(tmpdir.join('test.h5'))
+    conv_to_hdf5(std_test_file, h5_name, preset='fast-write')
+
+    with tb.open_file(h5_name) as h5:
+        assert h5.root._v_attrs.preset == 'fast-write'
+        table = h5.root.PWXSAN.PRA
+        assert table.filters.complib == 'blosc:lz4'
+        assert not table.filters.fletcher32
+        assert table.chunkshape == (H5Writer.presets['fast-write']
+                                    ['chunkshape'],)
+
+    conv_to_hdf5(std_test_file, h5_name, chunkshape=100)
+    with tb.open_file(h5_name) as h5:
+        assert h5.root.PWXSAN.PRA.chunkshape == (100,)
+        assert h5.root.PWXSAN.PRA.filters.complib == 'blosc:lz4hc'
+
+    with pytest.raises(ValueError):
+        H5Writer(str(tmpdir.join('bad.h5')), preset='tiny')
+
+
+@pytest.mark.parametrize('symbol_ids', [None, True])
+def test_single_layout(tmpdir, symbol_ids):
+    per_symbol_name = str(tmpdir.join('per_symbol.h5'))
+    single_name = str(tmpdir.join('single.h5'))
+    conv_to_hdf5(std_test_file, per_symbol_name, symbol_ids=symbol_ids)
+    numrows = conv_to_hdf5(std_test_file, single_name, symbol_ids=symbol_ids,
+                           layout='single')
+
+    with tb.open_file(per_symbol_name) as per_symbol, \
+            tb.open_file(single_name) as single:
+        assert single.root._v_attrs.layout == 'single'
+        assert single.root.records.nrows == numrows
+        index = single.root.symbol_index.read()
+        assert (index['start'][1:] == index['stop'][:-1]).all()
+        assert index['stop'][-1] == numrows
+        assert ('Symbol_ID' in index.dtype.names) == bool(symbol_ids)
+
+        for table in per_symbol.walk_nodes('/', 'Table'):
+            if table.name == 'symbols':
+                continue
+            root = table._v_parent._v_name
+            suffix = '' if table.name == 'no_suffix' else table.name
+            expected = read_symbol(per_symbol, root, suffix)
+            assert (read_symbol(single, root, suffix) == expected).all()
+
+        with pytest.raises(KeyError):
+            read_symbol(single, 'NOPE')
+
+
+def test_single_layout_unsorted(tmpdir):
+    raw = np.hstack(list(marketflow.TAQ2Chunks(std_test_file,
+                                               do_process_chunk=False)))
+    first_line = marketflow.TAQ2Chunks(std_test_file).first_line
+    taq_name = str(tmpdir.join('reversed.zip'))
+    write_taq(taq_name, first_line, [raw[::-1].copy()])
+
+    sorted_name = str(tmpdir.join('sorted.h5'))
+    reversed_name = str(tmpdir.join('reversed.h5'))
+    conv_to_hdf5(std_test_file, sorted_name, layout='single')
+    conv_to_hdf5(taq_name, reversed_name, layout='single')
+
+    with tb.open_file(sorted_name) as expected, \
+            tb.open_file(reversed_name) as h5:
+        assert (h5.root.symbol_index.read() ==
+                expected.root.symbol_index.read()).all()
+        assert (h5.root.records.cols.Time[:] ==
+                expected.root.records.cols.Time[:]).all()
+        assert 'records_sorted' not in h5.root
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_queries(tmpdir, layout):
+    h5_name = str(tmpdir.join('test.h5'))
+    conv_to_hdf5(std_test_file, h5_name, layout=layout, indexes=True)
+
+    with tb.open_file(h5_name) as h5:
+        assert list(h5.root._v_attrs.indexes) == ['Time', 'Sequence_Number']
+        everything = dict(query(h5))
+        assert len(everything) == 97
+        times = np.hstack([rows['Time'] for rows in everything.values()])
+        start, stop = np.percentile(times, [40, 60])
+
+        found = dict(query(h5, start, stop, 'Bid_Price > 0'))
+        for symbol, rows in everything.items():
+            keep = ((rows['Time'] >= start) & (rows['Time'] < stop) &
+                    (rows['Bid_Price'] > 0))
+            if keep.any():
+                assert (found.pop(symbol) == rows[keep]).all()
+        assert not found
+
+        symbol = (b'PWXSAN', b'PRA')
+        rows = query_symbol(h5, *symbol, start=start)
+        assert (rows == everything[symbol][
+            everything[symbol]['Time'] >= start]).all()
+
+        if layout == 'single':
+            table = h5.root.records
+            assert table.cols.Time.is_indexed
+            assert table.will_query_use_indexing(
+                *time_condition(start, stop))
+
+
+def test_write_buffer(tmpdir):
+    buffered_name = str(tmpdir.join('buffered.h5'))
+    direct_name = str(tmpdir.join('direct.h5'))
+    conv_to_hdf5(std_test_file, buffered_name, buffer_bytes='4KB')
+    conv_to_hdf5(std_test_file, direct_name, buffer_bytes=0)
+
+    with tb.open_file(buffered_name) as buffered, \
+            tb.open_file(direct_name) as direct:
+        for table in direct.walk_nodes('/', 'Table'):
+            assert (buffered.get_node(table._v_pathname).read() ==
+                    table.read()).all()
+
+    # Appends are in whole HDF5 chunks, once the first is topped up
+    writer = H5Writer(str(tmpdir.join('aligned.h5')), chunkshape=100,
+                      buffer_bytes=250 * 8)
+    data = np.zeros(1000, dtype=[('x', np.int64)])
+    data['x'] = np.arange(1000)
+    writer.append('/', 'x', data[:30])
+    table = writer.h5.root.x
+    assert table.nrows == 0
+    writer.flush()
+    assert table.nrows == 30
+    # Our buffer holds 200 rows, 170 of which fill up the first chunk
+    writer.append('/', 'x', data[30:300])
+    assert table.nrows == 200
+    writer.append('/', 'y', data[:10])
+    assert table.nrows == 300
+    writer.finalize_hdf5()
+    with tb.open_file(str(tmpdir.join('aligned.h5'))) as h5:
+        assert (h5.root.x.read() == data[:300]).all()
+        assert (h5.root.y.read() == data[:10]).all()
+
+
+def test_node_cache(tmpdir):
+    writer = H5Writer(str(tmpdir.join('nodes.h5')), buffer_bytes=0,
+                      node_cache_size=2)
+    data = np.zeros(10, dtype=[('x', np.int64)])
+    for name in ['a', 'b', 'a', 'c', 'a', 'b']:
+        writer.append('/', name, data)
+    # b was dropped when c came along, so we look it up again
+    assert writer.node_misses == 4
+    assert writer.node_hits == 2
+    assert list(writer.tables) == [('/', 'a'), ('/', 'b')]
+    assert writer.get_table('/', 'nope') is None
+    assert len(writer.descriptions) == 1
+    writer.finalize_hdf5()
+
+    with tb.open_file(str(tmpdir.join('nodes.h5'))) as h5:
+        assert h5.root.a.nrows == 30
+        assert h5.root.b.nrows == 20
+        assert h5.root.c.nrows == 10
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_reader(tmpdir, layout):
+    h5_name = str(tmpdir.join('test.h5'))
+    conv_to_hdf5(std_test_file, h5_name, layout=layout)
+
+    with tb.open_file(h5_name) as h5:
+        expected = dict(query(h5))
+    symbol = max(expected, key=lambda symbol: len(expected[symbol]))
+    times = expected[symbol]['Time']
+    windows = [(None, None), (times[3], None), (None, times[-5]),
+               (times[2], times[7]), (times[-1] + 1, None), (times[5], 0)]
+
+    with H5Reader(block_rows=4) as reader:
+        for start, stop in windows:
+            keep = np.ones(len(times), dtype=bool)
+            if start is not None:
+                keep &= times >= start
+            if stop is not None:
+                keep &= times < stop
+            rows = reader.read(h5_name, *symbol, start=start, stop=stop)
+            assert (rows == expected[symbol][keep]).all()
+
+        # Everything's cached now
+        misses = reader.misses
+        reader.read(h5_name, *symbol)
+        assert reader.misses == misses
+        assert 0 < reader.hit_rate() < 1
+        assert 'hit rate' in reader.report()
+
+        for other, rows in expected.items():
+            assert (reader.read(h5_name, *other) == rows).all()
+        with pytest.raises(KeyError):
+            reader.read(h5_name, 'NOPE')
+
+    # A small cache keeps the most recent blocks
+    with H5Reader(cache_bytes=1000, block_rows=4) as reader:
+        for other in expected:
+            reader.read(h5_name, *other)
+        assert reader.cached_bytes <= 1000
+        assert len(reader.blocks) > 0
@@ -0,0 +1,133 @@
+'''Test reading TAQ data from streams and multi-member archives'''
+
+from io import BytesIO, RawIOBase
+from os import path
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, BadZipFile
+
+import numpy as np
+import pytest
+from pytest import mark
+
+import marketflow
+from marketflow.streams import open_stream
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+class Pipe:
+    '''Only has read(), which returns short reads, like a pipe'''
+
+    def __init__(self, data):
+        self.data = BytesIO(data)
+
+    def read(self, size=-1):
+        if size is not None and size > 0:
+            size = min(size, 1000)
+        return self.data.read(size)
+
+
+class Unseekable(RawIOBase):
+    '''For writing zip files with data descriptors, as when streaming'''
+
+    def __init__(self):
+        self.written = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+
+@pytest.fixture(scope='module')
+def raw_taq():
+    with ZipFile(std_test_file) as zfile:
+        return zfile.read(zfile.namelist()[0])
+
+
+@pytest.fixture(scope='module')
+def expected():
+    return np.hstack(list(marketflow.TAQ2Chunks(std_test_file)))
+
+
+@mark.parametrize('taq_args', [{}, dict(prefetch=2), dict(start_row=5000),
+                               dict(validate='raise')])
+def test_zip_stream(taq_args, expected):
+    with open(std_test_file, 'rb') as infile:
+        taq_in = marketflow.TAQ2Chunks(Pipe(infile.read()), chunksize=3000,
+                                       **taq_args)
+        chunks = list(taq_in)
+
+    assert taq_in.numlines == len(expected)
+    start_row = taq_args.get('start_row', 0)
+    assert (np.hstack(chunks) == expected[start_row:]).all()
+
+
+def test_uncompressed_stream(raw_taq, expected):
+    taq_in = marketflow.TAQ2Chunks(Pipe(raw_taq), chunksize=3000)
+    assert (np.hstack(list(taq_in)) == expected).all()
+
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(Pipe(raw_taq), index=True)
+
+
+def multi_member_zips(raw_taq):
+    '''A streamed archive (with data descriptors), and a regular one'''
+    streamed = Unseekable()
+    with ZipFile(streamed, 'w', ZIP_DEFLATED) as zfile:
+        zfile.writestr('EQY_US_ALL_BBO_20140206', raw_taq)
+        with zfile.open('EQY_US_ALL_BBO_20140207', 'w',
+                        force_zip64=True) as member:
+            member.write(raw_taq)
+
+    regular = BytesIO()
+    with ZipFile(regular, 'w', ZIP_DEFLATED) as zfile:
+        zfile.writestr('EQY_US_ALL_BBO_20140206', raw_taq)
+        zfile.writestr('some_dir/', b'')
+        zfile.writestr(ZipInfo('EQY_US_ALL_BBO_20140207'), raw_taq,
+                       compress_type=ZIP_STORED)
+
+    return bytes(streamed.written), regular.getvalue()
+
+
+def test_each_member(raw_taq, expected, tmpdir):
+    streamed, regular = multi_member_zips(raw_taq)
+    zip_name = str(tmpdir.join('days.zip'))
+    with open(zip_name, 'wb') as zip_file:
+        zip_file.write(regular)
+    names = ['EQY_US_ALL_BBO_20140206', 'EQY_US_ALL_BBO_20140207']
+
+    for source, jobs in [(Pipe(streamed), None), (Pipe(regular), None),
+                         (zip_name, None), (zip_name, 2)]:
+        seen = []
+        for taq_in in marketflow.TAQ2Chunks.each_member(source, jobs=jobs,
+                                                        chunksize=3000):
+            seen.append(taq_in.infile_name)
+            assert (np.hstack(list(taq_in)) == expected).all()
+        assert seen == names
+
+    # Picking a single member
+    taq_in = marketflow.TAQ2Chunks(Pipe(streamed), member=names[1])
+    assert taq_in.infile_name == names[1]
+    taq_in = marketflow.TAQ2Chunks(zip_name, member=1)
+    assert taq_in.infile_name == names[1]
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(zip_name)
+    with pytest.raises(ValueError):
+        open_stream(Pipe(regular), member='missing')
+    with pytest.raises(ValueError):
+        list(marketflow.TAQ2Chunks.each_member(Pipe(regular), jobs=2))
+
+
+def test_bad_crc(raw_taq):
+    _, regular = multi_member_zips(raw_taq)
+    corrupt = bytearray(regular)
+    # A byte in the data of the stored member
+    corrupt[regular.index(b'EQY_US_ALL_BBO_20140207') + 1000] ^= 1
+
+    with pytest.raises(BadZipFile):
+        for taq_in in marketflow.TAQ2Chunks.each_member(Pipe(corrupt)):
+            list(taq_in)
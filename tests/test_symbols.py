@@ -0,0 +1,54 @@
+'''Test the marketflow.symbols module'''
+
+from os import path
+
+import numpy as np
+import pytest
+
+import marketflow
+from marketflow.symbols import SymbolTable
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+def test_intern():
+    table = SymbolTable()
+    roots = np.array([b'AAA   ', b'AAA   ', b'BB    ', b'AAA   '], 'S6')
+    suffixes = np.array([b'', b'', b'', b'PR'], 'S10')
+    suffixes = np.char.ljust(suffixes, 10)
+
+    ids = table.intern(roots, suffixes)
+
+    assert ids.dtype == np.int32
+    assert ids.tolist() == [0, 0, 1, 2]
+    assert table.id_for('BB') == 1
+    assert table.id_for('AAA', 'PR') == 2
+    assert (table.roots[ids] == roots).all()
+    assert (table.suffixes[ids] == suffixes).all()
+    with pytest.raises(KeyError):
+        table.id_for('CCC')
+
+    # Existing symbols keep their IDs
+    assert table.intern(roots[::-1], suffixes[::-1]).tolist() == [2, 1, 0, 0]
+    assert len(table.intern(roots[:0], suffixes[:0])) == 0
+
+
+def test_taq_symbol_ids(tmpdir):
+    taq_in = marketflow.TAQ2Chunks(std_test_file, symbol_ids=True)
+    chunk = next(taq_in)
+    table = taq_in.symbol_table
+
+    assert chunk['Symbol_ID'].dtype == np.int32
+    assert (table.roots[chunk['Symbol_ID']] == chunk['Symbol_root']).all()
+    assert (table.suffixes[chunk['Symbol_ID']] == chunk['Symbol_suffix']).all()
+
+    # A saved table gives the same IDs next time, and isn't changed by
+    # re-reading the same symbols
+    fname = str(tmpdir.join('symbols.npz'))
+    table.save(fname)
+    loaded = SymbolTable.load(fname)
+    again = next(marketflow.TAQ2Chunks(std_test_file, symbol_ids=loaded))
+    assert (again['Symbol_ID'] == chunk['Symbol_ID']).all()
+    assert len(loaded) == len(table)
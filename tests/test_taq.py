@@ -1,5 +1,8 @@
 from os import path, listdir
+from zipfile import ZipFile
 import marketflow
+from marketflow.utility import Prefetcher, parse_size
+import numpy as np
 import arrow
 import pytest
 import configparser
@@ -132,6 +135,378 @@ def test_row_values(fname, numlines=5):
         assert ask_price == chunk_proc[i][9]
         assert ask_size == chunk_proc[i][10]
 
+@mark.parametrize('fname', DATA_FILES)
+def test_columns(fname):
+    columns = ['Time', 'Symbol_root', 'Bid_Price', 'Ask_Size']
+    full = marketflow.TAQ2Chunks(sample_data_dir + fname, chunksize=chunksize)
+    narrow = marketflow.TAQ2Chunks(sample_data_dir + fname,
+                                   chunksize=chunksize, columns=columns)
+
+    full_chunk = next(full)
+    narrow_chunk = next(narrow)
+
+    # We keep file order, not the order of `columns`
+    assert list(narrow_chunk.dtype.names) == columns
+    for name in columns:
+        assert (narrow_chunk[name] == full_chunk[name]).all()
+
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(sample_data_dir + fname, columns=['Nope'])
+
+
+def test_symbols():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    # PWXSAN has rows with and without the PRA suffix
+    symbols = ['BNETHJ', ('PWXSAN', 'PRA')]
+    full = marketflow.TAQ2Chunks(fname)
+    filtered = marketflow.TAQ2Chunks(fname, chunksize=500, symbols=symbols)
+
+    full_chunk = next(full)
+    expected = full_chunk[(full_chunk['Symbol_root'] == b'BNETHJ') |
+                          ((full_chunk['Symbol_root'] == b'PWXSAN') &
+                           (full_chunk['Symbol_suffix'] == b'PRA'.ljust(10)))]
+    result = np.hstack(list(filtered))
+
+    assert len(expected) > 0
+    assert (result == expected).all()
+
+
+def test_symbols_stop_early():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    taq_in = marketflow.TAQ2Chunks(fname, chunksize=10,
+                                   do_process_chunk=False)
+    raw_chunks = list(taq_in)
+    consumed = []
+
+    def counted():
+        for chunk in raw_chunks:
+            consumed.append(chunk)
+            yield chunk
+
+    # AOCHDQ is the first symbol in the file
+    taq_in.symbols = ['AOCHDQ']
+    result = np.hstack(list(taq_in.filter_chunks(counted())))
+
+    assert (result['Symbol_root'] == b'AOCHDQ').all()
+    assert len(consumed) < len(raw_chunks)
+
+
+def test_time_modes():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    float_in = marketflow.TAQ2Chunks(fname)
+    float_chunk = next(float_in)
+    ns_in = marketflow.TAQ2Chunks(fname, time_mode='ns')
+    ns_chunk = next(ns_in)
+    ms_chunk = next(marketflow.TAQ2Chunks(fname, time_mode='ms'))
+
+    for chunk in [ns_chunk, ms_chunk]:
+        assert chunk['Time'].dtype == np.int64
+        for name in ['hour', 'minute', 'msec']:
+            assert name not in chunk.dtype.names
+
+    hour, minute, msec = [float_chunk[name].astype(np.int64)
+                          for name in ['hour', 'minute', 'msec']]
+    expected_ms = (hour * 3600 + minute * 60) * 1000 + msec
+    assert (ms_chunk['Time'] == expected_ms).all()
+    assert (ns_chunk['Time'] ==
+            expected_ms * 1000000 + ns_in.midnight_ns).all()
+
+    # All modes agree on datetime64
+    as_dt = ns_in.to_datetime64(ns_chunk['Time'])
+    assert as_dt.dtype == np.dtype('M8[ns]')
+    assert (as_dt == float_in.to_datetime64(float_chunk['Time'])).all()
+
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(fname, time_mode='fortnights')
+
+
+def test_price_modes():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    raw = next(marketflow.TAQ2Chunks(fname, do_process_chunk=False))
+    float_chunk = next(marketflow.TAQ2Chunks(fname))
+    int_in = marketflow.TAQ2Chunks(fname, price_mode='int')
+    int_chunk = next(int_in)
+    int32_chunk = next(marketflow.TAQ2Chunks(fname, price_mode='int32'))
+
+    for name in ['Bid_Price', 'Ask_Price']:
+        assert int_chunk[name].dtype == np.int64
+        assert int32_chunk[name].dtype == np.int32
+        # Exactly what's in the file
+        assert (int_chunk[name] == raw[name].astype(np.int64)).all()
+        assert (int32_chunk[name] == int_chunk[name]).all()
+        assert (int_in.to_dollars(int_chunk[name]) == float_chunk[name]).all()
+
+    # Everything else is unchanged
+    assert (int_chunk['Bid_Size'] == float_chunk['Bid_Size']).all()
+
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(fname, price_mode='fractions')
+
+
+def test_price_int32_overflow():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    taq_in = marketflow.TAQ2Chunks(fname, do_process_chunk=False)
+    raw = next(taq_in).copy()
+    raw['Ask_Price'][3] = b'99999999999'
+
+    int32_in = marketflow.TAQ2Chunks(fname, price_mode='int32')
+    with pytest.raises(ValueError):
+        int32_in.process_chunk(raw)
+    # The full int64 is fine
+    int_in = marketflow.TAQ2Chunks(fname, price_mode='int')
+    assert int_in.process_chunk(raw)['Ask_Price'][3] == 99999999999
+
+
+def test_categorical():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    bytes_chunk = next(marketflow.TAQ2Chunks(fname))
+    cat_in = marketflow.TAQ2Chunks(fname, categorical=True)
+    cat_chunk = next(cat_in)
+
+    categories = cat_in.bytes_spec.categories()
+    assert 'Exchange' in categories
+    assert 'National_BBO_LULD_Indicator' in categories
+    # Multi-byte fields are left alone
+    assert 'Symbol_root' not in categories
+    assert cat_chunk['Symbol_root'].dtype == bytes_chunk['Symbol_root'].dtype
+
+    for name, values in categories.items():
+        assert cat_chunk[name].dtype == np.uint8
+        assert (values[cat_chunk[name]] == bytes_chunk[name]).all()
+
+    assert ((cat_chunk['Exchange'] == ord('N')) ==
+            (bytes_chunk['Exchange'] == b'N')).all()
+
+
+def test_memory_budget():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    full = next(marketflow.TAQ2Chunks(fname))
+
+    taq_in = marketflow.TAQ2Chunks(fname, memory_budget='1MB')
+    footprint = taq_in.row_footprint()
+    # At least the raw line and the processed row
+    assert footprint > (taq_in.bytes_spec.bytes_per_line +
+                        full.dtype.itemsize)
+    assert taq_in.chunksize == 2 ** 20 // footprint
+    chunks = list(taq_in)
+    assert len(chunks[0]) == taq_in.chunksize
+    assert (np.hstack(chunks) == full).all()
+
+    # Prefetched chunks count against the budget
+    prefetching = marketflow.TAQ2Chunks(fname, memory_budget='1MB',
+                                        prefetch=2)
+    assert prefetching.chunksize < taq_in.chunksize
+
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(fname, memory_budget=10)
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(fname, chunksize=10, memory_budget='1MB')
+
+
+def test_parse_size():
+    assert parse_size(1000) == 1000
+    assert parse_size('512MB') == 512 * 2 ** 20
+    assert parse_size('1.5 g') == 3 * 2 ** 29
+    with pytest.raises(ValueError):
+        parse_size('12 parsecs')
+
+
+def test_calibrate():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+
+    chunksize, rates = marketflow.TAQ2Chunks.calibrate(
+        fname, '1MB', candidates=[1000, 4000, 10 ** 9], sample_rows=10000)
+
+    # The candidate that doesn't fit is dropped
+    assert sorted(rates) == [1000, 4000]
+    assert chunksize in rates
+
+
+@mark.parametrize('prefetch', [None, 2])
+def test_recycle(prefetch):
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    full = next(marketflow.TAQ2Chunks(fname))
+
+    taq_in = marketflow.TAQ2Chunks(fname, chunksize=1000, recycle=2,
+                                   prefetch=prefetch)
+    chunks = []
+    seen = []
+    for chunk in taq_in:
+        # We need to copy chunks we keep around
+        chunks.append(chunk.copy())
+        seen.append(chunk)
+    assert (np.hstack(chunks) == full).all()
+
+    # Only two distinct output buffers were used
+    assert len(chunks) > 2
+    assert np.shares_memory(seen[0], seen[2])
+    assert not np.shares_memory(seen[0], seen[1])
+
+    # The same for raw chunks
+    raw = np.hstack([chunk.copy() for chunk in marketflow.TAQ2Chunks(
+        fname, chunksize=1000, recycle=2, do_process_chunk=False,
+        prefetch=prefetch)])
+    assert (raw == next(marketflow.TAQ2Chunks(
+        fname, do_process_chunk=False))).all()
+
+
+def write_synthetic(fname, spec_class, rows):
+    '''Write a zipped raw TAQ file with records from `rows` of field values
+
+    Fields missing from a row are filled with zeros.
+    '''
+    fields = spec_class.initial_dtype_info
+    bytes_per_line = sum(width for _, width in fields) + 2
+    header = ' N02062014 Record Count : {:>7}'.format(len(rows))
+    lines = [header.ljust(bytes_per_line - 2).encode('ascii')]
+    for row in rows:
+        lines.append(b''.join(row.get(name, b'0' * width).rjust(width)
+                              for name, width in fields))
+
+    with ZipFile(fname, 'w') as zfile:
+        zfile.writestr(path.basename(fname)[:-4],
+                       b''.join(line + b'\r\n' for line in lines))
+
+
+def test_layouts(tmpdir):
+    trades = [{'hour': b'09', 'minute': b'30', 'msec': b'01234',
+               'Exchange': b'N', 'Symbol_root': b'AAA   ',
+               'Symbol_suffix': b' ' * 10, 'Sale_Condition': b'@  F',
+               'Trade_Volume': b'000000100', 'Trade_Price': b'00001234500'},
+              {'hour': b'15', 'minute': b'59', 'msec': b'59999',
+               'Exchange': b'T', 'Symbol_root': b'BBB   ',
+               'Symbol_suffix': b'PR'.ljust(10),
+               'Trade_Volume': b'000012345', 'Trade_Price': b'00000010000'}]
+    # Detected by name
+    trade_name = str(tmpdir.join('EQY_US_ALL_TRADE_20140206.zip'))
+    write_synthetic(trade_name, marketflow.raw_taq.TradeBytesSpec, trades)
+    # Detected by record length
+    other_name = str(tmpdir.join('trades.zip'))
+    write_synthetic(other_name, marketflow.raw_taq.TradeBytesSpec, trades)
+
+    for fname in [trade_name, other_name]:
+        taq_in = marketflow.TAQ2Chunks(fname, price_mode='int')
+        chunk = next(taq_in)
+        assert taq_in.file_type == 'TRADE'
+        assert chunk['Trade_Price'].tolist() == [1234500, 10000]
+        assert chunk['Trade_Volume'].tolist() == [100, 12345]
+        assert chunk['Symbol_root'].tolist() == [b'AAA   ', b'BBB   ']
+        assert chunk['Sale_Condition'][0] == b'@  F'
+        assert taq_in.to_datetime64(chunk['Time'])[1] == \
+            np.datetime64('2014-02-06T20:59:59.999')
+
+    # NBBO files also contain 'BBO'
+    nbbo_name = str(tmpdir.join('EQY_US_ALL_NBBO_20140206.zip'))
+    write_synthetic(nbbo_name, marketflow.raw_taq.NBBOBytesSpec,
+                    [{'Best_Offer_Price': b'00000020000'}])
+    taq_in = marketflow.TAQ2Chunks(nbbo_name)
+    assert taq_in.file_type == 'NBBO'
+    assert next(taq_in)['Best_Offer_Price'][0] == 2.
+
+    # Layouts are only worked out once
+    BytesSpec = marketflow.BytesSpec
+    assert BytesSpec.layout(98) is BytesSpec.layout(98)
+    assert not BytesSpec.fits(73)
+    with pytest.raises(ValueError):
+        marketflow.raw_taq.detect_file_type(b'too short')
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(trade_name, file_type='BBO')
+
+
+@mark.parametrize('taq_args', [{},
+                                dict(time_mode='ns', price_mode='int',
+                                     categorical=True),
+                                dict(time_mode='ms', symbol_ids=True),
+                                dict(columns=['Time', 'Symbol_root',
+                                              'Bid_Price'])])
+def test_encode_chunk(taq_args, tmpdir):
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    raw = np.hstack(list(marketflow.TAQ2Chunks(fname,
+                                               do_process_chunk=False)))
+    taq_in = marketflow.TAQ2Chunks(fname, **taq_args)
+    encoded = [taq_in.encode_chunk(chunk) for chunk in taq_in]
+
+    if 'columns' in taq_args:
+        encoded = np.hstack(encoded)
+        for name in ['hour', 'minute', 'msec', 'Symbol_root', 'Bid_Price']:
+            assert (encoded[name] == raw[name]).all()
+        assert (encoded['Ask_Price'] == b'0' * 11).all()
+        assert (encoded['Exchange'] == b' ').all()
+        return
+
+    # Round trip, through a file
+    out_name = str(tmpdir.join('taq.zip'))
+    numrows = marketflow.raw_taq.write_taq(out_name, taq_in.first_line,
+                                           encoded)
+    assert numrows == len(raw)
+    written = marketflow.TAQ2Chunks(out_name, do_process_chunk=False)
+    assert written.first_line == taq_in.first_line
+    assert np.hstack(list(written)).tobytes() == raw.tobytes()
+
+
+def test_uncompressed(tmpdir):
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    txt_name = str(tmpdir.join('taq.txt'))
+    with ZipFile(fname) as zfile:
+        zinfo, = zfile.infolist()
+        with open(txt_name, 'wb') as txt_file:
+            txt_file.write(zfile.read(zinfo))
+
+    zipped = np.hstack(list(marketflow.TAQ2Chunks(fname, chunksize=1000)))
+    mapped = marketflow.TAQ2Chunks(txt_name, chunksize=1000)
+    assert mapped.numlines == len(mapped.records)
+    assert (np.hstack(list(mapped)) == zipped).all()
+
+    # Raw chunks are views on the memory map
+    raw = marketflow.TAQ2Chunks(txt_name, chunksize=1000,
+                                do_process_chunk=False)
+    assert np.shares_memory(next(raw), raw.records)
+
+    from_row = marketflow.TAQ2Chunks(txt_name, start_row=5000)
+    assert (next(from_row) == zipped[5000:]).all()
+
+    from_symbol = marketflow.TAQ2Chunks(txt_name, start_symbol='OGKZWV')
+    assert (next(from_symbol) ==
+            zipped[zipped['Symbol_root'] >= b'OGKZWV']).all()
+
+    symbols = marketflow.TAQ2Chunks(txt_name, symbols=['OGKZWV'])
+    assert (next(symbols) ==
+            zipped[zipped['Symbol_root'] == b'OGKZWV']).all()
+
+
+def test_prefetch():
+    fname = sample_data_dir + config['taq-data']['std-test-file']
+    plain = list(marketflow.TAQ2Chunks(fname, chunksize=100))
+    prefetched = marketflow.TAQ2Chunks(fname, chunksize=100, prefetch=3)
+
+    for expected, chunk in zip(plain, prefetched):
+        assert (expected == chunk).all()
+    # zip() stops early on plain, so make sure we're done
+    assert list(prefetched) == []
+
+    stats = prefetched.prefetcher
+    assert stats.items == len(plain)
+    assert stats.consumer_stalls >= 0 and stats.producer_stalls >= 0
+
+    # Stopping early shouldn't hang
+    early = marketflow.TAQ2Chunks(fname, chunksize=10, prefetch=1)
+    next(early)
+    early.close()
+
+
+def test_prefetch_errors():
+    calls = []
+
+    def bad_read():
+        calls.append(1)
+        if len(calls) > 2:
+            raise IOError('Oops')
+        return b'data'
+
+    with pytest.raises(IOError):
+        list(Prefetcher(bad_read, 1))
+
+
 @mark.parametrize('fname', DATA_FILES)
 def test_statistics(fname):
     # np.average()
@@ -0,0 +1,100 @@
+'''Test the marketflow.validation module'''
+
+from os import path
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+import marketflow
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+def read_member():
+    with ZipFile(std_test_file) as zfile:
+        zinfo, = zfile.infolist()
+        return zinfo.filename, bytearray(zfile.read(zinfo))
+
+
+def write_member(fname, member_name, data):
+    with ZipFile(fname, 'w') as zfile:
+        zfile.writestr(member_name, bytes(data))
+
+
+def field_offset(row, name):
+    '''Offset in the raw file of field `name` in record `row`'''
+    spec = marketflow.BytesSpec(98)
+    offset = np.dtype(spec.initial_dtype).fields[name][1]
+    return (row + 1) * spec.bytes_per_line + offset
+
+
+def test_clean_file():
+    taq_in = marketflow.TAQ2Chunks(std_test_file, chunksize=1000,
+                                   validate=True)
+    for chunk in taq_in:
+        pass
+
+    assert taq_in.validator.ok
+    assert taq_in.validator.rows_seen == len(taq_in)
+    assert taq_in.validator.row_count_ok
+    assert taq_in.validator.report().startswith('OK')
+
+
+@pytest.mark.parametrize('chunksize', [1000, 10 ** 6])
+def test_bad_records(tmpdir, chunksize):
+    member_name, data = read_member()
+    data[field_offset(10, 'Bid_Price') + 3] = ord('x')
+    hour = field_offset(20, 'hour')
+    data[hour:hour + 2] = b'25'
+    data[field_offset(30, 'newline')] = ord('\n')
+    # Row 1000 starts a chunk (for chunksize=1000), and is the same symbol
+    # as row 999
+    sequence = field_offset(1000, 'Sequence_Number')
+    data[sequence:sequence + 16] = b'0' * 16
+    # A truncated download
+    del data[-50:]
+
+    fname = str(tmpdir.join('bad.zip'))
+    write_member(fname, member_name, data)
+
+    taq_in = marketflow.TAQ2Chunks(fname, chunksize=chunksize, validate=True)
+    chunks = list(taq_in)
+    validator = taq_in.validator
+
+    assert sum(len(chunk) for chunk in chunks) == len(taq_in) - 1
+    assert not validator.ok
+    assert validator.bad_row_numbers('digits:Bid_Price').tolist() == [10]
+    assert validator.bad_row_numbers('range:hour').tolist() == [20]
+    assert validator.bad_row_numbers('newline').tolist() == [30]
+    assert validator.bad_row_numbers('sequence').tolist() == [1000]
+    assert validator.bad_offsets('newline').tolist() == \
+        [field_offset(30, 'hour')]
+    assert validator.bad_counts['digits:Ask_Price'] == 0
+    assert validator.partial_bytes == 48
+    assert validator.row_count_ok is False
+    assert 'digits:Bid_Price: 1 rows, first at row 10' in validator.report()
+
+    # Raising stops at the first bad chunk
+    taq_in = marketflow.TAQ2Chunks(fname, chunksize=chunksize,
+                                   validate='raise')
+    with pytest.raises(ValueError):
+        list(taq_in)
+
+
+def test_uncompressed(tmpdir):
+    member_name, data = read_member()
+    data[field_offset(5, 'Ask_Size')] = ord('-')
+
+    fname = str(tmpdir.join('bad.txt'))
+    with open(fname, 'wb') as outfile:
+        outfile.write(data)
+
+    taq_in = marketflow.TAQ2Chunks(fname, chunksize=1000, validate=True,
+                                   do_process_chunk=False)
+    list(taq_in)
+
+    assert taq_in.validator.bad_row_numbers('digits:Ask_Size').tolist() == [5]
+    assert taq_in.validator.row_count_ok
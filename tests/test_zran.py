@@ -0,0 +1,113 @@
+'''Test the marketflow.zran module'''
+
+from os import path
+from shutil import copy
+from zipfile import ZipFile, BadZipFile
+
+import numpy as np
+import pytest
+
+import marketflow
+from marketflow.zran import (SeekIndex, build_index, index_name,
+                             member_data_range)
+
+test_path = path.dirname(__file__)
+sample_data_dir = path.join(test_path, '../test-data/')
+std_test_file = sample_data_dir + 'small_test_data_public.zip'
+
+
+@pytest.fixture
+def indexed_file(tmpdir):
+    '''A copy of our test data, with an index with several restart points'''
+    taq_fname = str(tmpdir.join('test.zip'))
+    copy(std_test_file, taq_fname)
+    build_index(taq_fname, span=50000)
+
+    return taq_fname
+
+
+def test_open_at(indexed_file):
+    index = SeekIndex.load(index_name(indexed_file))
+    assert len(index) > 1
+
+    with ZipFile(indexed_file) as zfile:
+        zinfo, = zfile.infolist()
+        full = zfile.read(zinfo)
+        data_start, _ = member_data_range(zfile, zinfo)
+
+    for offset in [0, 17, 250000, len(full) - 10] + \
+            [int(x) for x in index.out_offset]:
+        with open(indexed_file, 'rb') as raw_fp:
+            reader = index.open_at(raw_fp, data_start, offset)
+            assert reader.read(100000) == full[offset:offset + 100000]
+            reader.close()
+
+
+def test_first_rows(indexed_file):
+    index = SeekIndex.load(index_name(indexed_file))
+    taq_in = marketflow.TAQ2Chunks(indexed_file, do_process_chunk=False)
+    raw = next(taq_in)
+
+    assert (raw['Symbol_root'][index.first_row] == index.first_root).all()
+    assert (raw['Symbol_suffix'][index.first_row] ==
+            index.first_suffix).all()
+
+
+def test_start_row_and_symbol(indexed_file):
+    full = next(marketflow.TAQ2Chunks(indexed_file))
+
+    from_row = np.hstack(list(marketflow.TAQ2Chunks(
+        indexed_file, chunksize=1000, index=True, start_row=7000)))
+    assert (from_row == full[7000:]).all()
+
+    from_symbol = np.hstack(list(marketflow.TAQ2Chunks(
+        indexed_file, chunksize=1000, index=True, start_symbol='OGKZWV')))
+    assert (from_symbol == full[full['Symbol_root'] >= b'OGKZWV']).all()
+
+    # The same thing, without an index
+    from_symbol = np.hstack(list(marketflow.TAQ2Chunks(
+        indexed_file, chunksize=1000, start_symbol='OGKZWV')))
+    assert (from_symbol == full[full['Symbol_root'] >= b'OGKZWV']).all()
+
+    symbols = np.hstack(list(marketflow.TAQ2Chunks(
+        indexed_file, chunksize=1000, index=True, symbols=['OGKZWV'])))
+    assert (symbols == full[full['Symbol_root'] == b'OGKZWV']).all()
+
+
+def test_stale_index(indexed_file, tmpdir):
+    # The same data, but truncated
+    with ZipFile(indexed_file) as zfile:
+        zinfo, = zfile.infolist()
+        full = zfile.read(zinfo)
+    other = str(tmpdir.join('other.zip'))
+    with ZipFile(other, 'w') as zfile:
+        zfile.writestr(zinfo, full[:len(full) // 2])
+
+    with pytest.raises(ValueError):
+        marketflow.TAQ2Chunks(other, index=index_name(indexed_file))
+
+
+def test_raw_backend(tmpdir):
+    expected = np.hstack(list(marketflow.TAQ2Chunks(std_test_file,
+                                                    chunksize=3000)))
+    for taq_args in [{}, dict(check_crc=False), dict(start_row=5000),
+                     dict(recycle=2)]:
+        taq_in = marketflow.TAQ2Chunks(std_test_file, chunksize=3000,
+                                       zip_backend='raw', **taq_args)
+        chunks = [chunk.copy() for chunk in taq_in]
+        start_row = taq_args.get('start_row', 0)
+        assert (np.hstack(chunks) == expected[start_row:]).all()
+
+    # Change the CRC-32 in the central directory
+    with open(std_test_file, 'rb') as taq_file:
+        data = bytearray(taq_file.read())
+    data[data.rindex(b'PK\x01\x02') + 16] ^= 1
+    bad_crc = str(tmpdir.join('bad_crc.zip'))
+    with open(bad_crc, 'wb') as bad_file:
+        bad_file.write(data)
+
+    with pytest.raises(BadZipFile):
+        list(marketflow.TAQ2Chunks(bad_crc, zip_backend='raw'))
+    unchecked = marketflow.TAQ2Chunks(bad_crc, zip_backend='raw',
+                                      check_crc=False)
+    assert sum(len(chunk) for chunk in unchecked) == len(expected)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+'''Compare compression and chunkshape settings for H5Writer on a TAQ file
+
+For example:
+
+    $ python utils/benchmark_hdf5.py EQY_US_ALL_BBO_20140206.zip \
+        --complib blosc:lz4 blosc:zstd --complevel 1 5 --chunkshape 0 8192
+
+converts the file once for each combination of --complib, --complevel,
+--shuffle and --chunkshape (0 lets PyTables pick), and once for each of
+H5Writer.presets (unless --no-presets). For each, we report:
+
+- write speed, in MB/s of uncompressed TAQ data
+- the size of the HDF5 file
+- symbol latency: reading all of a few symbols' tables (the largest, and some
+  picked at random), as a median in ms
+- time-range latency: reading 1% of the rows of the same tables, by Time,
+  as a median in ms
+
+Reads are from a warm OS cache, so they mostly measure decompression.
+'''
+
+from itertools import product
+from os import path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import time
+
+import numpy as np
+import tables as tb
+
+from marketflow.hdf5 import H5Writer, conv_to_hdf5, uncompressed_size
+
+
+SHUFFLES = {'none': dict(shuffle=False),
+            'byte': dict(shuffle=True),
+            'bit': dict(shuffle=False, bitshuffle=True),
+           }
+
+
+def matrix_configs(complibs, complevels, shuffles, chunkshapes):
+    '''Yield (name, conv_args) for every combination of settings'''
+    for complib, complevel, shuffle, chunkshape in \
+            product(complibs, complevels, shuffles, chunkshapes):
+        filters = tb.Filters(complib=complib, complevel=complevel,
+                             **SHUFFLES[shuffle])
+        name = '{} {} {} {}'.format(complib, complevel, shuffle,
+                                    chunkshape or 'auto')
+        yield name, dict(filters=filters, chunkshape=chunkshape or None)
+
+
+def preset_configs():
+    '''Yield (name, conv_args) for H5Writer.presets'''
+    for preset in sorted(H5Writer.presets):
+        yield preset, dict(preset=preset)
+
+
+def sample_tables(h5, count, seed=0):
+    '''Return paths of the largest table and (count - 1) random others'''
+    tables = sorted((table.nrows, table._v_pathname)
+                    for table in h5.walk_nodes('/', 'Table'))
+    largest = tables.pop()[1]
+    others = Random(seed).sample(tables, min(count - 1, len(tables)))
+    return [largest] + [pathname for _, pathname in others]
+
+
+def read_latency(h5_name, table_paths):
+    '''Return median (symbol, time-range) read times in seconds'''
+    symbol_times = []
+    range_times = []
+    with tb.open_file(h5_name) as h5:
+        for table_path in table_paths:
+            table = h5.get_node(table_path)
+
+            tstart = time()
+            table.read()
+            symbol_times.append(time() - tstart)
+
+            # Pick a window of Time with about 1% of the rows in the middle of
+            # the day, then look it up the way a user would
+            nrows = table.nrows
+            lo = table.cols.Time[nrows // 2]
+            hi = table.cols.Time[min(nrows // 2 + max(nrows // 100, 1),
+                                     nrows - 1)]
+            tstart = time()
+            table.read_where('(Time >= lo) & (Time <= hi)')
+            range_times.append(time() - tstart)
+
+    return np.median(symbol_times), np.median(range_times)
+
+
+def run_config(taq_name, h5_name, conv_args, table_paths=None, samples=10):
+    '''Convert with `conv_args`, and return a dict of results
+
+    `table_paths` are the tables to read back, picked from this file if
+    None.'''
+    tstart = time()
+    conv_to_hdf5(taq_name, h5_name, **conv_args)
+    write_time = time() - tstart
+
+    if table_paths is None:
+        with tb.open_file(h5_name) as h5:
+            table_paths = sample_tables(h5, samples)
+    symbol_time, range_time = read_latency(h5_name, table_paths)
+
+    return dict(write_time=write_time, size=path.getsize(h5_name),
+                symbol_time=symbol_time, range_time=range_time,
+                table_paths=table_paths)
+
+
+def main(taq_name, configs, samples, time_mode):
+    nbytes = uncompressed_size(taq_name)
+    print('{:>32} {:>8} {:>9} {:>10} {:>10}'.format(
+        'settings', 'MB/s', 'MB', 'symbol ms', 'range ms'))
+
+    table_paths = None
+    with TemporaryDirectory() as tmp_dir:
+        for i, (name, conv_args) in enumerate(configs):
+            h5_name = path.join(tmp_dir, '{}.h5'.format(i))
+            # We read the same tables from every file
+            results = run_config(taq_name, h5_name,
+                                 dict(conv_args, time_mode=time_mode),
+                                 table_paths, samples)
+            table_paths = results['table_paths']
+            print('{:>32} {:8.1f} {:9.2f} {:10.3f} {:10.3f}'.format(
+                name, nbytes / 1e6 / results['write_time'],
+                results['size'] / 1e6, results['symbol_time'] * 1e3,
+                results['range_time'] * 1e3))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fname', help='Path to (zipped) TAQ data')
+    parser.add_argument('--complib', nargs='*', default=[],
+                        choices=tb.filters.all_complibs,
+                        help='Compression libraries to try')
+    parser.add_argument('--complevel', nargs='+', type=int, default=[5],
+                        help='Compression levels to try')
+    parser.add_argument('--shuffle', nargs='+', default=['byte'],
+                        choices=sorted(SHUFFLES),
+                        help='Shuffle filters to try')
+    parser.add_argument('--chunkshape', nargs='+', type=int, default=[0],
+                        help='Rows per chunk to try (0 lets PyTables pick)')
+    parser.add_argument('--no-presets', action='store_true',
+                        help="Don't try H5Writer.presets")
+    parser.add_argument('--samples', type=int, default=10,
+                        help='Number of tables to read back')
+    parser.add_argument('--time-mode', choices=['float', 'ns', 'ms'],
+                        default='float', help='Passed on to conv_to_hdf5')
+    args = parser.parse_args()
+
+    configs = list(matrix_configs(args.complib, args.complevel, args.shuffle,
+                                  args.chunkshape))
+    if not args.no_presets:
+        configs += list(preset_configs())
+    if not configs:
+        parser.error('Nothing to try, give --complib or drop --no-presets')
+
+    main(args.fname, configs, args.samples, args.time_mode)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+'''Compare time-range queries on HDF5 files with and without indexes
+
+For example:
+
+    $ python utils/benchmark_queries.py EQY_US_ALL_BBO_20140206.zip
+
+converts the file with conv_to_hdf5 (by default with --layout single), once
+without indexes and once with (indexes=True), then times random Time
+windows (--width of the day each) three ways:
+
+- scan: reading everything and selecting in numpy, as you would by hand
+- where: marketflow.hdf5.query() without indexes (an in-kernel scan)
+- indexed: query() with indexes
+
+and the same for just the biggest symbol, with query_symbol(). We report the
+median time over --repeat windows, in ms.
+'''
+
+from os import path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import time
+
+import numpy as np
+import tables as tb
+
+from marketflow.hdf5 import (LAYOUTS, conv_to_hdf5, query, query_symbol,
+                             read_symbol)
+
+
+def median_ms(func, windows):
+    '''Median time of func(start, stop) over windows, in ms'''
+    times = []
+    for start, stop in windows:
+        tstart = time()
+        func(start, stop)
+        times.append(time() - tstart)
+    return np.median(times) * 1e3
+
+
+def scan_all(h5, start, stop):
+    '''Select a window from everything, by hand'''
+    for _, rows in query(h5):
+        rows[(rows['Time'] >= start) & (rows['Time'] < stop)]
+
+
+def scan_symbol(h5, symbol, start, stop):
+    '''Select a window from one symbol, by hand'''
+    rows = read_symbol(h5, *symbol)
+    rows[(rows['Time'] >= start) & (rows['Time'] < stop)]
+
+
+def biggest_symbol(h5):
+    '''(root, suffix) with the most rows'''
+    return max(((len(rows), symbol) for symbol, rows in query(h5)))[1]
+
+
+def main(taq_name, layout, width, repeat, seed=0):
+    with TemporaryDirectory() as tmp_dir:
+        plain_name = path.join(tmp_dir, 'plain.h5')
+        indexed_name = path.join(tmp_dir, 'indexed.h5')
+
+        tstart = time()
+        conv_to_hdf5(taq_name, plain_name, layout=layout)
+        plain_time = time() - tstart
+        tstart = time()
+        conv_to_hdf5(taq_name, indexed_name, layout=layout, indexes=True)
+        indexed_time = time() - tstart
+        print('conversion: {:.2f} sec, {:.2f} sec with indexes '
+              '({:.1f} MB, {:.1f} MB)'.format(
+                  plain_time, indexed_time, path.getsize(plain_name) / 1e6,
+                  path.getsize(indexed_name) / 1e6))
+
+        with tb.open_file(plain_name) as plain, \
+                tb.open_file(indexed_name) as indexed:
+            times = np.hstack([rows['Time'] for _, rows in query(plain)])
+            first, last = times.min(), times.max()
+            span = (last - first) * width
+            rand = Random(seed)
+            windows = []
+            for _ in range(repeat):
+                start = first + rand.random() * (last - first - span)
+                windows.append((start, start + span))
+
+            symbol = biggest_symbol(plain)
+            print('{:>8} {:>10} {:>10} {:>10}'.format(
+                '', 'scan ms', 'where ms', 'indexed ms'))
+            print('{:>8} {:10.2f} {:10.2f} {:10.2f}'.format(
+                'all',
+                median_ms(lambda lo, hi: scan_all(plain, lo, hi), windows),
+                median_ms(lambda lo, hi: list(query(plain, lo, hi)),
+                          windows),
+                median_ms(lambda lo, hi: list(query(indexed, lo, hi)),
+                          windows)))
+            print('{:>8} {:10.2f} {:10.2f} {:10.2f}'.format(
+                symbol[0].decode('ascii'),
+                median_ms(lambda lo, hi: scan_symbol(plain, symbol, lo, hi),
+                          windows),
+                median_ms(lambda lo, hi: query_symbol(plain, *symbol,
+                                                      start=lo, stop=hi),
+                          windows),
+                median_ms(lambda lo, hi: query_symbol(indexed, *symbol,
+                                                      start=lo, stop=hi),
+                          windows)))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fname', help='Path to (zipped) TAQ data')
+    parser.add_argument('--layout', choices=LAYOUTS, default='single',
+                        help='Passed on to conv_to_hdf5')
+    parser.add_argument('--width', type=float, default=0.01,
+                        help='Width of each window, as a fraction of the day')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of windows to try')
+    args = parser.parse_args()
+
+    main(args.fname, args.layout, args.width, args.repeat)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+'''Compare read throughput of TAQ2Chunks' zip backends on a zipped TAQ file
+
+For example:
+
+    $ python utils/benchmark_zip_backends.py EQY_US_ALL_BBO_20140206.zip
+
+Raw chunks are read (no processing), so this is mostly decompression. Times
+are the best of --repeat passes.
+'''
+
+from time import time
+
+import marketflow
+from marketflow.hdf5 import uncompressed_size
+
+
+CONFIGS = [('zipfile', dict(zip_backend='zipfile')),
+           ('raw', dict(zip_backend='raw')),
+           ('raw, no CRC', dict(zip_backend='raw', check_crc=False)),
+          ]
+
+
+def time_pass(fname, chunksize, taq_args):
+    '''Return (rows, seconds) for one pass over fname'''
+    tstart = time()
+    taq_in = marketflow.TAQ2Chunks(fname, chunksize=chunksize,
+                                   do_process_chunk=False, **taq_args)
+    numrows = sum(len(chunk) for chunk in taq_in)
+    return numrows, time() - tstart
+
+
+def main(fname, chunksize, repeat):
+    nbytes = uncompressed_size(fname)
+    for name, taq_args in CONFIGS:
+        best = min(time_pass(fname, chunksize, taq_args)[1]
+                   for _ in range(repeat))
+        print('{:>12}: {:.3f} sec ({:.0f} MB/s)'.format(
+            name, best, nbytes / 1e6 / best))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fname', help='Path to zipped TAQ data')
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help='Rows per chunk')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Passes for each backend (we report the best)')
+    args = parser.parse_args()
+
+    main(args.fname, args.chunksize, args.repeat)
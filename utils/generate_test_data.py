@@ -2,11 +2,9 @@
 
 '''Mix up symbols and prices a little bit'''
 
-from zipfile import ZipFile, ZIP_DEFLATED
-from os import path
-
 import marketflow
 import marketflow.processing as tp
+from marketflow.raw_taq import write_taq
 
 
 def main(fname_in, fname_out, size, frac):
@@ -34,17 +32,9 @@ def main(fname_in, fname_out, size, frac):
     # padding for the rest of the line
     first_line += b' '*(line_len-len(first_line)-2) + b'\r\n'
 
-    with open(fname_out, 'wb') as ofile:
-        ofile.write(first_line)
-
-        for chunk in sorted(chunks, key=lambda x: x[0]['Symbol_root']):
-            ofile.write(chunk)
-
-    basename = path.basename(fname_out)
-    with ZipFile(fname_out + '.zip', 'w') as zf:
-        zf.write(fname_out, basename, ZIP_DEFLATED)
-
-    # Currently, the unzipped version of fname_out is left laying around!
+    # Chunks are streamed straight into the zip archive
+    write_taq(fname_out + '.zip', first_line,
+              sorted(chunks, key=lambda x: x[0]['Symbol_root']))
 
 if __name__ == '__main__':
     import argparse